@@ -20,7 +20,19 @@ class HTadjust(object):
     def __init__(self,FESA_GHOST_Device='GHOSTconfig',FESA_GHOST_Property='HTadjust',
                  simulate_SET=False,INCA_ACCEL='LEIR',sourceHT_selector=None,
                  BCT15_selector='LEI.USER.ALL',which_ebook='TESTS',
-                 no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging=''):
+                 no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging='',
+                 japc_record=None,japc_replay=None,clock=None,log_structured=False,
+                 BCT15_estimator='mean',BCT15_reject_cut=3.5,BCT15_max_reject=0.2,
+                 BCT15_pool_rounds=False,BCT15_max_rounds=2,BCT15_round_shots=None,
+                 BCT15_settle_time=0.0,BCT15_settle_shots=0,BCT15_settle_tol=0.05,BCT15_persistent=True,
+                 tracking=False,dither_amplitude=None,dither_shots=3,tracking_bandwidth=0.01,tracking_gain=10.0,
+                 surrogate=False,surrogate_file=None,surrogate_history=24.0,surrogate_half_life=12.0,
+                 surrogate_timber=('IP.NSRCGEN:SOURCEHTAQNI','ITF.BCT15:CURRENTLINACSINGLE'),
+                 adaptive_schedule=False,schedule_factor=2.0,schedule_min=10.0,schedule_max=None,
+                 wake_on_drop=False,wake_drop=0.05,wake_threshold=5.0,wake_min_interval=300.0,
+                 wake_on_recovery=False,recovery_debounce=10.0,
+                 momentum=False,momentum_freshness=60.0,momentum_drift=0.05,trace_file=None,profile_iterations=None,
+                 status_port=None,japc_rates=None):
         """
         Initialisation of the HTadjust module. The input parameters are:
         
@@ -46,6 +58,111 @@ class HTadjust(object):
         log_level:(default:'DEBUG'): The level of logging for the local log system.
         
         dir_logging: (default:''): The directory of the local log files for logging.
+
+        japc_record:(default:None): Trace file for recording the JAPC session (GET, SET and subscription callbacks).
+
+        japc_replay:(default:None): Trace file (or japc_trace.JAPCReplayer object) to replay instead of a live JAPC session.
+        See japc_trace.replay_module().
+
+        clock:(default:None): The clock of all the waits and time-stamps (cmn_methods.WallClock or VirtualClock). 
+        By default the real time is used (the clock of the trace in replay mode).
+
+        log_structured:(default:False): Flag to write also the structured (JSON lines) log, see ghost_logging.StructuredLogHandler.
+
+        BCT15_estimator:(default:'mean'): The estimator of the BCT15 measurements: 'mean' (mean and standard deviation of all
+        the shots), 'median' (median/MAD) or 'trimmed' (mean of the shots which are not outliers). See GHOST.shot_statistics().
+
+        BCT15_reject_cut:(default:3.5): The outlier rejection threshold of the robust estimators, in robust standard deviations.
+
+        BCT15_max_reject:(default:0.2): The maximum fraction of rejected shots for a stable round of BCT15 measurements.
+
+        BCT15_pool_rounds:(default:False): Flag to pool the rounds of BCT15 measurements with inverse-variance weighting, instead 
+        of judging each round alone. The measurement stops as soon as the pooled estimate is stable.
+
+        BCT15_max_rounds:(default:2): The maximum number of rounds of BCT15 measurements for each DV step.
+
+        BCT15_round_shots:(default:None): The number of shots of each pooled round (None: the shot_number of run()). Shorter 
+        rounds stop earlier in quiet conditions.
+
+        BCT15_settle_time:(default:0.0): Time in seconds after the SET of the HT voltage before the BCT15 shots are valid. 
+        The shots are selected with the cycleStamp of their header, see GHOST.get_my_JAPC_parameter().
+
+        BCT15_settle_shots:(default:0): Number of consecutive shots of the settle detector after the SET (0: no detector).
+
+        BCT15_settle_tol:(default:0.05): Relative spread of the BCT15 shots for the settle detector.
+
+        BCT15_persistent:(default:True): Flag to keep one BCT15 subscription (ring buffer) for the measurements of an iteration,
+        instead of a new subscription for each measurement. See GHOST.start_buffered_subscription() and GHOST.take_shots().
+
+        tracking:(default:False): Flag for the continuous dither/lock-in tracking of the HT voltage (see track_HT()) instead of 
+        the discrete iterations.
+
+        dither_amplitude:(default:None): The amplitude in V of the dither of the tracking mode (None: half of HTadjust_Vrange).
+
+        dither_shots:(default:3): The number of BCT15 shots on each half period of the dither.
+
+        tracking_bandwidth:(default:0.01): The cut-off frequency in Hz of the low-pass filter of the demodulated BCT15 signal.
+
+        tracking_gain:(default:10.0): The move of the center of the dither per period, in units of dither_amplitude times 
+        the filtered relative current difference.
+
+        surrogate:(default:False): Flag for the warm start of the iterations from a surrogate model of the BCT15 current versus
+        the HT voltage (see warm_start() and ghost_surrogate.QuadraticSurrogate). The model is refit incrementally from the Timber
+        history and from the measurements of every iteration.
+
+        surrogate_file:(default:None): The file of the state of the surrogate model (None: dir_logging+'HTadjust_surrogate.json').
+
+        surrogate_history:(default:24.0): The Timber history in hours for the first fit of the surrogate model.
+
+        surrogate_half_life:(default:12.0): The half-life in hours of the weight of the samples of the surrogate model.
+
+        surrogate_timber:(default:('IP.NSRCGEN:SOURCEHTAQNI','ITF.BCT15:CURRENTLINACSINGLE')): The Timber variables of the HT 
+        voltage and of the BCT15 current.
+
+        adaptive_schedule:(default:False): Flag for the adaptive wait between the iterations (see cmn_methods.IterationScheduler
+        and schedule_bounds()) instead of 10 seconds after a change and HTadjust_intervall otherwise.
+
+        schedule_factor:(default:2.0): The backoff factor of the adaptive wait.
+
+        schedule_min:(default:10.0): The minimum adaptive wait in seconds, if not given by the FESA limits of HTadjust_intervall.
+
+        schedule_max:(default:None): The cap of the adaptive wait in seconds, also when the FESA limit of HTadjust_intervall is 
+        larger (None: 4 times HTadjust_intervall).
+
+        wake_on_drop:(default:False): Flag to monitor the BCT15 current during the wait after an iteration and to start the next
+        iteration at once when the current drops (see current_monitor()).
+
+        wake_drop:(default:0.05): The relative drop of the BCT15 current detected by the monitor.
+
+        wake_threshold:(default:5.0): The alarm threshold of the CUSUM statistic of the monitor (see cmn_methods.CusumDetector).
+
+        wake_min_interval:(default:300.0): The minimum time in seconds between two wake-ups by the monitor.
+
+        wake_on_recovery:(default:False): Flag to subscribe to the source status and to the BCT15 current during the waits after 
+        a wrong source status or a low current, and to resume as soon as the condition clears (see recovery_monitor()).
+
+        recovery_debounce:(default:10.0): The time in seconds the condition must hold before the module resumes.
+
+        momentum:(default:False): Flag for the momentum mode of the iterations: The Start measurement is reused from the previous 
+        iteration when it is fresh (see fresh_measurement()), the first probe is in the direction of the last move of the HT 
+        voltage and the opposite probe is skipped when the first one improves the current. After a warm start (see surrogate), 
+        the Start measurement is never reused: It is measured at the new HT voltage.
+
+        momentum_freshness:(default:60.0): The maximum age in seconds of a reused BCT15 measurement.
+
+        momentum_drift:(default:0.05): The maximum relative difference between the initial BCT15 shot of the iteration and the 
+        reused measurement.
+
+        trace_file:(default:None): The trace file of the spans of the module (Chrome trace JSON for a '.json' file, otherwise 
+        collapsed stacks for flamegraphs), see ghost_trace.Tracer. None: no tracing (unless GHOST_TRACE is set).
+
+        profile_iterations:(default:None): The window (first, last) of iterations profiled with cProfile when tracing.
+
+        status_port:(default:None): The port of the local HTTP status endpoint of the module (0: a free port), see 
+        ghost_status.StatusServer. None: no endpoint (unless GHOST_STATUS_PORT is set).
+
+        japc_rates:(default:None): The rate and burst of the JAPC requests of each device (dictionary: device -> (rate, burst))
+        or a JSON file of them, see ghost_ratelimit.JAPCLimiter. None: no rate limit (unless GHOST_JAPC_RATES is set).
         
         
         
@@ -73,6 +190,97 @@ class HTadjust(object):
         self.log_me=log_me
 
         self.dir_logging=dir_logging
+
+        self.japc_record=japc_record
+
+        self.japc_replay=japc_replay
+
+        self.clock=clock
+
+        self.log_structured=log_structured
+
+        self.BCT15_estimator=BCT15_estimator
+
+        self.BCT15_reject_cut=BCT15_reject_cut
+
+        self.BCT15_max_reject=BCT15_max_reject
+
+        self.BCT15_pool_rounds=BCT15_pool_rounds
+
+        self.BCT15_max_rounds=BCT15_max_rounds
+
+        self.BCT15_round_shots=BCT15_round_shots
+
+        self.BCT15_settle_time=BCT15_settle_time
+
+        self.BCT15_settle_shots=BCT15_settle_shots
+
+        self.BCT15_settle_tol=BCT15_settle_tol
+
+        self.BCT15_persistent=BCT15_persistent
+
+        self.tracking=tracking
+
+        self.dither_amplitude=dither_amplitude
+
+        self.dither_shots=dither_shots
+
+        self.tracking_bandwidth=tracking_bandwidth
+
+        self.tracking_gain=tracking_gain
+
+        self.surrogate=surrogate
+
+        self.surrogate_file=surrogate_file if surrogate_file is not None else dir_logging+'HTadjust_surrogate.json'
+
+        self.surrogate_history=surrogate_history
+
+        self.surrogate_half_life=surrogate_half_life
+
+        self.surrogate_timber=surrogate_timber
+
+        self.model=None # The surrogate model, loaded on the first warm start.
+
+        self.adaptive_schedule=adaptive_schedule
+
+        self.schedule_factor=schedule_factor
+
+        self.schedule_min=schedule_min
+
+        self.schedule_max=schedule_max
+
+        self.scheduler=None # The IterationScheduler, created on the first adaptive wait.
+
+        self.wake_on_drop=wake_on_drop
+
+        self.wake_drop=wake_drop
+
+        self.wake_threshold=wake_threshold
+
+        self.wake_min_interval=wake_min_interval
+
+        self.last_wake=-np.inf # Time of the last wake-up by the monitor, for the rate limit.
+
+        self.wake_on_recovery=wake_on_recovery
+
+        self.recovery_debounce=recovery_debounce
+
+        self.momentum=momentum
+
+        self.momentum_freshness=momentum_freshness
+
+        self.momentum_drift=momentum_drift
+
+        self.last_point=None # HT voltage, BCT15 current and time of the result of the last iteration (momentum mode).
+
+        self.last_direction=1 # Direction of the last move of the HT voltage (momentum mode).
+
+        self.trace_file=trace_file
+
+        self.profile_iterations=profile_iterations
+
+        self.status_port=status_port
+        self.japc_rates=japc_rates
         
         self.__author__='P. Zisopoulos (pzisopou@cern.ch)'
         
@@ -85,57 +293,105 @@ class HTadjust(object):
         
 
 
-    def HT_Current_Measurements(self,inside_range_flag,shot_number):
+    def HT_Current_Measurements(self,inside_range_flag,shot_number,not_before=None):
         
         """
         Method of HTadjust class:
 
-            Perform BCT15 current measurements for a maximum of two rounds.
+            Perform BCT15 current measurements for a maximum of BCT15_max_rounds rounds (default two).
+
+            If the measurements are affected by noise, repeat for another round. If the last round is not successful exit the program.
 
-            If the measurements are affected by noise, repeat for a second round. If second round is not successful exit the program.
+            With BCT15_pool_rounds, each new round is pooled with the previous ones (see GHOST.pool_shot_statistics()) and the
+            measurement stops as soon as the pooled estimate is stable.
+
+            Each round measures only the shots after the last shot of the previous round (see GHOST.take_shots()), so that
+            two rounds never share a BCT15 cycle.
 
                 Input:
 
-                shot_number: The number of shots for the BCT15 measurements.
+                shot_number: The number of shots for the BCT15 measurements (of each round, unless BCT15_round_shots is given).
+
+                not_before: The time of the SET of the HT voltage (see GHOST.last_set_time). Only the shots of the later cycles
+                (after BCT15_settle_time and the settle detector) are measured. None: All the shots after the first update.
 
 
                 Output:
 
-                BCT15: Dictionary with key values "Mean", "Sigma" and "Values" for the BCT15 measurements
+                BCT15: Dictionary with key values "Mean", "Sigma", "Values" and "Rejected" (number of outlier shots) for the BCT15 
+                measurements (see GHOST.shot_statistics() and the BCT15_estimator option).
 
                 status: A logical flag to notify the main routine of the unstable conditions in the BCT15 measurements.
         """
 
         status=1 
 
-        for round_ in ['First','Second']:
+        round_shots=shot_number if (self.BCT15_round_shots is None or not self.BCT15_pool_rounds) else self.BCT15_round_shots
+
+        rounds=[] # Statistics of the measured rounds, for the pooling.
+
+        last,stamps=None,[] # Last shot (sequence number) and cycle stamps of the previous round.
+
+        for ind,round_ in enumerate(self.round_names(self.BCT15_max_rounds)):
 
             msg=round_+' round of BCT15 measurements'
             myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
             
             if inside_range_flag:
 
-                BCT15=myGT.get_my_JAPC_parameter(device="ITF.BCT15",field='Acquisition',
-                                                         parameter='currentLinacSingle',
-                                                         my_selector=self.BCT15_selector,
-                                                         no_shots=shot_number)
-                my_condition=BCT15['Sigma']>0.1*BCT15['Mean']
+                BCT15=self.measure_BCT15(no_shots=round_shots,not_before=not_before,after=last)
+
+                shared=set(stamps)&set(stamp for stamp in BCT15.get('Stamps',[]) if np.isfinite(stamp))
+
+                if shared:
+
+                    msg='The {0} round of BCT15 measurements shares {1} cycles with the previous round: Shots dropped.'.format(
+                        round_,len(shared))
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='warning',event='BCT15_shared',
+                        values={'Shared':len(shared)})
+
+                    keep=[k for k,stamp in enumerate(BCT15['Stamps']) if stamp not in shared]
+
+                    BCT15=dict(BCT15,Values=[BCT15['Values'][k] for k in keep],Stamps=[BCT15['Stamps'][k] for k in keep])
+
+                last,stamps=BCT15.get('Last'),[stamp for stamp in BCT15.get('Stamps',[]) if np.isfinite(stamp)]
+
+                BCT15=myGT.shot_statistics(BCT15['Values'],estimator=self.BCT15_estimator,
+                                           reject_cut=self.BCT15_reject_cut,max_reject=self.BCT15_max_reject)
+
+                if BCT15['Rejected']:
+                    msg='{0} of {1} BCT15 shots rejected as outliers.'.format(BCT15['Rejected'],round_shots)
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='BCT15_rejected',
+                        values={'Rejected':BCT15['Rejected'],'Shots':round_shots})
+
+                if self.BCT15_pool_rounds:
+
+                    rounds.append(BCT15)
+
+                    BCT15=myGT.pool_shot_statistics(rounds,ref_shots=shot_number)
+
+                    msg=('Pooled BCT15 measurements of {0} rounds: Mean-> {1}, Sigma-> {2} '+
+                        '(equivalent for {3} shots).').format(len(rounds),"%.3f"%BCT15['Mean'],"%.3f"%BCT15['Sigma'],shot_number)
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='BCT15_pooled',
+                        values={'Rounds':len(rounds),'Mean':BCT15['Mean'],'Sigma':BCT15['Sigma']})
+
+                my_condition=not BCT15['Sigma']<=0.1*BCT15['Mean'] # Also unstable for a nan mean or an inf sigma.
                 
             else:
                 
-                BCT15={'Values':np.zeros(shot_number),'Mean':np.zeros(1),'Sigma':np.zeros(1)}
+                BCT15={'Values':np.zeros(shot_number),'Mean':0.0,'Sigma':0.0,'Rejected':0} # No SET: no measurement.
                 
                 my_condition=False
 
            
 
-            if my_condition and round_=='First':
+            if my_condition and ind<self.BCT15_max_rounds-1:
 
-                msg='First round: Unstable conditions in the BCT15 measurements.'
+                msg=round_+' round: Unstable conditions in the BCT15 measurements.'
                 myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
-            elif my_condition and round_=='Second':
-                msg='Second round: Unstable conditions in the BCT15 measurements.'
+            elif my_condition:
+                msg=round_+' round: Unstable conditions in the BCT15 measurements.'
                 myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
                 msg='Not possible to adjust the HT voltage. Setting the HT voltage to the initial value.'
@@ -152,6 +408,52 @@ class HTadjust(object):
         return status,BCT15
 
 
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def measure_BCT15(self,no_shots,not_before=None,verbose=True,after=None):
+        """
+        Method of HTadjust class:
+
+            Measure no_shots shots of the BCT15 current, from the long-lived subscription of the iteration (BCT15_persistent)
+            or with a new subscription. With not_before (time of the SET of the HT voltage), only the shots of the later cycles are
+            measured, after BCT15_settle_time and the settle detector. With after (the 'Last' of the previous measurement of the
+            long-lived subscription), only the later shots are measured.
+
+            Output: The dictionary of GHOST.get_my_JAPC_parameter() (of GHOST.take_shots() with BCT15_persistent).
+        """
+
+        settle={}
+
+        if not_before is not None:
+            settle=dict(not_before=not_before,settle_time=self.BCT15_settle_time,settle_shots=self.BCT15_settle_shots,
+                        settle_tol=self.BCT15_settle_tol)
+
+        if self.BCT15_persistent:
+
+            my_constructor=myGT.start_buffered_subscription(device="ITF.BCT15",field='Acquisition',
+                parameter='currentLinacSingle',my_selector=self.BCT15_selector)
+
+            return myGT.take_shots(my_constructor,no_shots=no_shots,verbose=verbose,after=after,**settle)
+
+        return myGT.get_my_JAPC_parameter(device="ITF.BCT15",field='Acquisition',parameter='currentLinacSingle',
+            my_selector=self.BCT15_selector,no_shots=no_shots,verbose=verbose,**settle)
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    @staticmethod
+    def round_names(max_rounds):
+        """
+        The names of the measurement rounds for the log ('First', 'Second', ...).
+        """
+
+        names=['First','Second','Third','Fourth','Fifth']
+
+        return [names[k] if k<len(names) else 'Round {}'.format(k+1) for k in range(max_rounds)]
+
+
 # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
 
 
@@ -228,6 +530,446 @@ class HTadjust(object):
         return HT_new, BCT15_new
 
 
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def refit_surrogate(self,HT_now):
+        """
+        Method of HTadjust class:
+
+            Load the surrogate model (a new one around HT_now if there is no state file) and add the Timber history of the HT 
+            voltage and of the BCT15 current since its last refit (at most surrogate_history hours), in one-minute bins. 
+            The model is then saved.
+        """
+
+        if self.model is None:
+
+            self.model=QuadraticSurrogate.load(self.surrogate_file)
+
+            if self.model is None:
+                self.model=QuadraticSurrogate(HT_ref=HT_now,half_life=self.surrogate_half_life*3600)
+
+        bin_size=60.0
+
+        t_end=np.floor(myGT.clock.time()/bin_size)*bin_size # Only complete bins, the next refit starts from here.
+        t_start=t_end-self.surrogate_history*3600
+
+        if self.model.last_history is not None:
+            t_start=max(t_start,self.model.last_history)
+
+        try:
+
+            HT_times,HT_values=myGT.get_timber_series(self.surrogate_timber[0],t_start,t_end)
+            BCT15_times,BCT15_values=myGT.get_timber_series(self.surrogate_timber[1],t_start,t_end)
+
+        except Exception as e:
+
+            msg='Timber history not available for the surrogate model: {}'.format(e)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='warning')
+
+            return
+
+        times,HT_values,BCT15_values=align_history(HT_times,HT_values,BCT15_times,BCT15_values,bin_size=bin_size)
+
+        for stamp,HT,current in zip(times,HT_values,BCT15_values):
+            self.model.update(HT,current,stamp)
+
+        self.model.last_history=t_end
+
+        self.model.save(self.surrogate_file)
+
+        msg='Surrogate model refit with {0} Timber samples ({1} samples in total).'.format(len(times),self.model.samples)
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def warm_start(self,HT_start,HTadjust_vrange):
+        """
+        Method of HTadjust class:
+
+            Warm start of an iteration after the start of the module or an interruption (source status, low current, inhibit).
+            The surrogate model is refit with the new Timber history and proposes the first candidate HT voltage (its optimum,
+            within the safe limits) and the step of the iteration (between HTadjust_vrange/4 and HTadjust_vrange). 
+
+            Output: The HT voltage and the step of the iteration (HT_start and HTadjust_vrange if the model is not trusted yet).
+        """
+
+        self.refit_surrogate(HT_start)
+
+        HT_candidate,step=self.model.propose(HT_start,safe_volt_low,safe_volt_high,HTadjust_vrange)
+
+        if HT_candidate is None:
+
+            msg='Surrogate model not trusted yet ({} samples). Cold start of the iteration.'.format(self.model.samples)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+            return HT_start,HTadjust_vrange
+
+        HT_candidate=round(HT_candidate,2)
+        step=round(step,2)
+
+        msg=('Warm start from the surrogate model: HT voltage {0}-->{1} V, step {2} V ({3} samples).').format(
+            HT_start,HT_candidate,step,self.model.samples)
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='surrogate_warm_start',
+            values={'HT_start':HT_start,'HT_candidate':HT_candidate,'Step':step})
+
+        return HT_candidate,step
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def schedule_bounds(self,HTadjust_interval):
+        """
+        Method of HTadjust class:
+
+            The bounds in seconds of the adaptive wait. The minimum is the FESA limit HTadjust_intervall_min (minutes), or 
+            schedule_min. The maximum is the FESA limit HTadjust_intervall_max (minutes), capped at schedule_max (default: 4 
+            times HTadjust_intervall), so that the backoff never reaches the hours allowed by the FESA limit.
+        """
+
+        low,high=myGT.FESA_param_limits('intervall')
+
+        min_wait=self.schedule_min if not low else low*60
+
+        max_wait=self.schedule_max if self.schedule_max is not None else 4*HTadjust_interval*60
+
+        if high:
+            max_wait=min(max_wait,high*60)
+
+        return min_wait,max(max_wait,min_wait)
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def next_wait(self,HT_start,HT_new,HTadjust_interval):
+        """
+        Method of HTadjust class:
+
+            The adaptive wait in seconds before the next iteration, after a move of the HT voltage from HT_start to HT_new
+            (see cmn_methods.IterationScheduler).
+        """
+
+        min_wait,max_wait=self.schedule_bounds(HTadjust_interval)
+
+        if self.scheduler is None:
+            self.scheduler=IterationScheduler(base=HTadjust_interval*60,min_wait=min_wait,max_wait=max_wait,
+                                              factor=self.schedule_factor)
+        else:
+            self.scheduler.set_bounds(min_wait,max_wait)
+
+        wait=self.scheduler.next_wait(HT_new-HT_start)
+
+        msg='Adaptive schedule: next iteration in {0} seconds (cruise interval {1} seconds).'.format(
+            "%.0f"%wait,"%.0f"%self.scheduler.cruise)
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='schedule',
+            values={'Wait':wait,'Cruise':self.scheduler.cruise})
+
+        return wait
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def current_monitor(self):
+        """
+        Method of HTadjust class:
+
+            Start the monitor of the BCT15 current for the wait after an iteration (option wake_on_drop).
+
+            The shots of the long-lived BCT15 subscription during the wait feed a CUSUM detector (see cmn_methods.CusumDetector),
+            whose reference is the current at the beginning of the wait. A sustained drop of wake_drop (relative) cuts the wait 
+            short, at most once every wake_min_interval seconds (a later alarm waits for the end of the rate limit).
+
+            Output: The wake_on function of GHOST.wait_time_interval() (None without the option).
+        """
+
+        if not self.wake_on_drop:
+            return None
+
+        my_constructor=myGT.start_buffered_subscription(device="ITF.BCT15",field='Acquisition',
+            parameter='currentLinacSingle',my_selector=self.BCT15_selector)
+
+        buffer_=myGT.shot_buffers[my_constructor]
+
+        detector=CusumDetector(drop=self.wake_drop,threshold=self.wake_threshold)
+
+        position=[buffer_.newer(0)[1]] # Only the shots of the wait.
+
+        def current_drop():
+
+            values,position[0]=buffer_.newer(position[0])
+
+            if not detector.update(values):
+                return None
+
+            if myGT.clock.time()-self.last_wake<self.wake_min_interval:
+                return None # Rate limit: The alarm stays raised until the next check.
+
+            self.last_wake=myGT.clock.time()
+
+            return 'BCT15 current dropped from {0} mA to {1} mA (CUSUM {2})'.format(
+                "%.3f"%detector.reference,"%.3f"%detector.last,"%.1f"%detector.statistic)
+
+        return current_drop
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def recovery_monitor(self,gate):
+        """
+        Method of HTadjust class:
+
+            Start the monitor of the wait after a failed gate of the iteration (option wake_on_recovery): 'status' subscribes to 
+            the status of the source (resume when it is ON, code 2) and 'current' to the BCT15 current (resume when it is above
+            the threshold of 0.01 mA). The condition must hold for recovery_debounce seconds (see cmn_methods.RecoveryMonitor).
+
+            The subscription is stopped with the other long-lived subscriptions after the wait.
+
+            Output: The wake_on function of GHOST.wait_time_interval() (None without the option).
+        """
+
+        if not self.wake_on_recovery:
+            return None
+
+        if gate=='status':
+
+            my_constructor=myGT.start_buffered_subscription(device='IP.NSRCGEN',field='Status',
+                parameter='sourceHTStatus',my_selector=None,size=64,convert=lambda status:status[0])
+
+            condition=lambda code:code==2
+            reason='The status of the source is ON again'
+
+        else:
+
+            my_constructor=myGT.start_buffered_subscription(device="ITF.BCT15",field='Acquisition',
+                parameter='currentLinacSingle',my_selector=self.BCT15_selector)
+
+            condition=lambda current:current>=0.01
+            reason='The BCT15 current is above threshold (0.01 mA) again'
+
+        return RecoveryMonitor(myGT.shot_buffers[my_constructor],condition,self.recovery_debounce,myGT.clock,
+                               reason+' for {} seconds'.format(self.recovery_debounce))
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def fresh_measurement(self,HT_start,Init_BCT):
+        """
+        Method of HTadjust class:
+
+            The result of the last iteration can replace the Start measurement (momentum mode) if the HT voltage did not change 
+            since, it is not older than momentum_freshness seconds and the initial BCT15 shot of this iteration (Init_BCT) is within 
+            momentum_drift (relative) of it.
+
+            Output: The result of the last iteration (dictionary with keys 'HT', 'Current' and 'Time') or None.
+        """
+
+        point=self.last_point
+
+        if point is None or not HT_start==point['HT']:
+            return None
+
+        if myGT.clock.time()-point['Time']>self.momentum_freshness:
+            return None
+
+        if not abs(Init_BCT-point['Current'])<=self.momentum_drift*abs(point['Current']):
+            return None
+
+        return point
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def run_tracking(self):
+        """
+        Method of HTadjust class:
+
+            Main loop of the continuous tracking mode (option tracking), instead of the iterations of run().
+
+            When the flags, the source status and the BCT15 current allow it, the HT voltage is tracked with track_HT() until
+            one of the conditions fails. The module then waits for HTadjust_interval minutes and checks the conditions again.
+        """
+
+        while True:
+
+            HTadjust_interval=myGT.get_FESA_param('intervall')
+
+            msg='HTadjust_interval is {} minutes'.format(HTadjust_interval)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='iteration_start',
+                values={'Interval':HTadjust_interval})
+
+            myGT.my_stopper(flag='initial',set_init=False) # Check kill flag
+
+            reason=self.tracking_conditions()
+
+            if reason is None:
+
+                reason=self.track_HT()
+
+            msg='HT tracking stopped: {0}. Waiting for {1} minutes.'.format(reason,HTadjust_interval)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='tracking_stop')
+
+            myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False)
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def tracking_conditions(self):
+        """
+        Method of HTadjust class:
+
+            Check the inhibit and test flags and the status of the source for the tracking mode.
+
+            Output: None if the tracking can go on, otherwise the reason (string) to stop it.
+        """
+
+        if myGT.get_FESA_param('inhibit'):
+            return 'Inhibit flag raised by the user'
+
+        if myGT.get_FESA_param('test'):
+            return 'The tracking needs SET operations (HTadjust_test=True)'
+
+        myGT.japc.setSelector(None)
+
+        HT_status=myGT.fec_call(myGT.japc.getParam,'IP.NSRCGEN/Status#sourceHTStatus',
+            description='GET IP.NSRCGEN/Status#sourceHTStatus')
+
+        if not HT_status[0]==2:
+            return 'The status of the source is {}'.format(HT_status[1])
+
+        return None
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def track_HT(self):
+        """
+        Method of HTadjust class:
+
+            Continuous dither/lock-in tracking of the optimum HT voltage.
+
+            The HT voltage is dithered with a square wave of amplitude dither_amplitude around its center: Each period sets
+            center+amplitude and center-amplitude (alternating order, which cancels a linear drift of the current) and measures 
+            dither_shots BCT15 shots after each SET (persistent subscription, only shots after the SET and BCT15_settle_time).
+
+            The demodulated signal r=(I+ - I-)/(I+ + I-) is low-pass filtered with the cut-off frequency tracking_bandwidth (Hz),
+            and the center moves by tracking_gain*dither_amplitude*r_filtered per period (at most dither_amplitude), keeping the 
+            dither within the safe limits of the HT voltage.
+
+            The kill flag, the tracking conditions (see tracking_conditions()) and the current threshold are checked on every period.
+            The HT voltage is set back to the center when the tracking stops, also on a kill. The tracking does not start when the 
+            safe limits are narrower than the dither, and it stops (the period is rolled back) when a dither SET is refused.
+
+            Output: The reason (string) for the end of the tracking.
+        """
+
+        amplitude=self.dither_amplitude
+
+        if amplitude is None:
+            amplitude=myGT.get_FESA_param('Vrange')/2.0
+
+        HT_center=myGT.get_my_JAPC_parameter(device="IP.NSRCGEN",
+            field="Setting",parameter='sourceHT',my_selector=None,subscribe_=0,no_shots=1)['Mean']
+
+        msg=('Starting the HT tracking around {0} V: Dither +/- {1} V, {2} shots per half period, ' +
+            'bandwidth {3} Hz.').format(HT_center,amplitude,self.dither_shots,self.tracking_bandwidth)
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='tracking_start',
+            values={'HT':HT_center,'Amplitude':amplitude})
+
+        r_filtered=0.0
+
+        period=0
+
+        if safe_volt_high-safe_volt_low<2*amplitude:
+
+            return 'The safe limits [{0},{1}] V are narrower than the dither +/- {2} V'.format(safe_volt_low,safe_volt_high,
+                amplitude)
+
+        while True:
+
+            # The dither stays within the safe limits.
+            HT_center=min(max(HT_center,safe_volt_low+amplitude),safe_volt_high-amplitude)
+
+            # A kill leaves the HT voltage at the center of the dither.
+            myGT.my_stopper(flag='',set_init=True,device='IP.NSRCGEN',field='Setting',parameter='sourceHT',
+                val_to_set=HT_center,lim_l=safe_volt_low,lim_r=safe_volt_high)
+
+            reason=self.tracking_conditions() if period else None
+
+            if reason is not None:
+                break
+
+            t_period=myGT.clock.monotonic()
+
+            signs=(1,-1) if period%2==0 else (-1,1)
+
+            currents={}
+
+            myGT.begin_iteration()
+
+            for sign in signs:
+
+                if not myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',field='Setting',parameter='sourceHT',
+                    my_selector=self.sourceHT_selector,val_to_set=HT_center+sign*amplitude,
+                    lim_l=safe_volt_low,lim_r=safe_volt_high):
+
+                    reason='SET of the dither point {} V refused by the safe limits'.format(HT_center+sign*amplitude)
+                    break
+
+                BCT15=self.measure_BCT15(no_shots=self.dither_shots,not_before=myGT.last_set_time,verbose=False)
+
+                currents[sign]=myGT.shot_statistics(BCT15['Values'],estimator=self.BCT15_estimator,
+                    reject_cut=self.BCT15_reject_cut,max_reject=self.BCT15_max_reject)['Mean']
+
+            if reason is not None:
+
+                myGT.rollback_iteration(reason=reason+'.')
+
+                break
+
+            myGT.commit_iteration()
+
+            I_mean=(currents[1]+currents[-1])/2.0
+
+            if not I_mean>=0.01:
+                reason='BCT15 current {} mA below threshold (0.01 mA)'.format("%.3f"%I_mean)
+                break
+
+            r=(currents[1]-currents[-1])/(2.0*I_mean)
+
+            duration=myGT.clock.monotonic()-t_period
+
+            r_filtered+=(1.0-np.exp(-2.0*np.pi*self.tracking_bandwidth*duration))*(r-r_filtered)
+
+            step=float(np.clip(self.tracking_gain*amplitude*r_filtered,-amplitude,amplitude))
+
+            msg=('HT tracking: Center {0} V, BCT15 I+ {1} mA, I- {2} mA, demodulated {3}, filtered {4}, step {5} V.').format(
+                "%.3f"%HT_center,"%.3f"%currents[1],"%.3f"%currents[-1],"%.4f"%r,"%.4f"%r_filtered,"%.3f"%step)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='tracking',
+                values={'HT':HT_center,'I_plus':currents[1],'I_minus':currents[-1],'Demodulated':r,'Filtered':r_filtered,
+                        'Step':step})
+
+            HT_center+=step
+
+            period+=1
+
+        myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',field='Setting',parameter='sourceHT',
+            my_selector=self.sourceHT_selector,val_to_set=HT_center,lim_l=safe_volt_low,lim_r=safe_volt_high)
+
+        myGT.stop_buffered_subscription()
+
+        return reason
+
+
 
 # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
 
@@ -280,6 +1022,10 @@ class HTadjust(object):
                         If the measurement conditions are not ideal (i.e. there is noise in the measurements) the program will halt and restart.voltage
 
                         In addition, the program is externally controlled with the HTadjust_kill and HTadjust_inhibit variables in FESA.
+
+                        With the surrogate option, the first iteration after the start or an interruption begins from the optimum 
+                        proposed by the surrogate model (see warm_start()), which learns from the measurements of every iteration.
+                        The surrogate model is not used in replay mode (the Timber history is not part of the JAPC trace).
                         
                     }
                 
@@ -304,7 +1050,11 @@ class HTadjust(object):
             FESA_GHOST_Property=self.FESA_GHOST_Property,simulate_SET=self.simulate_SET,
             INCA_ACCEL='LEIR',japc_selector=self.sourceHT_selector,
             which_ebook=self.which_ebook,no_elog_write=self.no_elog_write,
-            log_me=self.log_me,log_level=self.log_level,dir_logging=self.dir_logging)
+            log_me=self.log_me,log_level=self.log_level,dir_logging=self.dir_logging,
+            schema_properties=['IP.NSRCGEN/Setting'],japc_record=self.japc_record,japc_replay=self.japc_replay,
+            clock=self.clock,log_structured=self.log_structured,trace_file=self.trace_file,
+            profile_iterations=self.profile_iterations,status_port=self.status_port,
+            japc_rates=self.japc_rates)
 
         
 
@@ -316,233 +1066,366 @@ class HTadjust(object):
         print('Second lim')
         safe_volt_high=myGT.get_FESA_param('HTUpperLimit')
         
+        restart=True # The first iteration after the start or an interruption can be warm started.
+
         #Infinite loop module !
-        while True:
+        try:
 
+            if self.tracking:
+                self.run_tracking() # Continuous tracking instead of the iterations, until a kill.
 
-            HTadjust_interval=myGT.get_FESA_param('intervall') # Get HTadjust_interval
+            while True:
 
-            msg='HTadjust_interval is {} minutes'.format(HTadjust_interval)
-            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                myGT.begin_iteration() # Every SET of this iteration is journaled and can be rolled back.
 
+                myGT.trace_mark('checks') # Phases of the iteration in the trace (see GHOST.trace_mark()).
 
-            myGT.my_stopper(flag='initial',set_init=False) # Check kill flag
+                HTadjust_interval=myGT.get_FESA_param('intervall') # Get HTadjust_interval
 
-            HTadjust_inhibit=myGT.get_FESA_param('inhibit')
+                msg='HTadjust_interval is {} minutes'.format(HTadjust_interval)
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='iteration_start',
+                    values={'Interval':HTadjust_interval})
 
-            msg='HTadjust_inhbit is: '+str(HTadjust_inhibit)+'.'
-            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                myGT.my_stopper(flag='initial',set_init=False) # Check kill flag
+
+                HTadjust_inhibit=myGT.get_FESA_param('inhibit')
+
+                msg='HTadjust_inhbit is: '+str(HTadjust_inhibit)+'.'
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
             
-            HTadjust_test=myGT.get_FESA_param('test')
+                HTadjust_test=myGT.get_FESA_param('test')
 
-            msg='HTadjust_test is: '+str(HTadjust_test)+'.'
-            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                msg='HTadjust_test is: '+str(HTadjust_test)+'.'
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
             
-            #Check inhbit flag !
-            if not HTadjust_inhibit:
+                #Check inhbit flag !
+                if not HTadjust_inhibit:
 
-                #Check the status of the HT source before performing and adjustments ! 
-                myGT.japc.setSelector(None)
+                    #Check the status of the HT source before performing and adjustments ! 
+                    myGT.japc.setSelector(None)
 
-                HT_status=myGT.japc.getParam('IP.NSRCGEN/Status#sourceHTStatus')
+                    HT_status=myGT.fec_call(myGT.japc.getParam,'IP.NSRCGEN/Status#sourceHTStatus',
+                        description='GET IP.NSRCGEN/Status#sourceHTStatus')
 
-                if not HT_status[0]==2:
+                    if not HT_status[0]==2:
                     
-                    msg=('The status of the source is {0}. ' + 
-                        'Waiting for {1} minutes.').format(HT_status[1],HTadjust_interval)
+                        msg=('The status of the source is {0}. ' + 
+                            'Waiting for {1} minutes.').format(HT_status[1],HTadjust_interval)
 
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_source_status')
 
-                    myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False)
+                        restart=True
+
+                        myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False,
+                            wake_on=self.recovery_monitor('status'))
+
+                        myGT.stop_buffered_subscription()
                     
-                    continue
+                        continue
                 
-                else:
-                    msg=('The status of the source is {}. ' + 
-                        'Proceeding with HTadjust operations.').format(HT_status[1])
+                    else:
+                        msg=('The status of the source is {}. ' + 
+                            'Proceeding with HTadjust operations.').format(HT_status[1])
 
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    pass
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        pass
 
-                # Begin main sequence.
+                    # Begin main sequence.
  
 
-                HTadjust_vrange=myGT.get_FESA_param('Vrange')
+                    myGT.trace_mark('initial')
 
-                msg='The HT voltage will be adjusted within a +/- '+str(HTadjust_vrange)+' V range.'
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    HTadjust_vrange=myGT.get_FESA_param('Vrange')
 
-                msg='Acquiring source HT voltage.'
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    msg='The HT voltage will be adjusted within a +/- '+str(HTadjust_vrange)+' V range.'
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
-                HT_start=myGT.get_my_JAPC_parameter(device="IP.NSRCGEN",
-                    field="Setting",parameter='sourceHT',my_selector=None,subscribe_=0,no_shots=1)['Mean']
+                    msg='Acquiring source HT voltage.'
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
-                msg='The source HT voltage is '+str(HT_start)+' V.'
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    HT_start=myGT.get_my_JAPC_parameter(device="IP.NSRCGEN",
+                        field="Setting",parameter='sourceHT',my_selector=None,subscribe_=0,no_shots=1)['Mean']
 
+                    msg='The source HT voltage is '+str(HT_start)+' V.'
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='HT_start',values={'HT':HT_start})
 
-                #Do a first current measurement and examine if it is above or below the threshold
 
-                Init_BCT=myGT.get_my_JAPC_parameter(device="ITF.BCT15",
-                    field='Acquisition',parameter='currentLinacSingle',
-                    my_selector=self.BCT15_selector,no_shots=1,subscribe_=1,verbose=False)['Mean']
+                    #Do a first current measurement and examine if it is above or below the threshold
 
-                msg='Initial ion beam current measurement is {}'.format("%.3f"%Init_BCT)
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    Init_BCT=self.measure_BCT15(no_shots=1,verbose=False)['Mean'] # Starts the subscription of the iteration.
 
-                # Is the current enough? Decide whether to proceed or not.
-                if Init_BCT<0.01:
-                    msg=('The measurement of the BCT15 current is below threshold (0.01 mA).' + 
-                        ' Waiting for {} minutes and restarting.').format(HTadjust_interval)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    msg='Initial ion beam current measurement is {}'.format("%.3f"%Init_BCT)
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='BCT15_initial',values={'Current':Init_BCT})
+
+                    # Is the current enough? Decide whether to proceed or not.
+                    if Init_BCT<0.01:
+                        msg=('The measurement of the BCT15 current is below threshold (0.01 mA).' + 
+                            ' Waiting for {} minutes and restarting.').format(HTadjust_interval)
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_low_current',
+                            values={'Current':Init_BCT})
+
+                        wake_on=self.recovery_monitor('current') # Reuses the BCT15 subscription of the iteration.
+
+                        if wake_on is None:
+                            myGT.stop_buffered_subscription() # No BCT15 subscription during the waits.
+
+                        restart=True
                     
-                    myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False)
+                        myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False,wake_on=wake_on)
+
+                        myGT.stop_buffered_subscription()
                     
-                    continue
+                        continue
 
-                else:
+                    else:
                     
-                    msg=('The measurement of the BCT15 current is above threshold (0.01 mA). ' + 
-                        'Proceeding with HTadjust operations.')
+                        msg=('The measurement of the BCT15 current is above threshold (0.01 mA). ' + 
+                            'Proceeding with HTadjust operations.')
                      
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    pass
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        pass
 
 
-                # Start measurements
+                    myGT.trace_mark('warm_start')
 
-                my_keys=['Start','Positive','Negative']
+                    step=HTadjust_vrange
 
-                k=0 # index for my_keys array
+                    HT_measured=HT_start # The HT voltage of Init_BCT
 
-                BCT15_all={} #initialize dictionary
+                    if self.surrogate and restart and not HTadjust_test and self.japc_replay is None:
+                        HT_start,step=self.warm_start(HT_start,HTadjust_vrange)
 
-                for dv in [0,HTadjust_vrange,-HTadjust_vrange]:
+                    restart=False
 
-                    myGT.my_stopper(flag='',set_init=True,
-                    device='IP.NSRCGEN',field='Setting',parameter='sourceHT',
-                    val_to_set=HT_start,lim_l=safe_volt_low,lim_r=safe_volt_high)
+                    # Start measurements
 
-                    msg='Initiating BCT15 measurements for DV = {} V.'.format(dv)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    my_keys={0:'Start',1:'Positive',-1:'Negative'}
+
+                    BCT15_all={key:-np.inf for key in my_keys.values()} # A skipped probe never wins in HT_Decider().
+
+                    BCT15_times={} # Time of each measurement
+
+                    BCT15_set={} # True for the probes measured at an HT voltage which was actually set (surrogate model)
+
+                    # Init_BCT tells about the reused measurement only if the warm start did not move the HT voltage.
+                    reused=self.fresh_measurement(HT_start,Init_BCT) \
+                        if self.momentum and not HTadjust_test and HT_start==HT_measured else None
 
+                    direction=self.last_direction if self.momentum else 1
 
-                    new_set_HTV=HT_start+dv
+                    HT_now=HT_measured # The HT voltage set now (HT_start is the candidate of a warm start)
 
-                    if not HTadjust_test:
+                    for dv in [0,direction*step,-direction*step]:
 
-                        msg='Setting the HT voltage to {} V.'.format(new_set_HTV)
+                        key=my_keys[int(np.sign(dv))]
 
+                        myGT.trace_mark('probe',DV=dv)
+
+                        myGT.my_stopper(flag='',set_init=False) # A kill rolls back the SETs of the iteration.
+
+                        if dv==0 and reused is not None:
+
+                            BCT15_all[key]=reused['Current']
+                            BCT15_times[key]=reused['Time']
+
+                            msg=('Reusing the BCT15 measurement of the previous iteration at {0} V: Mean-> {1} ' + 
+                                '(momentum mode).').format(HT_start,"%.3f"%reused['Current'])
+                            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='momentum_reuse',
+                                values={'HT':HT_start,'Mean':reused['Current'],'Age':myGT.clock.time()-reused['Time']})
+
+                            continue
+
+                        if self.momentum and dv==-direction*step and BCT15_all[my_keys[direction]]>BCT15_all['Start']:
+
+                            msg=('The probe at DV = {0} V improved the current. Skipping the probe at DV = {1} V ' + 
+                                '(momentum mode).').format(direction*step,dv)
+                            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='momentum_skip',
+                                values={'DV':dv})
+
+                            break
+
+                        msg='Initiating BCT15 measurements for DV = {} V.'.format(dv)
                         myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
-                        is_safe_to_set=myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',
-                                                   field='Setting',parameter='sourceHT',
-                                                   my_selector=self.sourceHT_selector,
-                                                   val_to_set=new_set_HTV,
-                                                   lim_l=safe_volt_low,lim_r=safe_volt_high)
+
+                        new_set_HTV=HT_start+dv
+
+                        if not HTadjust_test:
+
+                            msg='Setting the HT voltage to {} V.'.format(new_set_HTV)
+
+                            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                            is_safe_to_set=myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',
+                                                       field='Setting',parameter='sourceHT',
+                                                       my_selector=self.sourceHT_selector,
+                                                       val_to_set=new_set_HTV,
+                                                       lim_l=safe_volt_low,lim_r=safe_volt_high)
+
+                            if is_safe_to_set:
+                                HT_now=new_set_HTV # Not changed by a SET refused by the safe limits.
                     
-                    else:
+                        else:
 
-                        msg='This is a test. No SET operation on-going.'
-                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                            msg='This is a test. No SET operation on-going.'
+                            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
+                            is_safe_to_set=True # Measurement at the current HT voltage.
 
 
-                    status,BCT15=self.HT_Current_Measurements(is_safe_to_set,shot_number=10)
 
-                    msg=('Result of BCT15 measurements for adjustment DV = {0} V: ' + 
-                        'Mean-> {1}, Sigma-> {2}').format(dv,"%.3f"%BCT15['Mean'],"%.3f"%BCT15['Sigma'])
+                        # Only the shots after the new HT voltage took effect.
+                        not_before=myGT.last_set_time if not HTadjust_test else None
 
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        status,BCT15=self.HT_Current_Measurements(is_safe_to_set,shot_number=10,not_before=not_before)
+
+                        msg=('Result of BCT15 measurements for adjustment DV = {0} V: ' + 
+                            'Mean-> {1}, Sigma-> {2}, Rejected-> {3}').format(dv,"%.3f"%BCT15['Mean'],"%.3f"%BCT15['Sigma'],
+                            BCT15['Rejected'])
+
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='BCT15',
+                            values={'DV':dv,'Mean':BCT15['Mean'],'Sigma':BCT15['Sigma'],'Rejected':BCT15['Rejected']})
                     
-                    if not status:
+                        if not status:
 
-                        break
+                            break
 
 
-                    BCT15_all[my_keys[k]]=BCT15['Mean']
+                        BCT15_all[key]=BCT15['Mean']
 
-                    k+=1
+                        BCT15_times[key]=myGT.clock.time()
+
+                        BCT15_set[key]=is_safe_to_set and not HTadjust_test and not self.simulate_SET
 
                         
 
-                if not status:
+                    if not status:
 
-                    msg='Adjustments of the HT source are not possible due to unstable conditions.'
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        msg='Adjustments of the HT source are not possible due to unstable conditions.'
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_unstable')
 
-                    msg='Setting the HT source voltage to the initial value.'
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        msg='Setting the HT source voltage to the initial value.'
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                        myGT.rollback_iteration(reason='Unstable BCT15 measurements.')
 
-                    myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',field='Setting',my_selector=self.sourceHT_selector,
-                    parameter='sourceHT',val_to_set=HT_start,lim_l=safe_volt_low,lim_r=safe_volt_high)
+                        self.last_point=None
 
+                        myGT.stop_buffered_subscription()
 
-                    myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=True,
-                        device='IP.NSRCGEN',field='Setting',parameter='sourceHT',
-                        val_to_set=HT_start,lim_l=safe_volt_low,lim_r=safe_volt_high,user_time=0) 
+                        myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False,user_time=0) 
 
-                    continue # GOTO the beginning of the while loop
+                        continue # GOTO the beginning of the while loop
 
 
                 
 
-                #In this part we are looking for values in the pair (HT_new, BCT15_new)! :-)
+                    myGT.trace_mark('decide')
+
+                    if self.model is not None and not HTadjust_test:
+
+                        # Incremental refit of the surrogate model with the measurements of this iteration, only at the HT
+                        # voltages which were set (not the reused Start, nor the probes refused by the safe limits).
+                        for sign,key in my_keys.items():
+                            if BCT15_set.get(key):
+                                self.model.update(HT_start+sign*step,BCT15_all[key],BCT15_times[key])
+
+                        self.model.save(self.surrogate_file)
+
+                    #In this part we are looking for values in the pair (HT_new, BCT15_new)! :-)
                 
-                HT_new, BCT15_new=self.HT_Decider(BCT15_all,HT_start,HTadjust_vrange)
+                    HT_new, BCT15_new=self.HT_Decider(BCT15_all,HT_start,step)
                 
-                go_on=False # Variable for continuing the search for optimum settings !
+                    go_on=False # Variable for continuing the search for optimum settings !
+
+                    if self.momentum:
+
+                        key=my_keys[int(np.sign(HT_new-HT_start))]
+
+                        self.last_point={'HT':HT_new,'Current':BCT15_new,'Time':BCT15_times[key]}
+
+                        if not HT_new==HT_start:
+                            self.last_direction=int(np.sign(HT_new-HT_start))
 
-                if not HTadjust_test:
+                    if self.momentum and HT_now==HT_new:
+
+                        pass # The HT voltage is already at HT_new.
+
+                    elif not HTadjust_test:
 
                     
 
-                    myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',field='Setting',
-                     my_selector=self.sourceHT_selector,parameter='sourceHT',
-                     val_to_set=HT_new,lim_l=safe_volt_low,lim_r=safe_volt_high)
+                        myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',field='Setting',
+                         my_selector=self.sourceHT_selector,parameter='sourceHT',
+                         val_to_set=HT_new,lim_l=safe_volt_low,lim_r=safe_volt_high)
 
 
-                else:
+                    else:
 
-                    msg=('New values for the HT adjustment acquired but ' + 
-                    ' no SET operation is performed (HTadjust_test=True).')
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        msg=('New values for the HT adjustment acquired but ' + 
+                        ' no SET operation is performed (HTadjust_test=True).')
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
-                if not HT_start==HT_new:
-                    go_on=True # If a change was found, reduce the waiting time and iterate again.
-                    msg=('HT extracting voltage [V]: {0}-->{1}, '+
-                        'BCT15 I [mA]: {2}-->{3}').format(HT_start,HT_new,
-                        "%.3f"%BCT15_all['Start'],"%.3f"%BCT15_new)
-                    myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+                    myGT.commit_iteration() # HT_new is the new working point.
 
-                    msg=('Successful optimization of the transmitted ion current.'+
-                        ' Proceeding to next iteration as soon as possible.')
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    myGT.trace_mark('wait')
+
+                    wake_on=self.current_monitor() # The monitor keeps the BCT15 subscription during the wait.
+
+                    if wake_on is None:
+                        myGT.stop_buffered_subscription()
+
+                    if not HT_start==HT_new:
+                        go_on=True # If a change was found, reduce the waiting time and iterate again.
+                        msg=('HT extracting voltage [V]: {0}-->{1}, '+
+                            'BCT15 I [mA]: {2}-->{3}').format(HT_start,HT_new,
+                            "%.3f"%BCT15_all['Start'],"%.3f"%BCT15_new)
+                        myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='HT_change',
+                            values={'HT_start':HT_start,'HT_new':HT_new,'BCT15_start':BCT15_all['Start'],'BCT15_new':BCT15_new})
+
+                        msg=('Successful optimization of the transmitted ion current.'+
+                            ' Proceeding to next iteration as soon as possible.')
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
                     
                 
 
-                if go_on:
-                    sleep_ht=10 # user defined sleep of 10 seconds !
+                    if self.adaptive_schedule:
+                        sleep_ht=self.next_wait(HT_start,HT_new,HTadjust_interval)
+                    elif go_on:
+                        sleep_ht=10 # user defined sleep of 10 seconds !
+                    else:
+                        sleep_ht=0 # no-user defined sleep !
+
+                    myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False,user_time=sleep_ht,wake_on=wake_on)
+
+                    myGT.stop_buffered_subscription()
+
+                    continue  #GOTO initial while loop
+
                 else:
-                    sleep_ht=0 # no-user defined sleep !
 
-                myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False,user_time=sleep_ht)
+                # Wait for new input and restart
+                    msg=('Inhibition of module HTadjust: Inhibit flag raised by the user.' + 
+                        'The module will resume after change of the HTadjust_inhibit flag.')
 
-                continue  #GOTO initial while loop
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='inhibit') 
 
-            else:
+                    restart=True
+
+                    myGT.wait_time_interval(FESA_time=HTadjust_interval,set_init=False)
+                    # sleep(10) #wait 10 seconds before restarting.
+                    continue  #GOTO initial while loop
+
+        except Exception:
 
-            # Wait for new input and restart
-                msg=('Inhibition of module HTadjust: Inhibit flag raised by the user.' + 
-                    'The module will resume after change of the HTadjust_inhibit flag.')
+            # Restore the hardware state of the unfinished iteration before exiting.
+            myGT.rollback_iteration(reason='Exception in the HTadjust module.')
 
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info') 
+            myGT.stop_buffered_subscription()
 
-                self.wait_time_interval(FESA_time=HTadjust_interval,set_init=False)
-                # sleep(10) #wait 10 seconds before restarting.
-                continue  #GOTO initial while loop
+            raise
                 
 
 
@@ -5,7 +5,8 @@
 ssh -f ln3op@cwe-513-vol262 \
 "cd /user/ln3op/GHOST/HTadjust/src/ && source /acc"\
 "/local/share/python/L866/setup.sh && nohup python /user/ln3op/GHOST/"\
-"HTadjust/src/HTadjust.py > garbage.in 2> garbage.out < /dev/null &"
+"lib/ghost_watchdog.py --heartbeat HTadjust.heartbeat --log HTadjust_watchdog.log"\
+" -- python /user/ln3op/GHOST/HTadjust/src/HTadjust.py > garbage.in 2> garbage.out < /dev/null &"
 
 # Note the Line continuations before messing with the commands ;) 
 
@@ -22,7 +22,9 @@ class OvenRestart(object):
                  simulate_SET=True,INCA_ACCEL='LEIR',Oven_FESA_selector=None,
                  OvenResistance_selector='LEI.USER.ALL',OvenPower_wait=60,OvenIncrPower_wait=20,
                  Pressure_wait=5,Pressure_limit=1e-6,which_ebook='LINAC 3',
-                 no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging=''):
+                 no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging='',
+                 japc_record=None,japc_replay=None,clock=None,log_structured=False,trace_file=None,profile_iterations=None,
+                 status_port=None,japc_rates=None):
         """
         Initialisation of the OvenRestart module. The input parameters are:
         
@@ -57,6 +59,28 @@ class OvenRestart(object):
         log_level:(default:'DEBUG'): The level of logging for the local log system.
 
         dir_logging:(default:''): The directory for the saving of the local log files.
+
+        japc_record:(default:None): Trace file for recording the JAPC session (GET, SET and subscription callbacks).
+
+        japc_replay:(default:None): Trace file (or japc_trace.JAPCReplayer object) to replay instead of a live JAPC session.
+        See japc_trace.replay_module().
+
+        clock:(default:None): The clock of all the waits and time-stamps (cmn_methods.WallClock or VirtualClock). 
+        By default the real time is used (the clock of the trace in replay mode).
+
+        log_structured:(default:False): Flag to write also the structured (JSON lines) log, see ghost_logging.StructuredLogHandler.
+
+        trace_file:(default:None): The trace file of the spans of the module (Chrome trace JSON for a '.json' file, otherwise 
+        collapsed stacks for flamegraphs), see ghost_trace.Tracer. None: no tracing (unless GHOST_TRACE is set).
+
+        profile_iterations:(default:None): The profiling window of the module with cProfile when tracing: (0, 0) for the whole 
+        run of the module (single-passage module without iterations).
+
+        status_port:(default:None): The port of the local HTTP status endpoint of the module (0: a free port), see 
+        ghost_status.StatusServer. None: no endpoint (unless GHOST_STATUS_PORT is set).
+
+        japc_rates:(default:None): The rate and burst of the JAPC requests of each device (dictionary: device -> (rate, burst))
+        or a JSON file of them, see ghost_ratelimit.JAPCLimiter. None: no rate limit (unless GHOST_JAPC_RATES is set).
         
         
         
@@ -93,6 +117,21 @@ class OvenRestart(object):
         self.log_me=log_me
         
         self.dir_logging=dir_logging
+
+        self.japc_record=japc_record
+
+        self.japc_replay=japc_replay
+
+        self.clock=clock
+
+        self.log_structured=log_structured
+
+        self.trace_file=trace_file
+
+        self.profile_iterations=profile_iterations
+
+        self.status_port=status_port
+        self.japc_rates=japc_rates
         
         self.__author__='P. Zisopoulos (pzisopou@cern.ch)'
         
@@ -112,10 +151,10 @@ class OvenRestart(object):
 
         assert time_wait>0,"Please give a positive and finite waiting time."
 
-        P=myGT.japc.getParam('IP.VGP2/PR')
+        P=myGT.fec_call(myGT.japc.getParam,'IP.VGP2/PR',description='GET IP.VGP2/PR')
 
         msg='The pressure is {} mbar.'.format("%.2E"%P)
-        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='pressure',values={'Pressure':P})
 
         while P >= self.Pressure_limit:
 
@@ -128,7 +167,7 @@ class OvenRestart(object):
             # Wait for 5 minutes
             myGT.wait_time_interval(FESA_time=time_wait,set_init=False)
             # Re-check pressure
-            P=myGT.japc.getParam('IP.VGP2/PR')
+            P=myGT.fec_call(myGT.japc.getParam,'IP.VGP2/PR',description='GET IP.VGP2/PR')
     
     def which_combo(self):
         """
@@ -154,53 +193,24 @@ class OvenRestart(object):
         """
         Method to read the Power of the ovens.
 
+        Readings which are not finite are repeated with the retry policy of GHOST (see GHOST.fec_call()).
+
         """
 
         left,right,which_oven=self.which_combo()
 
         myGT.japc.setSelector(None)
 
-        
-
-        while True:
+        oven_power=myGT.fec_call(myGT.japc.getParam,['IP.NSRCGEN/Setting#oven1Power',
+            'IP.NSRCGEN/Setting#oven2Power'],description='reading of the oven power',deadline=None,
+            validate=lambda powpow: all(np.isfinite(powpow[left:right])))[left:right]
 
-            oven_power=myGT.japc.getParam(['IP.NSRCGEN/Setting#oven1Power',
-                'IP.NSRCGEN/Setting#oven2Power'])[left:right]
-            m=0
-
-            for powpow in oven_power:
-                
-                if np.isfinite(powpow):
-                
-                    msg='The power of oven {0} is measured to be {1} W.'.format(which_oven[m],"%.2f"%powpow)
-                    
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    
-                    m+=1
-                    
-                    rept=False
-                    
-                    continue
-                
-                else:
-                
-                    msg=('The power of oven {0} was not measured properly' + 
-                        ' (Value is : {1}). Repeating in one minute.').format(which_oven[m],powpow)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-
-                    sleep(60)
-
-                    rept=True
-                    
-                    break
-
-
-
-            if rept:
-                continue
-            else:
-                break
+        for m,powpow in enumerate(oven_power):
 
+            msg='The power of oven {0} is measured to be {1} W.'.format(which_oven[m],"%.2f"%powpow)
+            
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='oven_power',
+                values={'Oven':which_oven[m],'Power':powpow})
              
         return oven_power
 
@@ -209,65 +219,29 @@ class OvenRestart(object):
         Method to read the resistance of the ovens.
         Note the selector cannot be None otherwide JAPC complains for multiplexed parameter.
         Selector LEI.USER.ALL is mandatory so we need to subscribe.
-        
-        """
 
+        Readings which are not finite are repeated with the backoff and the deadline of the retry policy of GHOST (see
+        GHOST.fec_call()). The failures of the acquisition itself are already retried and counted for the circuit breaker by
+        get_my_JAPC_parameter(), so they do not count a second time.
         
+        """
 
-        while True:
-
-            if Oven_choice==1 or Oven_choice==2:
-
-                res=[myGT.get_my_JAPC_parameter(device='IP.NSRCGEN',field='Acquisition',
-                    parameter='oven'+str(Oven_choice)+'AqnR',my_selector='LEI.USER.ALL',no_shots=1,subscribe_=1,verbose=False)['Mean']]
-                which_oven=[Oven_choice]
-
-            elif Oven_choice==3:
-
-                res=[myGT.get_my_JAPC_parameter(device='IP.NSRCGEN',field='Acquisition',
-                    parameter='oven1AqnR',my_selector='LEI.USER.ALL',no_shots=1,subscribe_=1,verbose=False)['Mean'],
-                myGT.get_my_JAPC_parameter(device='IP.NSRCGEN',field='Acquisition',
-                    parameter='oven2AqnR',my_selector='LEI.USER.ALL',no_shots=1,subscribe_=1,verbose=False)['Mean']]
-                which_oven=[1,2]
-
-            
-            m=0
-            for r in res:
-                
-                if np.isfinite(r):
-
-                    msg=('The resistance of oven {0} is measured to be {1} Ohm.').format(which_oven[m],"%.2f"%r)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    
-                    m+=1
-                    
-                    rept=False
-                    
-                    continue
-
-
-                else:
-
-                    msg=('The resistance of oven {0} was not measured properly '+
-                    '(Value is : {1}). Repeating in one minute.').format(which_oven[m],r)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    
-                    sleep(60)
-                    
-                    rept=True
+        left,right,which_oven=self.which_combo()
 
-                    break
+        res=[]
 
-                
+        for ov in which_oven:
 
+            r=myGT.fec_call(myGT.get_my_JAPC_parameter,device='IP.NSRCGEN',field='Acquisition',
+                parameter='oven'+str(ov)+'AqnR',my_selector='LEI.USER.ALL',no_shots=1,subscribe_=1,verbose=False,
+                description='reading of the resistance of oven {}'.format(ov),breaker=False,
+                validate=lambda meas: np.isfinite(meas['Mean']))['Mean']
 
-            if rept:
-                continue
-            else:
-                break
-            
+            msg=('The resistance of oven {0} is measured to be {1} Ohm.').format(ov,"%.2f"%r)
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='oven_resistance',
+                values={'Oven':ov,'Resistance':r})
 
-            
+            res.append(r)
 
         return res
 
@@ -337,11 +311,17 @@ class OvenRestart(object):
             FESA_GHOST_Property=self.FESA_GHOST_Property,simulate_SET=self.simulate_SET,
             INCA_ACCEL='LEIR',japc_selector=self.Oven_FESA_selector,
             which_ebook=self.which_ebook,no_elog_write=self.no_elog_write,
-            log_me=self.log_me,log_level=self.log_level,dir_logging=self.dir_logging)
+            log_me=self.log_me,log_level=self.log_level,dir_logging=self.dir_logging,
+            schema_properties=['IP.NSRCGEN/Setting'],japc_record=self.japc_record,japc_replay=self.japc_replay,
+            clock=self.clock,log_structured=self.log_structured,trace_file=self.trace_file,
+            profile_iterations=self.profile_iterations,status_port=self.status_port,
+            japc_rates=self.japc_rates)
 
 
         myGT.start_module()# Initialize logging systems and JAPC
 
+        myGT.trace_mark('checks') # Phases of the module in the trace (see GHOST.trace_mark()).
+
         myGT.my_stopper(flag='initial',set_init=False) # Check OvenRestart_kill flag 
                                                        #without setting any initial value :-)
 
@@ -372,7 +352,8 @@ class OvenRestart(object):
                 
                 myGT.japc.setSelector(None)
 
-                Oven_status=myGT.japc.getParam('IP.NSRCGEN/Status#oven'+str(Oven_choice)+'Status')[1]
+                Oven_status=myGT.fec_call(myGT.japc.getParam,'IP.NSRCGEN/Status#oven'+str(Oven_choice)+'Status',
+                    description='GET oven status')[1]
                 which_oven=[Oven_choice]
                 which_oven_str=Oven_choice
                 msg='Oven {} is selected for restart.'.format(which_oven_str)
@@ -382,8 +363,8 @@ class OvenRestart(object):
             elif Oven_choice==3:
 
                 Oven_both_status=[item[0] for item \
-                in myGT.japc.getParam(['IP.NSRCGEN/Status#oven1Status',
-                    'IP.NSRCGEN/Status#oven2Status'])]
+                in myGT.fec_call(myGT.japc.getParam,['IP.NSRCGEN/Status#oven1Status',
+                    'IP.NSRCGEN/Status#oven2Status'],description='GET oven status')]
                 
                 which_oven=[1,2]
                 which_oven_str='1 and 2'
@@ -407,6 +388,8 @@ class OvenRestart(object):
                 myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
 
+                myGT.trace_mark('outgassing')
+
                 #Get oven power
                 Oven_power=self.read_power()
                 
@@ -433,19 +416,22 @@ class OvenRestart(object):
 
                     set_oven_power=2.0 #in Watts
 
-                    for ov in which_oven:
+                    is_safe_to_set=myGT.set_my_JAPC_parameters(device='IP.NSRCGEN',field='Setting',
+                        values={'oven'+str(ov)+'Power':set_oven_power for ov in which_oven},
+                        my_selector=None,lim_l=0.0,lim_r=10.0)
 
-                        is_safe_to_set=myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',
-                            field='Setting',parameter='oven'+str(ov)+'Power',
-                            my_selector=None,val_to_set=set_oven_power,lim_l=0.0,lim_r=10.0)
+                    for ov in which_oven:
 
                         msg='Power of oven {0} is set to {1} W.'.format(ov,"%.1f"%set_oven_power)
-                        myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+                        myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='oven_power_set',
+                            values={'Oven':ov,'Power':set_oven_power})
 
 
                     msg='The power of the oven {} is set. Waiting for 60 minutes.'.format(which_oven_str)
                     myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
+                    myGT.trace_mark('settling')
+
                     #wait for 60 minutes
                     time_wait=self.OvenPower_wait
                     
@@ -477,15 +463,18 @@ class OvenRestart(object):
 
                         set_oven_power+=go_up
 
-                        for ov in which_oven:
+                        myGT.trace_mark('power_step',Power=set_oven_power)
+
+                        is_safe_to_set=myGT.set_my_JAPC_parameters(device='IP.NSRCGEN',field='Setting',
+                            values={'oven'+str(ov)+'Power':set_oven_power for ov in which_oven},
+                            my_selector=None,lim_l=0.0,lim_r=10.0)
 
-                            is_safe_to_set=myGT.set_my_JAPC_parameter(device='IP.NSRCGEN',
-                                field='Setting',parameter='oven'+str(ov)+'Power',
-                                val_to_set=set_oven_power,lim_l=0.0,lim_r=10.0,my_selector=None)
+                        for ov in which_oven:
 
                             msg='Power of oven {0} is set to {1} W.'.format(ov,"%.1f"%set_oven_power)
 
-                            myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+                            myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='oven_power_set',
+                                values={'Oven':ov,'Power':set_oven_power})
 
 
 
@@ -521,7 +510,7 @@ class OvenRestart(object):
                         if all(np.array(Oven_power)>=5.0):
                             
                             msg="OvenRestart module finished with success. Goodbye! :-)"
-                            myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+                            myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='finish')
                             
                             myGT.send_email()
                             
@@ -541,14 +530,14 @@ class OvenRestart(object):
 
                         msg=('Resistance value outside operation range (0.5,5) Ohms. '+
                             'Aborting OvenRestart module operations. Exiting.')
-                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_resistance')
                                                     
 
                 else:
 
                     msg=('Oven {} appears to be already powered on. '+
                         'Aborting OvenRestart module operations. Exiting.').format(Oven_choice)
-                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_powered_on')
 
 
 
@@ -556,14 +545,14 @@ class OvenRestart(object):
 
                 msg=('The status of the oven {0} is {1}. '+
                     'Aborting OvenRestart module operations. Exiting.').format(Oven_choice,Oven_status)
-                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_oven_status')
 
         else:
 
 
             # Wait for new input and restart
             msg='Inhibition of module OvenRestart: Inhibit flag raised by the user. Exiting.'
-            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='inhibit')
 
             
                 
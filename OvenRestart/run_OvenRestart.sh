@@ -5,6 +5,7 @@
 
 source /acc/local/share/python/L866/setup.sh
 
-python OvenRestart.py & # run the module in the background. Remove & for shell print.
+# The watchdog restarts the module when it stalls (no heartbeat within the budget of its phase) or fails.
+python ../lib/ghost_watchdog.py --heartbeat OvenRestart.heartbeat --log OvenRestart_watchdog.log -- python OvenRestart.py & # run the module in the background. Remove & for shell print.
 
 
@@ -0,0 +1,556 @@
+
+import sys
+
+sys.path.append('/user/ln3op/GHOST/lib')
+
+from cmn_methods import * # Some helper functions
+
+
+class SourceOptimizer(object):
+    """
+    The SourceOptimizer module tunes a set of bounded setting parameters (knobs) of the ion source of Linac 3 together,
+    for the maximum ion beam current from BCT15. It generalizes HTadjust, which tunes only the sourceHT voltage, to knobs
+    which interact with each other (e.g. the HT voltage and the oven power).
+
+    The optimization uses SPSA (Simultaneous Perturbation Stochastic Approximation): Every update perturbs all the knobs at once
+    in a random direction and needs two BCT15 measurements, whatever the number of knobs.
+
+    The module is an infinite loop module, controlled with the FESA parameters SourceOptimizer_kill, SourceOptimizer_inhibit,
+    SourceOptimizer_intervall and SourceOptimizer_test of the GHOST FESA class.
+    The module is executed by calling the run() method of the SourceOptimizer class.
+
+    """
+
+
+
+    def __init__(self,FESA_GHOST_Device='GHOSTconfig',FESA_GHOST_Property='SourceOptimizer',
+                 simulate_SET=False,INCA_ACCEL='LEIR',knobs=None,knob_selector=None,
+                 BCT15_selector='LEI.USER.ALL',which_ebook='TESTS',
+                 no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging='',
+                 japc_record=None,japc_replay=None,clock=None,log_structured=False,
+                 updates=10,spsa_a=0.5,spsa_c=1.0,spsa_A=2.0,seed=None,
+                 BCT15_estimator='median',BCT15_settle_time=0.0):
+        """
+        Initialisation of the SourceOptimizer module. The input parameters are:
+
+        FESA_GHOST_Device: (default:GHOSTconfig): The device of the GHOST module in the appropriate FESA class.
+
+        FESA_GHOST_Property: (default:SourceOptimizer): The property of the GHOST module in the appropriate FESA class.
+
+        simulate_SET:(default:False): Option for executing the module in simulation mode i.e. without actually adjusting any
+        of the parameters with JAPC.
+
+        INCA_ACCEL:(default:LEIR): The accelerator in the INCA (INjection Control Architecture) database.
+
+        knobs:(default:None): List of dictionaries, one for each knob, with the keys:
+
+            'Device', 'Field', 'Parameter': The FESA setting parameter.
+
+            'Step': The size of the SPSA perturbation in the units of the parameter. The knobs move by at most one Step per update.
+
+            'Low', 'High' (optional): The absolute limits of the parameter. By default the FESA limits ('_min'/'_max') of the
+            schema registry are used. A knob without any limits (and without 'Safe') is refused.
+
+            'Range' (optional): The maximum distance from the value at the beginning of each iteration.
+
+            'Safe' (optional): The FESA parameters (device/property#field) of the operator safe limits (low, high) of the
+            parameter, read again before every SPSA perturbation and update (e.g. the HTLowerLimit and HTUpperLimit of HTadjust).
+
+            'Settle' (optional): Time in seconds after a SET of the knob before the BCT15 shots are valid. The slow knobs (e.g. the
+            oven power, which needs about an hour per step) cannot be measured with the BCT15 shots of the next cycles.
+
+        None: The sourceHT voltage (Step 2 V, Range 10 V), within the HTadjust safe limits.
+
+        knob_selector:(default:None): The JAPC selector for interacting with the knobs.
+
+        BCT15_selector:(default:'LEI.USER.ALL'): The selector for interacting with the currentLinacSingle parameter.
+
+        which_ebook:(default:'TESTS'): The elogbook to push events from the elogbook module.
+
+        no_elog_write:(default:False): Flag to suppress logging to the elogbook.
+
+        log_me:(default:True): Flag to initiate the logger module for the local log system.
+
+        log_level:(default:'DEBUG'): The level of logging for the local log system.
+
+        dir_logging: (default:''): The directory of the local log files for logging.
+
+        japc_record, japc_replay, clock, log_structured: As for HTadjust.
+
+        updates:(default:10): The number of SPSA updates of each iteration.
+
+        spsa_a, spsa_c, spsa_A:(default:0.5, 1.0, 2.0): The SPSA gain sequences a_k=spsa_a/(k+1+spsa_A)**0.602 (update, in
+        Steps per unit of relative current gradient) and c_k=spsa_c/(k+1)**0.101 (perturbation, in Steps).
+
+        seed:(default:None): The seed of the random perturbation directions (use it for reproducible runs).
+
+        BCT15_estimator:(default:'median'): The estimator of the BCT15 measurements, see GHOST.shot_statistics().
+
+        BCT15_settle_time:(default:0.0): Time in seconds after a SET before the BCT15 shots are valid.
+
+        """
+
+        self.FESA_GHOST_Device=FESA_GHOST_Device
+
+        self.FESA_GHOST_Property=FESA_GHOST_Property
+
+        self.simulate_SET=simulate_SET
+
+        self.knob_selector=knob_selector
+
+        self.knobs=knobs if knobs is not None else [
+            {'Device':'IP.NSRCGEN','Field':'Setting','Parameter':'sourceHT','Step':2.0,'Range':10.0,
+             'Safe':(FESA_GHOST_Device+'/HTadjust#HTadjust_HTLowerLimit',FESA_GHOST_Device+'/HTadjust#HTadjust_HTUpperLimit')}]
+
+        self.BCT15_selector=BCT15_selector
+
+        self.INCA_ACCEL=INCA_ACCEL
+
+        self.which_ebook=which_ebook
+
+        self.log_level=log_level
+
+        self.no_elog_write=no_elog_write
+
+        self.log_me=log_me
+
+        self.dir_logging=dir_logging
+
+        self.japc_record=japc_record
+
+        self.japc_replay=japc_replay
+
+        self.clock=clock
+
+        self.log_structured=log_structured
+
+        self.updates=updates
+
+        self.spsa_a=spsa_a
+
+        self.spsa_c=spsa_c
+
+        self.spsa_A=spsa_A
+
+        self.random=np.random.RandomState(seed)
+
+        self.BCT15_estimator=BCT15_estimator
+
+        self.BCT15_settle_time=BCT15_settle_time
+        self.settle_beat=10.0 # Maximum time (in seconds) between two heartbeats while waiting for the settle time
+
+        self.__version__='v.1.0'
+
+
+
+#                                              FUNCTION DEFINITIONS
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+
+    def knob_names(self):
+        """
+        Method of SourceOptimizer class:
+
+            The names device/field#parameter of the knobs.
+        """
+
+        return [knob['Device']+'/'+knob['Field']+'#'+knob['Parameter'] for knob in self.knobs]
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def read_knobs(self):
+        """
+        Method of SourceOptimizer class:
+
+            Read the current values of the knobs, with one GET per FESA property.
+
+            Output: Array of the values, in the order of the knobs.
+        """
+
+        values={}
+
+        for device,field in sorted({(knob['Device'],knob['Field']) for knob in self.knobs}):
+
+            template,fresh=myGT.get_property_template(device,field,self.knob_selector,refresh=True)
+
+            values[(device,field)]=template
+
+        return np.array([float(values[(knob['Device'],knob['Field'])][knob['Parameter']]) for knob in self.knobs])
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def knob_limits(self,start):
+        """
+        Method of SourceOptimizer class:
+
+            The lower and upper limits (arrays) of the knobs for the iteration which starts at the values start: The absolute
+            limits ('Low'/'High' or the FESA limits), within 'Range' of the start values and within the current operator safe
+            limits ('Safe').
+        """
+
+        low=np.zeros(len(self.knobs))
+        high=np.zeros(len(self.knobs))
+
+        for ind,(knob,name) in enumerate(zip(self.knobs,self.knob_names())):
+
+            my_field=myGT.schema.field(knob['Device']+'/'+knob['Field'],knob['Parameter']) \
+                if myGT.schema.has_field(name) else None
+
+            my_low,my_high=knob.get('Low'),knob.get('High')
+
+            if my_low is None and my_field is not None:
+                my_low=my_field.low
+            if my_high is None and my_field is not None:
+                my_high=my_field.high
+
+            assert knob.get('Safe') is not None or (my_low is not None and my_high is not None), \
+                'No limits for the knob {}.'.format(name)
+
+            low[ind]=my_low if my_low is not None else -np.inf
+            high[ind]=my_high if my_high is not None else np.inf
+
+            if knob.get('Range') is not None:
+
+                low[ind]=max(low[ind],start[ind]-knob['Range'])
+                high[ind]=min(high[ind],start[ind]+knob['Range'])
+
+            if knob.get('Safe') is not None:
+
+                safe_low,safe_high=[myGT.fec_call(myGT.japc.getParam,param,description='GET '+param,deadline=None)
+                                    for param in knob['Safe']]
+
+                low[ind]=max(low[ind],safe_low)
+                high[ind]=min(high[ind],safe_high)
+
+        return low,high
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def set_knobs(self,values,low,high):
+        """
+        Method of SourceOptimizer class:
+
+            Set the knobs to values (array), with one SET per FESA property and the limits low, high (arrays).
+
+            Output: True if all the SET operations were performed.
+        """
+
+        done=True
+
+        for device,field in sorted({(knob['Device'],knob['Field']) for knob in self.knobs}):
+
+            inds=[ind for ind,knob in enumerate(self.knobs) if (knob['Device'],knob['Field'])==(device,field)]
+
+            names=[self.knobs[ind]['Parameter'] for ind in inds]
+
+            done&=myGT.set_my_JAPC_parameters(device=device,field=field,values=dict(zip(names,values[inds])),
+                my_selector=self.knob_selector,lim_l=dict(zip(names,low[inds])),lim_r=dict(zip(names,high[inds])))
+
+        return done
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def measure_BCT15(self,shot_number,after_SET=True):
+        """
+        Method of SourceOptimizer class:
+
+            Measure the BCT15 current with the long-lived subscription of the iteration (see GHOST.take_shots()). With after_SET,
+            only the shots after the last SET and BCT15_settle_time (or the longest 'Settle' of the knobs) are measured. The settle
+            time is waited in the phase 'settle' of the module, with a heartbeat at least every settle_beat seconds, so that a slow
+            knob (e.g. the oven power) does not exceed the budget of the watchdog (see ghost_watchdog.PHASE_BUDGETS).
+
+            Output: The dictionary of GHOST.shot_statistics().
+        """
+
+        my_constructor=myGT.start_buffered_subscription(device="ITF.BCT15",field='Acquisition',
+            parameter='currentLinacSingle',my_selector=self.BCT15_selector)
+
+        settle_time=max([self.BCT15_settle_time]+[knob.get('Settle',0.0) for knob in self.knobs])
+
+        settle=dict(not_before=myGT.last_set_time,settle_time=settle_time) if after_SET else {}
+
+        if after_SET and settle_time>0 and myGT.last_set_time is not None:
+
+            remaining=myGT.last_set_time+settle_time-myGT.japc_time()
+
+            if remaining>0:
+
+                previous=myGT.enter_phase('settle')
+
+                wake_up=myGT.clock.time()+remaining
+
+                while myGT.clock.time()<wake_up:
+                    myGT.sleep(min(wake_up-myGT.clock.time(),self.settle_beat))
+
+                myGT.enter_phase(previous)
+
+        BCT15=myGT.take_shots(my_constructor,no_shots=shot_number,verbose=False,**settle)
+
+        return myGT.shot_statistics(BCT15['Values'],estimator=self.BCT15_estimator)
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def optimize(self,start,shot_number):
+        """
+        Method of SourceOptimizer class:
+
+            One iteration of the SPSA optimization, starting from the knob values start (array).
+
+            The knobs are scaled with their Step: x=(values-start)/Step. Each update k draws a random direction delta (+/-1 for
+            each knob), sets the knobs to x+c_k*delta and x-c_k*delta and measures the relative BCT15 current y+ and y- on each.
+            The gradient estimate (y+ - y-)/(2*c_k*delta) moves x by a_k times the gradient, at most one Step per knob. The
+            perturbed points are kept within the limits of the knobs (see knob_limits()), read again for every update so that
+            a change of the operator safe limits is followed at once. The iteration stops (and is rolled back by run()) when a
+            knob is outside its limits (e.g. after the operators tightened the safe limits), when the limits of a knob are narrower
+            than the perturbation or when a SET is refused.
+
+            The kill and inhibit flags are checked on every update. A kill rolls back all the SET operations of the iteration.
+
+            Output: The final knob values, the reference current and the reason of an early stop (None if all the updates were done).
+        """
+
+        steps=np.array([float(knob['Step']) for knob in self.knobs])
+
+        reference=self.measure_BCT15(shot_number,after_SET=False)['Mean']
+
+        msg='Reference ion beam current measurement is {}'.format("%.3f"%reference)
+        myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='BCT15_initial',values={'Current':reference})
+
+        if not reference>=0.01:
+            return start,reference,'BCT15 current below threshold (0.01 mA)'
+
+        x=np.zeros(len(self.knobs))
+
+        for k in range(self.updates):
+
+            myGT.my_stopper(flag='',set_init=False) # A kill rolls back the SETs of the iteration.
+
+            if myGT.get_FESA_param('inhibit'):
+                return start+steps*x,reference,'Inhibit flag raised by the user'
+
+            low,high=self.knob_limits(start)
+
+            if np.any((start<low)|(start>high)):
+                return start,reference,'Knobs outside their limits'
+
+            a_k=self.spsa_a/(k+1+self.spsa_A)**0.602
+            c_k=self.spsa_c/(k+1)**0.101
+
+            if np.any(high-low<2.0*c_k*steps):
+                return start,reference,'Limits of the knobs narrower than the SPSA perturbation'
+
+            delta=self.random.choice([-1.0,1.0],size=len(self.knobs))
+
+            # The center is kept far enough from the limits for the perturbation.
+            x=np.clip(x,(low-start)/steps+c_k,(high-start)/steps-c_k)
+
+            y={}
+
+            for sign in (1,-1):
+
+                if not self.set_knobs(start+steps*(x+sign*c_k*delta),low,high):
+                    return start,reference,'SET of the knobs refused by their limits'
+
+                BCT15=self.measure_BCT15(shot_number)
+
+                y[sign]=BCT15['Mean']/reference
+
+                if not BCT15['Sigma']<=0.1*BCT15['Mean']:
+                    break
+
+            if len(y)<2:
+
+                msg='SPSA update {}: Unstable conditions in the BCT15 measurements. No update of the knobs.'.format(k+1)
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='optimizer_unstable')
+
+                continue
+
+            gradient=(y[1]-y[-1])/(2.0*c_k*delta)
+
+            x=x+np.clip(a_k*gradient,-1.0,1.0)
+
+            x=np.clip(x,(low-start)/steps,(high-start)/steps)
+
+            msg=('SPSA update {0}: I+ {1}, I- {2} (relative), knobs {3}.').format(k+1,"%.4f"%y[1],"%.4f"%y[-1],
+                ', '.join('{0}={1}'.format(name,"%.3f"%value) for name,value in zip(self.knob_names(),start+steps*x)))
+            myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='optimizer_update',
+                values=dict({'Update':k+1,'I_plus':y[1],'I_minus':y[-1]},**dict(zip(self.knob_names(),start+steps*x))))
+
+        return start+steps*x,reference,None
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+#                                                 MAIN FUNCTION
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+
+    def run(self,shot_number=5):
+        """
+        The main function of the SourceOptimizer module.
+
+        Inputs:
+
+        shot_number: (default 5): The number of BCT15 shots of each measurement.
+
+
+        *** Description :
+
+        {
+            Each iteration checks the kill and inhibit flags and the status of the source, reads the knobs and performs
+            the SPSA updates of optimize().
+
+            The knobs are then set to the final values and the BCT15 current is measured. If it is lower than the reference
+            current of the beginning of the iteration, all the SET operations of the iteration are rolled back.
+
+            The module waits for SourceOptimizer_intervall minutes between the iterations (10 seconds after an improvement).
+            In test mode (SourceOptimizer_test=True) no knob is changed.
+        }
+        """
+
+        global myGT
+
+        # Initialize my helper !
+
+        myGT=GHOST(mod_name=self.__class__.__name__,FESA_GHOST_Device=self.FESA_GHOST_Device,
+            FESA_GHOST_Property=self.FESA_GHOST_Property,simulate_SET=self.simulate_SET,
+            INCA_ACCEL=self.INCA_ACCEL,japc_selector=self.knob_selector,
+            which_ebook=self.which_ebook,no_elog_write=self.no_elog_write,
+            log_me=self.log_me,log_level=self.log_level,dir_logging=self.dir_logging,
+            schema_properties=sorted({knob['Device']+'/'+knob['Field'] for knob in self.knobs}),
+            japc_record=self.japc_record,japc_replay=self.japc_replay,clock=self.clock,log_structured=self.log_structured)
+
+        myGT.start_module() # Initiate loggers, pyJAPC
+
+        try:
+
+            while True:
+
+                interval=myGT.get_FESA_param('intervall')
+
+                msg='SourceOptimizer_interval is {} minutes'.format(interval)
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='iteration_start',
+                    values={'Interval':interval})
+
+                myGT.my_stopper(flag='initial',set_init=False) # Check kill flag
+
+                if myGT.get_FESA_param('inhibit'):
+
+                    msg=('Inhibition of module SourceOptimizer: Inhibit flag raised by the user.' +
+                        'The module will resume after change of the SourceOptimizer_inhibit flag.')
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='inhibit')
+
+                    myGT.wait_time_interval(FESA_time=interval,set_init=False)
+
+                    continue
+
+                if myGT.get_FESA_param('test'):
+
+                    msg='This is a test (SourceOptimizer_test=True). No SET operation on-going.'
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                    myGT.wait_time_interval(FESA_time=interval,set_init=False)
+
+                    continue
+
+                myGT.japc.setSelector(None)
+
+                HT_status=myGT.fec_call(myGT.japc.getParam,'IP.NSRCGEN/Status#sourceHTStatus',
+                    description='GET IP.NSRCGEN/Status#sourceHTStatus')
+
+                if not HT_status[0]==2:
+
+                    msg=('The status of the source is {0}. ' +
+                        'Waiting for {1} minutes.').format(HT_status[1],interval)
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='abort_source_status')
+
+                    myGT.wait_time_interval(FESA_time=interval,set_init=False)
+
+                    continue
+
+                myGT.begin_iteration() # Every SET of this iteration is journaled and can be rolled back.
+
+                start=self.read_knobs()
+
+                msg='Starting the optimization of the knobs {}.'.format(', '.join(
+                    '{0}={1}'.format(name,value) for name,value in zip(self.knob_names(),start)))
+                myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                final,reference,reason=self.optimize(start,shot_number)
+
+                improved=False
+
+                if reason is None or reason.startswith('Inhibit'):
+
+                    low,high=self.knob_limits(start)
+
+                    final=np.clip(final,low,high) # Within the current safe limits.
+
+                    if self.set_knobs(final,low,high):
+
+                        current=self.measure_BCT15(shot_number)['Mean']
+
+                        improved=current>reference
+
+                    else:
+
+                        reason='SET of the final knob values refused by their limits'
+
+                if improved:
+
+                    myGT.commit_iteration()
+
+                    msg='Source optimization: {0}, BCT15 I [mA]: {1}-->{2}'.format(', '.join(
+                        '{0}: {1}-->{2}'.format(name,"%.3f"%old,"%.3f"%new) for name,old,new in zip(self.knob_names(),start,final)),
+                        "%.3f"%reference,"%.3f"%current)
+                    myGT.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='optimizer_result',
+                        values=dict({'BCT15_start':reference,'BCT15_new':current},**dict(zip(self.knob_names(),final))))
+
+                else:
+
+                    msg='No improvement of the ion beam current{}. Setting the knobs to their initial values.'.format(
+                        '' if reason is None else ' ('+reason+')')
+                    myGT.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='optimizer_no_improvement')
+
+                    myGT.rollback_iteration(reason='No improvement of the SourceOptimizer iteration.')
+
+                myGT.stop_buffered_subscription() # No BCT15 subscription during the waits.
+
+                myGT.wait_time_interval(FESA_time=interval,set_init=False,user_time=10 if improved else 0)
+
+        except Exception:
+
+            # Restore the hardware state of the unfinished iteration before exiting.
+            myGT.rollback_iteration(reason='Exception in the SourceOptimizer module.')
+
+            myGT.stop_buffered_subscription()
+
+            raise
+
+
+
+#                                                    RUN ME
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+if __name__ == "__main__":
+
+    my_log_dir='/user/ln3op/GHOST/SourceOptimizer/log/'
+
+    SO_object=SourceOptimizer(simulate_SET=False,knob_selector=None,
+                              BCT15_selector='LEI.USER.ALL',
+                              which_ebook='LINAC 3',no_elog_write=False,log_me=True,log_level='INFO',
+                              dir_logging=my_log_dir)
+
+    SO_object.run(shot_number=5) # Run SourceOptimizer module.
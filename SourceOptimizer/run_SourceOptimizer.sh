@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# source /acc/local/share/python/L867/setup.sh # Use Python 3 Officialy supported by CO (Attention:
+#The L867 subdir depends on the CPU of the running machine. Try L866 if this doesn't work.)
+
+source /acc/local/share/python/L866/setup.sh
+
+# The watchdog restarts the module when it stalls (no heartbeat within the budget of its phase) or fails.
+python ../lib/ghost_watchdog.py --heartbeat SourceOptimizer.heartbeat --log SourceOptimizer_watchdog.log -- python SourceOptimizer.py & # run the module in the background. Remove & for shell print.
@@ -8,7 +8,16 @@ import pyjapc
 import pytimber
 
 # Time module for sleeping
-from time import sleep
+import time
+
+# Scheduled wake-ups of the virtual clock
+import heapq
+
+# Jitter of the retry backoff
+import random
+
+# Callbacks of the long-lived subscriptions arrive from the JAPC threads
+import threading
 
 #PyLogBook to push events to the eLogbook
 import pylogbook
@@ -28,537 +37,2646 @@ from sys import exit
 # For string search
 import re
 
+#SET journal on disk
+import json
 
-#Plotting
+#Record and replay of JAPC sessions
+from japc_trace import JAPCRecorder, JAPCReplayer
 
-import matplotlib.pylab as plt
+#Structured module logs
+from ghost_logging import StructuredLogHandler
 
-#Send emails
+#Surrogate model for the warm start of the HTadjust module
+from ghost_surrogate import QuadraticSurrogate, align_history
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib
+#Heartbeat for the watchdog
+from ghost_watchdog import Heartbeat
 
-class GHOST():
+#Stack dumps for the watchdog and the decorator of the phases
+import faulthandler
+import signal
+import functools
+import os
 
+#Tracing spans and profiling
+from ghost_trace import Tracer
+import contextlib
+import atexit
 
-    def __init__(self,mod_name,FESA_GHOST_Property,
-             simulate_SET,INCA_ACCEL='LEIR',FESA_GHOST_Device='GHOSTconfig',japc_selector=None,
-             which_ebook='TESTS',no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging=''):
 
-        self.mod_name=mod_name
-        self.FESA_GHOST_Device=FESA_GHOST_Device
-        self.FESA_GHOST_Property=FESA_GHOST_Property
-        self.simulate_SET=simulate_SET
-        self.INCA_ACCEL=INCA_ACCEL
-        self.japc_selector=japc_selector
-        self.which_ebook=which_ebook
-        self.no_elog_write=no_elog_write
-        self.log_me=log_me
-        self.log_level=log_level
-        self.dir_logging=dir_logging
+#Rate limiter of the JAPC requests
+from ghost_ratelimit import process_limiter, RateLimitedJAPC
 
+#Local status endpoint of the module
+from ghost_status import StatusBoard, StatusServer
 
+#Plotting (headless, in a worker process)
 
+from ghost_plot import TimberPlotter
 
-    #                                              FUNCTION DEFINITIONS 
-    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+#Send emails (background dispatcher)
 
-    def initiate_JAPC(self,log=50):
-            """
+from ghost_notify import NotificationDispatcher, load_notify_config
 
-            Initialisation of the pyJAPC module. 
+NULL_SPAN=contextlib.nullcontext() # The span of GHOST.span() when tracing is off
 
-            Input:
 
-            log : (default 50): The log level of the pyjapc module.
 
+def ghost_phase(name):
+    """
+    Decorator of the GHOST methods which run in the phase name of the module (see GHOST.enter_phase()). The previous phase is
+    restored when the method returns. With tracing on (see GHOST.tracer), the method is also a span of the category name.
+    """
 
-            """
+    def decorator(method):
 
-            
-            japc=pyjapc.PyJapc(selector=self.japc_selector,
-                               incaAcceleratorName=self.INCA_ACCEL,noSet=self.simulate_SET,logLevel=log) 
-        
-            self.japc=japc
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
 
-    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+            tracer=self.tracer
 
-    def initiate_elogbook(self):
-        """
-        Initialisation of the elogbook module. 
+            previous=self.enter_phase(name)
 
-        Note that due to a bug of elogbook, each time a check of its functionality is performed via logging to logbook "TESTS".
-        
-        """
+            if tracer is not None:
+                tracer.begin(method.__name__,name)
 
-        assert self.which_ebook in ['LINAC 3','TESTS'], 'Wrong choice of logbook. Choose between "LINAC 3" and "TESTS"'
+            try:
+                return method(self,*args,**kwargs)
+            finally:
+                if tracer is not None:
+                    tracer.end()
+                if self.phase!='exit': # A kill flag unwinding the nested phases keeps the last beat 'exit'.
+                    self.enter_phase(previous)
 
-        def elog_checker():
-            
-            elog_temp=pylogbook.eLogbook('TESTS')
+        return wrapper
+
+    return decorator
+
+
+
+def ghost_span(fields=()):
+    """
+    Decorator of the GHOST I/O methods: With tracing on (see GHOST.tracer), the method is a span of the category 'io', with the
+    keyword arguments fields as arguments of the span. With tracing off, only the test of self.tracer is added.
+    """
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
+
+            tracer=self.tracer
+
+            if tracer is None:
+                return method(self,*args,**kwargs)
+
+            tracer.begin(method.__name__,'io',{field:str(kwargs[field]) for field in fields if field in kwargs} or None)
 
             try:
+                return method(self,*args,**kwargs)
+            finally:
+                tracer.end()
 
-                elog_temp.create_event('Testing elogbook functionality.')
+        return wrapper
 
-            except:
+    return decorator
 
-                self.no_elog_write=True
 
-                msg=('Cannot push events to '+self.which_ebook+' logbook. ' + 
-                    ' Failed to initiate PyLogbook module. Reverting to local logging only.')
-                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
+class FECTimeoutError(RuntimeError):
+    """
+    Raised when a JAPC operation on the FEC does not succeed within the deadline of its RetryPolicy.
+    """
 
-        elog_checker()
 
-        elog=pylogbook.eLogbook(self.which_ebook)
 
-        self.elog=elog
+class RetryPolicy():
+    """
+    Retry policy for every JAPC access of GHOST (see GHOST.fec_call()).
 
-    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+    Failed attempts are repeated with a jittered exponential backoff, until the total deadline of the operation is reached.
 
-    def initiate_logger(self):
+    After breaker_threshold consecutive failures the circuit breaker opens: the FEC is then probed with a cheap GET every
+    probe_interval seconds and the breaker closes as soon as the FEC answers again.
+
+    Input:
+
+    base_delay: (float): The delay (in seconds) after the first failed attempt.
+
+    max_delay: (float): The maximum delay (in seconds) between two attempts.
+
+    factor: (float): The growth factor of the delay after each failed attempt.
+
+    jitter: (float): Fraction (0-1) of each delay which is randomised, so that several modules do not retry in step.
+
+    deadline: (float): The total time (in seconds) given to an operation before FECTimeoutError is raised.
+                       None means that the operation is retried until it succeeds.
+
+    breaker_threshold: (int): The number of consecutive failures which opens the circuit breaker.
+
+    probe_interval: (float): The time (in seconds) between two probes of the FEC while the breaker is open.
+
+    seed: The seed of the jitter random generator (use it for reproducible runs).
+
+    """
+
+    def __init__(self,base_delay=1.0,max_delay=30.0,factor=2.0,jitter=0.5,deadline=120.0,
+                 breaker_threshold=3,probe_interval=5.0,seed=None):
+
+        assert base_delay>0 and max_delay>=base_delay,'Wrong input for the retry delays.'
+        assert 0<=jitter<=1,'The jitter must be a fraction between 0 and 1.'
+
+        self.base_delay=base_delay
+        self.max_delay=max_delay
+        self.factor=factor
+        self.jitter=jitter
+        self.deadline=deadline
+        self.breaker_threshold=breaker_threshold
+        self.probe_interval=probe_interval
+        self.random=random.Random(seed)
+
+        self.failures=0 # Consecutive failures, shared by all the operations of the module.
+
+    def backoff(self,attempt):
+        """
+        The delay (in seconds) before the next attempt, after attempt (int, starting from 0) failed attempts.
         """
-        Initialisation of the local logging system. 
 
-        The Python logger is used and the handler automatically opens a new log file at midnight. The logger's name is defined 
-        by the name of the class of the corresponding module.
+        delay=min(self.max_delay,self.base_delay*self.factor**attempt)
 
-        The directory of the log files must be set in the initialization of the object. (self.dir_logging)
+        return delay*(1.0-self.jitter*self.random.random())
 
-        If the object parameter "log_me" is False, then the logger is not constructed.
-        
+    def is_open(self):
+
+        return self.failures>=self.breaker_threshold
+
+    def record_failure(self):
+
+        self.failures+=1
+
+    def record_success(self):
+
+        self.failures=0
+
+    def half_open(self):
+        """
+        The FEC answered a probe: allow one more attempt before the breaker opens again.
         """
-        if self.log_me:
 
+        self.failures=self.breaker_threshold-1
 
-            # Set Logger and create its handler
 
 
-            lvl=logging.getLevelName(self.log_level)
+class IterationScheduler():
+    """
+    Adaptive wait between the iterations of an infinite loop module, set from the moves of the previous iterations.
 
-            
-            ttl='{:%Y-%m-%d_%H_%M_%S}'.format(datetime.datetime.now())
-            dir_=self.dir_logging
-            file_name=dir_+self.mod_name+'_'+ttl+'.log'
-            print(file_name)
-            # Create logger
-            logger = logging.getLogger(self.mod_name)
-            
-            logger.setLevel(lvl)
+    A search is a sequence of iterations which move the working point, ended by a stable iteration (no move):
 
-            #handler_logfile=logging.FileHandler(file_name,mode='w')
+    - Within a search the next iteration follows after min_wait.
+    - After a stable iteration the module waits for the cruise interval, which grows by factor after each further stable 
+      iteration (geometric backoff while the optimum is stable).
+    - When a search moves in the same direction as the previous one (a drift), the cruise interval shrinks by factor instead.
+      A search in the opposite direction keeps it.
 
-            # Create formatter and add it to the handler
-            
-            formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-            #handler_logfile.setFormatter(formatter)
+    The cruise interval is always kept within [min_wait, max_wait].
 
-            #Create funky Midnight roller
+    Input:
 
-            handler_rot = logging.handlers.TimedRotatingFileHandler(file_name,
-                                     when="midnight",
-                                     interval=1,
-                                     backupCount=0)# At midnight the Dracula comes out and at the same time,
-                                     # our bud here will change the log file name by appending the new date.
-            
-            handler_rot.setFormatter(formatter)
-            
-            logger.handlers = [handler_rot]
+    base: (float): The initial cruise interval (in seconds).
 
-            self.logger=logger
-        
-        else:
+    min_wait, max_wait: (float): The bounds of the wait (in seconds).
 
-            self.logger=[]
+    factor: (float): The growth factor of the backoff and the shrink factor of a drift.
 
-        # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+    """
 
+    def __init__(self,base,min_wait,max_wait,factor=2.0):
 
-        
-    def logger_or_printer(self,message,flag):
+        assert factor>1,'The factor of the scheduler must be larger than 1.'
+
+        self.factor=factor
+        self.cruise=base
+
+        self.search=0 # Direction of the on-going search (0: none).
+        self.last_search=0 # Direction of the previous search.
+        self.stable=0 # Consecutive stable iterations.
+
+        self.set_bounds(min_wait,max_wait)
 
+    def set_bounds(self,min_wait,max_wait):
+        """
+        Update the bounds of the wait (e.g. after a change of the FESA parameters).
         """
-        Function to switch between local logging or shell printing mode, according to the object initialization parameter log_me.
-        
-        Input:
 
-        message: The message (string) to be passed to the logger.
+        assert 0<min_wait<=max_wait,'Wrong bounds of the scheduler.'
 
-        flag: Parameter (string) which corresponds to the user defined severity (logging level) for the msg input.
+        self.min_wait=min_wait
+        self.max_wait=max_wait
+        self.cruise=min(max(self.cruise,min_wait),max_wait)
 
+    def next_wait(self,move):
+        """
+        The wait (in seconds) after an iteration which moved the working point by move (0: stable).
+        """
 
+        direction=int(np.sign(move))
 
-        Note that this method is designed to log only messages which correspond to the oblect parameted "log_level" and the flag input.
+        if direction:
 
-        For example, if flag='debug' and theu ser has initialised the module with log_level='info', the logger will not log anything.log
+            if not self.search:
+                self.search=direction
 
-        But if flag='info', the message will be logged.
-        
+            self.stable=0
+
+            return self.min_wait
+
+        if self.search:
+
+            if self.search==self.last_search:
+                self.cruise/=self.factor # Drift: look again sooner.
+
+            self.last_search=self.search
+            self.search=0
+
+        elif self.stable:
+
+            self.cruise*=self.factor # Backoff while nothing changes.
+
+        self.stable+=1
+
+        self.cruise=min(max(self.cruise,self.min_wait),self.max_wait)
+
+        return self.cruise
+
+
+
+class FESAField():
+    """
+    Typed accessor of one field of a FESA property, as found in the FESASchema registry.
+
+    Attributes: property (device/property), name, constructor (device/property#name), type ('bool','int','float','str','enum',
+    'array' or None if unknown), low and high (the FESA '_min'/'_max' limits, None if not defined).
+
+    """
+
+    __slots__=('property','name','constructor','type','low','high')
+
+    converters={'bool':bool,'int':int,'float':float,'str':str}
+
+    def __init__(self,property_,name,type_=None,low=None,high=None):
+
+        self.property=property_
+        self.name=name
+        self.constructor=property_+'#'+name
+        self.type=type_
+        self.low=low
+        self.high=high
+
+    def convert(self,value):
+        """
+        Convert value to the type of the field (values of unknown or composite types are returned unchanged).
         """
-        
-        lvl=self.log_level
 
-        if self.log_me:   
+        converter=self.converters.get(self.type)
 
-            if (lvl=='INFO') and (flag=='info'):
-                self.logger.info(message)
-            elif (lvl=='DEBUG') and (flag=='debug'):
-                self.logger.debug(message)
-            elif (lvl=='WARNING') and (flag=='warning'):
-                self.logger.warning(message)
-            elif (lvl=='ERROR') and (flag=='error'):
-                self.logger.error(message)
-            elif (lvl=='CRITICAL') and (flag=='critical'):
-                self.logger.critical(message)
+        return value if converter is None else converter(value)
 
-        else:
+    def in_range(self,value):
+        """
+        True if value is within the FESA limits of the field (missing limits are not checked).
+        """
 
-            print('Attention:Local logging is suppresed: '+message)
+        return (self.low is None or value>=self.low) and (self.high is None or value<=self.high)
 
+    def to_dict(self):
 
+        return {'Type':self.type,'Min':self.low,'Max':self.high}
 
-    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
 
 
-    def write_L3_log(self,msg,where,logfile_lvl='info'):
+class FESASchema():
+    """
+    Registry of the fields of FESA properties, built once from getParamInfo and a GET of each property.
+
+    The registry is persisted to a local cache file (JSON) with a version stamp, so that a restart of a module skips the
+    introspection round-trips. Name validation is then a set lookup.
+
+    Input:
+
+    properties: (dictionary): For each property (device/property) a dictionary with the field names as keys and the FESAField
+                              objects as items.
+
+    created: (float): The POSIX time of the introspection.
+
+    """
+
+    version=1 # Increase when the structure of the cache file changes.
+
+    def __init__(self,properties,created):
+
+        self.properties=properties
+        self.created=created
+        self.constructors={fld.constructor for fields in properties.values() for fld in fields.values()}
+
+    @staticmethod
+    def type_of(value):
         """
-        
-        Log messages to local logfile, logbook or both.
+        The schema type name of a value received from pyjapc.
+        """
+
+        if isinstance(value,(bool,np.bool_)):
+            return 'bool'
+        elif isinstance(value,(int,np.integer)):
+            return 'int'
+        elif isinstance(value,(float,np.floating)):
+            return 'float'
+        elif isinstance(value,str):
+            return 'str'
+        elif isinstance(value,tuple):
+            return 'enum'
+        elif isinstance(value,(list,np.ndarray)):
+            return 'array'
+
+        return None
+
+    @classmethod
+    def introspect(cls,properties,get_info,get_values,now=None):
+        """
+        Build the registry from the FEC.
 
         Input:
 
-        msg: (string): Them essage to be logged.logfile_lvl
+        properties: (list): The FESA properties (device/property) to be introspected.
 
-        where: (string): The location for the logging ('logbook', 'logfile' or 'both logs')
+        get_info: Callable returning the getParamInfo string of a property.
 
-        logfile_lvl : (string): The level for the logging. (see logger_or_printer() for more info)
+        get_values: Callable returning the dictionary of a property (GET), or None if the property cannot be read.
 
-        Note that logging operations are controlled form the iniatialisation of the object with the parameters
+        now: (float): The POSIX time of the introspection (default: the current time), e.g. the time of the clock of the module.
 
-        no_elog_write (for the logbook) and log_me (for the local logging).
+        """
+
+        registry={}
+
+        for prop in properties:
+
+            names=set(re.findall(re.escape(prop)+r'#(\w+)',get_info(prop)))
 
+            values=get_values(prop) or {}
 
+            names.update(values.keys())
+
+            fields={}
+
+            for name in names:
+
+                if name.endswith('_min') or name.endswith('_max'):
+                    continue
+
+                fields[name]=FESAField(prop,name,cls.type_of(values.get(name)),
+                                       cls.plain(values.get(name+'_min')),cls.plain(values.get(name+'_max')))
+
+            registry[prop]=fields
+
+        return cls(registry,now if now is not None else datetime.datetime.now().timestamp())
+
+    @staticmethod
+    def plain(value):
+        """
+        Convert numpy scalars to Python scalars for the JSON cache.
         """
-        my_str=('Wrong input to log function. Choose where to log the message between' +
-            '"logfile" for local logging,"logbook" for logging in the OP logbook or both with "both logs".')
-            
-        
-        assert where in ['logfile','logbook','both logs'], my_str
 
-        if where=='logfile':
-            
-            self.logger_or_printer(message=msg,flag=logfile_lvl) 
+        return value.item() if isinstance(value,np.generic) else value
 
-        elif where=='logbook':
+    @classmethod
+    def load(cls,file_name,properties,max_age,now=None):
+        """
+        Load the registry from the cache file_name. None is returned if the file is missing, has a different version stamp,
+        does not cover all the properties or is older than max_age seconds at the POSIX time now (default: the current time).
 
-            if not self.no_elog_write: 
-                msg=(msg+' [GHOST: {}]').format(self.mod_name)
-                self.elog.create_event(msg)
+        """
 
-        else:
+        try:
 
-            self.logger_or_printer(message=msg,flag=logfile_lvl)
+            with open(file_name) as cache_file:
+                cache=json.load(cache_file)
 
-            if not self.no_elog_write:
-                msg=(msg+' [GHOST: {}]').format(self.mod_name)
-                self.elog.create_event(msg)
+        except (OSError,ValueError):
 
-    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+            return None
 
+        if cache.get('Version')!=cls.version or not set(properties).issubset(cache.get('Properties',{})):
+            return None
 
-    def start_module(self):
+        now=now if now is not None else datetime.datetime.now().timestamp()
 
+        if now-cache.get('Created',0)>max_age:
+            return None
 
+        return cls.from_cache(cache)
+
+    @classmethod
+    def from_cache(cls,cache):
         """
-        Method to initialize PyJAPC and the loggers.
+        Build the registry from its cache dictionary (see to_cache()).
+        """
+
+        registry={prop:{name:FESAField(prop,name,item['Type'],item['Min'],item['Max']) for name,item in fields.items()}
+                  for prop,fields in cache['Properties'].items()}
+
+        return cls(registry,cache['Created'])
+
+    def to_cache(self):
+        """
+        The cache dictionary of the registry, with its version stamp.
+        """
+
+        return {'Version':self.version,'Created':self.created,
+                'Properties':{prop:{name:fld.to_dict() for name,fld in fields.items()}
+                              for prop,fields in self.properties.items()}}
+
+    def save(self,file_name):
 
+        with open(file_name,'w') as cache_file:
+            json.dump(self.to_cache(),cache_file,indent=1)
+
+    def has_field(self,constructor):
+
+        return constructor in self.constructors
+
+    def field(self,property_,name):
+        """
+        The FESAField accessor of property_#name. KeyError is raised for unknown fields.
         """
 
-        global logger,japc,elog
+        return self.properties[property_][name]
 
 
-        self.initiate_logger()   
 
-        self.initiate_JAPC()# Change pseudo_set to False to escape simulation mode for SET action
-       
-        self.initiate_elogbook() # which_ebook: LINAC 3  
+class WallClock():
+    """
+    Clock of GHOST for all the waits and time-stamps, based on the time module (real time).
+    """
 
+    def sleep(self,seconds):
 
-        if self.simulate_SET:
+        time.sleep(seconds)
 
-            msg=('******Initiating {} module in Simulation Mode.' +
-            'No SET operations will be performed******').format(self.mod_name)
+    def time(self):
+        """
+        The POSIX time in seconds.
+        """
 
-        else:
+        return time.time()
 
-            msg='******Initiating {} module.******'.format(self.mod_name)
+    def monotonic(self):
+        """
+        Monotonic time in seconds, for the measurement of time intervals.
+        """
+
+        return time.monotonic()
+
+    def now(self):
+        """
+        The local date and time (datetime object).
+        """
+
+        return datetime.datetime.fromtimestamp(self.time())
+
+
+
+class VirtualClock(WallClock):
+    """
+    Simulated clock of GHOST: A sleep does not wait but jumps the clock to the wake-up time.
+
+    Simulated backends can schedule actions with schedule(). They are executed in time order, at their scheduled time,
+    while a sleep jumps over them. A wait of hours of a module is then executed in a fraction of a second.
+
+    Input:
+
+    start: (float): The initial POSIX time of the clock (default: the current time).
+
+    """
+
+    def __init__(self,start=None):
+
+        self.t=time.time() if start is None else float(start)
+        self.scheduled=[]
+        self.counter=0 # Keeps the order of actions scheduled for the same time.
+
+    def schedule(self,when,action):
+        """
+        Execute the callable action (without arguments) when the clock reaches the POSIX time when.
+        """
+
+        heapq.heappush(self.scheduled,(when,self.counter,action))
+        self.counter+=1
+
+    def sleep(self,seconds):
+
+        wake_up=self.t+max(seconds,0)
+
+        while self.scheduled and self.scheduled[0][0]<=wake_up:
+
+            when,counter,action=heapq.heappop(self.scheduled)
+
+            self.t=max(self.t,when)
+
+            action()
+
+        self.t=wake_up
+
+    def time(self):
+
+        return self.t
+
+    def monotonic(self):
+
+        return self.t
+
+
+
+class ShotBuffer():
+    """
+    Ring buffer of the updates of a long-lived subscription (see GHOST.start_buffered_subscription()).
+
+    Each update is stored with its sequence number (count of received updates), its header time-stamp (POSIX, nan if missing)
+    and its isFirstUpdate flag. The callbacks append from the JAPC threads, so all the accesses are locked.
+
+    Input:
+
+    size: (int): The number of updates kept in the buffer.
+
+    """
+
+    def __init__(self,size=1024):
+
+        self.size=size
+        self.values=np.full(size,np.nan)
+        self.stamps=np.full(size,np.nan)
+        self.first=np.zeros(size,dtype=bool)
+        self.count=0 # Total number of received updates
+        self.lock=threading.Lock()
+
+    def append(self,value,stamp,first=False):
+
+        with self.lock:
+
+            ind=self.count%self.size
+
+            self.values[ind]=value
+            self.stamps[ind]=np.nan if stamp is None else stamp
+            self.first[ind]=first
+            self.count+=1
+
+    def since(self,seq):
+        """
+        The updates with sequence number >= seq which are still in the buffer, in arrival order: (values, stamps, first) arrays
+        and the sequence number of the first of them.
+        """
+
+        with self.lock:
+
+            start=max(seq,self.count-self.size,0)
+            order=np.arange(start,self.count)%self.size
+
+            return self.values[order],self.stamps[order],self.first[order],start
+
+    def newer(self,seq):
+        """
+        The values with sequence number >= seq which are still in the buffer and the sequence number of the next update.
+        """
+
+        with self.lock:
+
+            start=max(seq,self.count-self.size,0)
+
+            return self.values[np.arange(start,self.count)%self.size],self.count
+
+
+
+class RecoveryMonitor():
+    """
+    Wake-up condition of a wait (see GHOST.wait_time_interval()) on the updates of a long-lived subscription (ShotBuffer):
+    The wait is cut short when the updates satisfy condition without interruption for debounce seconds. The last update
+    counts until the next one, so that a subscription which publishes only on change is also handled.
+
+    Input:
+
+    buffer_: (ShotBuffer): The buffer of the subscription.
+
+    condition: (callable): The condition on one update.
+
+    debounce: (float): The time (in seconds) the condition must hold.
+
+    clock: The clock of the module.
+
+    reason: (string): The reason returned when the condition holds.
+
+    """
+
+    def __init__(self,buffer_,condition,debounce,clock,reason):
+
+        self.buffer=buffer_
+        self.condition=condition
+        self.debounce=debounce
+        self.clock=clock
+        self.reason=reason
+
+        values,self.position=buffer_.newer(0)
+        self.since=None # Time since the condition holds
+
+        self.check(values[-1:]) # The state at the beginning of the wait.
+
+    def check(self,values):
+
+        for value in values:
+
+            if not self.condition(value):
+                self.since=None
+            elif self.since is None:
+                self.since=self.clock.time()
+
+    def __call__(self):
+
+        values,self.position=self.buffer.newer(self.position)
+
+        self.check(values)
+
+        if self.since is not None and self.clock.time()-self.since>=self.debounce:
+            return self.reason
+
+        return None
+
+
+
+class CusumDetector():
+    """
+    Online one-sided CUSUM detector of a drop of a signal (e.g. the BCT15 current) below its reference level.
+
+    The reference level and the noise are learned (median and 1.4826*MAD) from the first learn values after a reset().
+    Then each value x adds (reference-x-drop*reference/2)/sigma to the statistic (clipped to clip, so that a single glitch 
+    cannot raise the alarm) and the statistic is kept non-negative. The alarm is raised when the statistic exceeds threshold,
+    i.e. for a sustained drop of about drop (relative) or more.
+
+    Input:
+
+    drop: (float): The relative drop of the signal to detect.
+
+    threshold: (float): The alarm threshold of the statistic (in units of sigma).
+
+    learn: (int): The number of values for the reference level.
+
+    clip: (float): The maximum increment of the statistic per value (in units of sigma).
+
+    """
+
+    def __init__(self,drop=0.05,threshold=5.0,learn=10,clip=2.0):
+
+        self.drop=drop
+        self.threshold=threshold
+        self.learn=learn
+        self.clip=clip
+
+        self.reset()
+
+    def reset(self):
+
+        self.learned=[]
+        self.reference=None
+        self.sigma=None
+        self.statistic=0.0
+        self.last=None # The last value
+
+    def update(self,values):
+        """
+        Add the values (finite values only) and return True if the alarm is raised.
+        """
+
+        for value in np.asarray(values,dtype=float):
+
+            if not np.isfinite(value):
+                continue
+
+            self.last=value
+
+            if self.reference is None:
+
+                self.learned.append(value)
+
+                if len(self.learned)>=self.learn:
+                    self.reference=float(np.median(self.learned))
+                    self.sigma=max(1.4826*float(np.median(np.abs(np.array(self.learned)-self.reference))),
+                                   1e-3*abs(self.reference),1e-12)
+
+                continue
+
+            increment=(self.reference-value-self.drop*self.reference/2.0)/self.sigma
+
+            self.statistic=max(0.0,self.statistic+min(increment,self.clip))
+
+        return self.alarm()
+
+    def alarm(self):
+
+        return self.statistic>self.threshold
+
+
+
+class GHOST():
+
+
+    def __init__(self,mod_name,FESA_GHOST_Property,
+             simulate_SET,INCA_ACCEL='LEIR',FESA_GHOST_Device='GHOSTconfig',japc_selector=None,
+             which_ebook='TESTS',no_elog_write=False,log_me=True,log_level='DEBUG',dir_logging='',
+             retry_policy=None,template_max_age=2.0,journal_me=True,verify_tol=None,
+             schema_properties=(),schema_cache=None,schema_max_age=7*24*3600,japc_record=None,japc_replay=None,
+             clock=None,log_structured=False,log_retention=30,heartbeat_file=None,stack_dump_file=None,phase_budgets=None,
+             trace_file=None,trace_format=None,profile_iterations=None,notify_config=None,status_port=None,
+             status_host='127.0.0.1',japc_rates=None,japc_host_limiter=None,japc_reserve=0.3,journal_max_size=1048576):
+
+        self.mod_name=mod_name
+        self.FESA_GHOST_Device=FESA_GHOST_Device
+        self.FESA_GHOST_Property=FESA_GHOST_Property
+        self.simulate_SET=simulate_SET
+        self.INCA_ACCEL=INCA_ACCEL
+        self.japc_selector=japc_selector
+        self.which_ebook=which_ebook
+        self.no_elog_write=no_elog_write
+        self.log_me=log_me
+        self.log_level=log_level
+        self.dir_logging=dir_logging
+        self.retry_policy=retry_policy if retry_policy is not None else RetryPolicy()
+        self.template_max_age=template_max_age # seconds
+        self.property_templates={}
+        self.iteration_templates=set() # Properties read from the FEC in the current iteration (see set_my_JAPC_parameters())
+        self.journal_me=journal_me
+        self.journal_file=dir_logging+mod_name+'_SET_journal.jsonl'
+        self.journal_max_size=journal_max_size # bytes, before the rotation of the journal file (see rotate_journal())
+        self.verify_tol=verify_tol
+        self.set_journal=[]
+        self.iteration=0
+        self.iteration_open=False
+        self.iteration_start=0 # Index of the first SET of the current iteration in set_journal
+        self.rolling_back=False
+        self.schema_properties=[FESA_GHOST_Device+'/'+FESA_GHOST_Property]+list(schema_properties)
+        self.schema_cache=schema_cache if schema_cache is not None else dir_logging+mod_name+'_schema.json'
+        self.schema_max_age=schema_max_age # seconds
+        self.schema=None
+        self.japc_record=japc_record # Trace file for the recording of the JAPC session
+        self.japc_replay=japc_replay # Trace file or JAPCReplayer object for the replay of a JAPC session
+
+        if isinstance(japc_replay,str):
+            self.japc_replay=JAPCReplayer(japc_replay)
+
+        if japc_replay is not None:
+            self.no_elog_write=True
+
+        if clock is None:
+            # The replay runs as fast as the CPU allows, on the clock of the trace.
+            clock=WallClock() if japc_replay is None else VirtualClock(start=self.japc_replay.now())
+
+        self.clock=clock # Clock of all the waits and time-stamps (see WallClock and VirtualClock)
+        self.log_structured=log_structured
+        self.log_retention=log_retention # Number of rolled segments of the structured log
+        self.last_set_time=None # Time (POSIX, see japc_time()) of the last SET
+        self.shot_buffers={} # Long-lived subscriptions: constructor -> ShotBuffer
+        self.phase='run' # Phase of the module (see enter_phase())
+
+        # The watchdog (see ghost_watchdog.Watchdog) passes the heartbeat and stack dump files in the environment.
+        heartbeat_file=heartbeat_file if heartbeat_file is not None else os.environ.get('GHOST_HEARTBEAT')
+
+        self.heartbeat=Heartbeat(heartbeat_file,mod_name,phase_budgets) if heartbeat_file else None
+        self.stack_dump_file=stack_dump_file if stack_dump_file is not None else os.environ.get('GHOST_STACK_DUMP')
+
+        if self.heartbeat is not None and self.stack_dump_file is None:
+            self.stack_dump_file=heartbeat_file+'.stack'
+
+        # Tracing spans (see ghost_trace.Tracer), also switched on by the environment variable GHOST_TRACE.
+        trace_file=trace_file if trace_file is not None else os.environ.get('GHOST_TRACE')
+
+        self.tracer=Tracer(trace_file,trace_format,profile_iterations=profile_iterations) if trace_file else None
+
+        if self.tracer is not None:
+            atexit.register(self.tracer.close) # Also after the exit() of the kill flag.
+
+        self.notify_config=notify_config # SMTP configuration file (see ghost_notify.load_notify_config())
+        self.notifier=None # The NotificationDispatcher, created by the first send_email()
+        self.plotters={} # Headless plotters of read_timber(): figure file -> ghost_plot.TimberPlotter
+
+        # Token buckets of the JAPC GET and SET requests (see ghost_ratelimit.JAPCLimiter), shared by the process or by the host
+        # (japc_host_limiter). Also switched on by GHOST_JAPC_RATES (JSON file of the rates) and GHOST_JAPC_HOST_LIMITER.
+        japc_rates=japc_rates if japc_rates is not None else os.environ.get('GHOST_JAPC_RATES')
+        japc_host_limiter=japc_host_limiter if japc_host_limiter is not None else os.environ.get('GHOST_JAPC_HOST_LIMITER')
+
+        self.limiter=None
+        self.limiter_seen={'Requests':0,'Delayed':0,'Wait_total':0.0} # Totals at the last report (see begin_iteration())
+        self.kill_check=False # A GET of the kill flag is on-going (priority request)
+
+        if (japc_rates or japc_host_limiter) and japc_replay is None:
+            self.limiter=process_limiter(japc_rates,japc_reserve,japc_host_limiter or None,self.clock)
+
+        # Local HTTP status endpoint (see ghost_status.StatusServer), also switched on by GHOST_STATUS_PORT (0: a free port).
+        status_port=status_port if status_port is not None else os.environ.get('GHOST_STATUS_PORT')
+
+        self.status=None # The StatusBoard of the module, fed by its logs, phases and SETs
+        self.status_server=None
+
+        if status_port is not None and status_port!='':
+
+            self.status=StatusBoard(mod_name,self.clock)
+            self.status_server=StatusServer(self.status,status_host,int(status_port))
+
+            atexit.register(self.status_server.close)
+
+            if self.limiter is not None:
+                self.status.providers['Limiter']=self.limiter.stats
+
+
+
+
+    #                                              FUNCTION DEFINITIONS 
+    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+
+    @ghost_span()
+    def initiate_JAPC(self,log=50):
+            """
+
+            Initialisation of the pyJAPC module. 
+
+            Input:
+
+            log : (default 50): The log level of the pyjapc module.
+
+            If japc_replay is given, the JAPC session is replayed from a trace (see japc_trace.JAPCReplayer) instead.
+            If japc_record is given, the JAPC session is recorded to a trace file (see japc_trace.JAPCRecorder).
+
+
+            """
+
+            
+            if self.japc_replay is not None:
+
+                japc=self.japc_replay
+
+            else:
+
+                japc=pyjapc.PyJapc(selector=self.japc_selector,
+                                   incaAcceleratorName=self.INCA_ACCEL,noSet=self.simulate_SET,logLevel=log) 
+
+                if self.limiter is not None:
+                    japc=RateLimitedJAPC(japc,self.limiter,self.japc_priority)
+
+                if self.japc_record is not None:
+                    japc=JAPCRecorder(japc,self.japc_record,clock=self.clock)
+        
+            self.japc=japc
+
+    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+
+    @ghost_span()
+    def initiate_elogbook(self):
+        """
+        Initialisation of the elogbook module. 
+
+        Note that due to a bug of elogbook, each time a check of its functionality is performed via logging to logbook "TESTS".
+        
+        """
+
+        assert self.which_ebook in ['LINAC 3','TESTS'], 'Wrong choice of logbook. Choose between "LINAC 3" and "TESTS"'
+
+        def elog_checker():
+            
+            elog_temp=pylogbook.eLogbook('TESTS')
+
+            try:
+
+                elog_temp.create_event('Testing elogbook functionality.')
+
+            except:
+
+                self.no_elog_write=True
+
+                msg=('Cannot push events to '+self.which_ebook+' logbook. ' + 
+                    ' Failed to initiate PyLogbook module. Reverting to local logging only.')
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+
+        elog_checker()
+
+        elog=pylogbook.eLogbook(self.which_ebook)
+
+        self.elog=elog
+
+    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+
+    @ghost_span()
+    def initiate_logger(self):
+        """
+        Initialisation of the local logging system. 
+
+        The Python logger is used and the handler automatically opens a new log file at midnight. The logger's name is defined 
+        by the name of the class of the corresponding module.
+
+        The directory of the log files must be set in the initialization of the object. (self.dir_logging)
+
+        If the object parameter "log_me" is False, then the logger is not constructed.
+
+        If the object parameter "log_structured" is True, the records are also written to the structured log sink
+        (see ghost_logging.StructuredLogHandler), with log_retention rolled segments.
+        
+        """
+        if self.log_me:
+
+
+            # Set Logger and create its handler
+
+
+            lvl=logging.getLevelName(self.log_level)
+
+            
+            ttl='{:%Y-%m-%d_%H_%M_%S}'.format(self.clock.now())
+            dir_=self.dir_logging
+            file_name=dir_+self.mod_name+'_'+ttl+'.log'
+            print(file_name)
+            # Create logger
+            logger = logging.getLogger(self.mod_name)
+            
+            logger.setLevel(lvl)
+
+            #handler_logfile=logging.FileHandler(file_name,mode='w')
+
+            # Create formatter and add it to the handler
+            
+            formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
+            #handler_logfile.setFormatter(formatter)
+
+            #Create funky Midnight roller
+
+            handler_rot = logging.handlers.TimedRotatingFileHandler(file_name,
+                                     when="midnight",
+                                     interval=1,
+                                     backupCount=0)# At midnight the Dracula comes out and at the same time,
+                                     # our bud here will change the log file name by appending the new date.
+            
+            handler_rot.setFormatter(formatter)
+
+            clock=self.clock
+
+            def clock_stamp(record):
+
+                record.created=clock.time() # Time-stamps of the log from the clock of the module.
+
+                return True
+
+            handler_rot.addFilter(clock_stamp)
+            
+            logger.handlers = [handler_rot]
+
+            if self.log_structured:
+
+                handler_json=StructuredLogHandler(dir_,self.mod_name,retention=self.log_retention)
+                handler_json.addFilter(clock_stamp)
+
+                logger.handlers.append(handler_json)
+
+            self.logger=logger
+        
+        else:
+
+            self.logger=[]
+
+        # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* 
+
+
+        
+    def logger_or_printer(self,message,flag,event=None,values=None):
+
+        """
+        Function to switch between local logging or shell printing mode, according to the object initialization parameter log_me.
+        
+        Input:
+
+        message: The message (string) to be passed to the logger.
+
+        flag: Parameter (string) which corresponds to the user defined severity (logging level) for the msg input.
+
+        event: (string): The event type of the message for the structured log.
+
+        values: (dictionary): Numeric values of the event for the structured log.
+
+
+
+        Note that this method is designed to log only messages which correspond to the oblect parameted "log_level" and the flag input.
+
+        For example, if flag='debug' and theu ser has initialised the module with log_level='info', the logger will not log anything.log
+
+        But if flag='info', the message will be logged.
+        
+        """
+        
+        lvl=self.log_level
+
+        extra={'ghost_event':event,'ghost_values':values,'ghost_iteration':self.iteration}
+
+        if self.log_me:   
+
+            if (lvl=='INFO') and (flag=='info'):
+                self.logger.info(message,extra=extra)
+            elif (lvl=='DEBUG') and (flag=='debug'):
+                self.logger.debug(message,extra=extra)
+            elif (lvl=='WARNING') and (flag=='warning'):
+                self.logger.warning(message,extra=extra)
+            elif (lvl=='ERROR') and (flag=='error'):
+                self.logger.error(message,extra=extra)
+            elif (lvl=='CRITICAL') and (flag=='critical'):
+                self.logger.critical(message,extra=extra)
+
+        else:
+
+            print('Attention:Local logging is suppresed: '+message)
+
+
+
+    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    @ghost_phase('logbook')
+    def elog_event(self,msg):
+        """
+        Method to push an event to the elogbook.
+        """
+
+        self.elog.create_event(msg)
+
+
+
+    @ghost_span()
+    def write_L3_log(self,msg,where,logfile_lvl='info',event=None,values=None):
+        """
+        
+        Log messages to local logfile, logbook or both.
+
+        Input:
+
+        msg: (string): Them essage to be logged.logfile_lvl
+
+        where: (string): The location for the logging ('logbook', 'logfile' or 'both logs')
+
+        logfile_lvl : (string): The level for the logging. (see logger_or_printer() for more info)
+
+        event, values: The event type (string) and the numeric values (dictionary) of the message for the structured log.
+
+        Note that logging operations are controlled form the iniatialisation of the object with the parameters
+
+        no_elog_write (for the logbook) and log_me (for the local logging).
+
+
+        """
+        my_str=('Wrong input to log function. Choose where to log the message between' +
+            '"logfile" for local logging,"logbook" for logging in the OP logbook or both with "both logs".')
+            
+        
+        assert where in ['logfile','logbook','both logs'], my_str
+
+        if self.status is not None:
+            self.status.message(msg,event,values,self.iteration) # Only the messages with an event type.
+
+        if where=='logfile':
+            
+            self.logger_or_printer(message=msg,flag=logfile_lvl,event=event,values=values) 
+
+        elif where=='logbook':
+
+            if not self.no_elog_write: 
+                msg=(msg+' [GHOST: {}]').format(self.mod_name)
+                self.elog_event(msg)
+
+        else:
+
+            self.logger_or_printer(message=msg,flag=logfile_lvl,event=event,values=values)
+
+            if not self.no_elog_write:
+                msg=(msg+' [GHOST: {}]').format(self.mod_name)
+                self.elog_event(msg)
+
+    # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    @ghost_phase('start')
+    def start_module(self):
+
+
+        """
+        Method to initialize PyJAPC and the loggers.
+
+        With a heartbeat (see ghost_watchdog.Watchdog), the stacks of all the threads are dumped to stack_dump_file on SIGUSR1 
+        or on a fatal error, and the unfinished iteration of a previous run is rolled back (see recover_journal()).
+
+        """
+
+        global logger,japc,elog
+
+
+        self.initiate_logger()   
+
+        if self.stack_dump_file is not None:
+
+            self.stack_dump=open(self.stack_dump_file,'a')
+
+            faulthandler.enable(file=self.stack_dump,all_threads=True)
+            faulthandler.register(signal.SIGUSR1,file=self.stack_dump,all_threads=True)
+
+        self.initiate_JAPC()# Change pseudo_set to False to escape simulation mode for SET action
+
+        self.initiate_schema()
+
+        if self.heartbeat is not None and self.japc_replay is None:
+            self.recover_journal()
+       
+        if self.japc_replay is None:
+            self.initiate_elogbook() # which_ebook: LINAC 3  
+
+
+        if self.status_server is not None:
+
+            msg='Status endpoint of the module: http://{0}:{1}/status (events: /events).'.format(
+                self.status_server.httpd.server_address[0],self.status_server.port)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+        if self.simulate_SET:
+
+            msg=('******Initiating {} module in Simulation Mode.' +
+            'No SET operations will be performed******').format(self.mod_name)
+
+        else:
+
+            msg='******Initiating {} module.******'.format(self.mod_name)
+
+        
+        self.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+
+     
+       
+    @ghost_span()
+    def initiate_schema(self,refresh=False,deadline=5.0):
+        """
+        Initialisation of the FESA schema registry (self.schema) for the GHOSTconfig property of the module and the properties
+        in schema_properties.
+
+        The registry is loaded from the cache file schema_cache. The FEC is introspected (see FESASchema.introspect()) only if the
+        cache is missing, outdated or refresh is True, and the result is saved to the cache file.
+
+        The GET of the values of a property is given deadline seconds, outside the circuit breaker: A property which cannot be
+        read without selector (PPM) is only known by its names, without delaying the start of the module.
+
+        """
+
+        if isinstance(self.japc,JAPCReplayer) and self.japc.schema is not None:
+
+            self.schema=FESASchema.from_cache(self.japc.schema)
+
+            return
+
+        if not refresh:
+
+            self.schema=FESASchema.load(self.schema_cache,self.schema_properties,self.schema_max_age,now=self.clock.time())
+
+            if self.schema is not None:
+                self.record_schema()
+                return
+
+        # The introspection is not part of a recorded session: The registry itself is stored in the trace.
+        japc=self.japc.japc if isinstance(self.japc,JAPCRecorder) else self.japc
+
+        def get_info(prop):
+
+            return self.fec_call(japc.getParamInfo,prop,description='GET info of '+prop,deadline=None)
+
+        def get_values(prop):
+
+            japc.setSelector(None)
+
+            try:
+
+                return self.fec_call(japc.getParam,prop,description='GET '+prop,deadline=deadline,breaker=False)
+
+            except FECTimeoutError:
+
+                return None # Only the names are known for properties which cannot be read without selector.
+
+        self.schema=FESASchema.introspect(self.schema_properties,get_info,get_values,now=self.clock.time())
+
+        msg='FESA schema registry built for {}.'.format(', '.join(self.schema_properties))
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+        self.record_schema()
+
+        try:
+
+            self.schema.save(self.schema_cache)
+
+        except OSError:
+
+            msg='Unable to write the FESA schema cache file {}.'.format(self.schema_cache)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+
+
+    def record_schema(self):
+        """
+        Method to store the FESA schema registry in the JAPC trace, when the session is recorded.
+        """
+
+        if isinstance(self.japc,JAPCRecorder):
+            self.japc.record_schema(self.schema.to_cache())
+
+
+
+    def FESA_param_field(self,param_request):
+        """
+        Method to get the typed accessor (FESAField) of a dedicated FESA parameter of the module (see get_FESA_param() for param_request).
+
+        """
+
+        return self.schema.field(self.FESA_GHOST_Device+'/'+self.FESA_GHOST_Property,self.mod_name+'_'+param_request)
+
+
+
+    def sleep(self,seconds):
+        """
+        Method for all the waits of GHOST, with the clock of the module (self.clock). The module is alive: a heartbeat is 
+        published (see beat()).
+        """
+
+        self.clock.sleep(seconds)
+
+        self.beat()
+
+
+
+    def enter_phase(self,phase):
+        """
+        Method to change the phase of the module ('start', 'run', 'wait', 'measure', 'set', ...), published with the heartbeat.
+        The watchdog gives a time budget to each phase (see ghost_watchdog.PHASE_BUDGETS).
+
+        Output: The previous phase.
+        """
+
+        previous=self.phase
+
+        self.phase=phase
+
+        if self.heartbeat is not None:
+            self.heartbeat.enter(phase,self.iteration)
+
+        if self.status is not None:
+            self.status.phase(phase,self.iteration)
+
+        return previous
+
+
+
+    def japc_priority(self):
+        """
+        Method telling if the current JAPC request has priority in the rate limiter (see ghost_ratelimit.JAPCLimiter): the kill
+        checks, the rollbacks and the exit of the module.
+        """
+
+        return self.kill_check or self.phase in ('rollback','exit')
+
+
+
+    def report_limiter(self):
+        """
+        Method to log the requests delayed by the JAPC rate limiter since the last report (none if no request was delayed).
+        """
+
+        stats=self.limiter.stats().values()
+
+        totals={key:sum(item[key] for item in stats) for key in self.limiter_seen}
+
+        delayed=totals['Delayed']-self.limiter_seen['Delayed']
+
+        if delayed>0:
+
+            requests=totals['Requests']-self.limiter_seen['Requests']
+            wait=totals['Wait_total']-self.limiter_seen['Wait_total']
+
+            msg='JAPC rate limiter: {0} of {1} requests delayed by {2} seconds in total.'.format(delayed,requests,"%.1f"%wait)
+
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='rate_limit',
+                              values={'Delayed':delayed,'Requests':requests,'Wait':wait})
+
+        self.limiter_seen=totals
+
+
+
+    def beat(self):
+
+        if self.heartbeat is not None:
+            self.heartbeat.beat(self.iteration)
+
+
+
+    def span(self,name,**args):
+        """
+        Method for a named span of the trace (see ghost_trace.Tracer) around a block of a module: with myGT.span('name'): ...
+        The keyword arguments are the arguments of the span. With tracing off, a shared empty context is returned.
+        """
+
+        if self.tracer is None:
+            return NULL_SPAN
+
+        return self.tracer.span(name,'module',args or None)
+
+
+
+    def trace_mark(self,name,**args):
+        """
+        Method to start the phase name of the trace of a long method (e.g. the run() of a module): The span of the previous mark
+        ends here. The marks of an iteration end with the iteration (see begin_iteration()).
+        """
+
+        if self.tracer is not None:
+            self.tracer.mark(name,args=args or None)
+
+
+
+    def japc_idle(self):
+        """
+        Method called while waiting for subscription data. In replay mode the next callback of the trace is delivered.
+        """
+
+        # No heartbeat: A subscription without data is detected by the budget of the phase.
+
+        if isinstance(self.japc,JAPCReplayer):
+            self.japc.pump()
+            self.clock.sleep(self.japc.time-self.clock.time()) # The acquisition took this time during the recording.
+        else:
+            self.clock.sleep(0.005)
+
+
+
+    def japc_time(self):
+        """
+        Method to get the current time (POSIX) on the time base of the JAPC time-stamps: The clock of the module, or the recording
+        time of the last replayed operation in replay mode.
+        """
+
+        if isinstance(self.japc,JAPCReplayer):
+            return self.japc.time
+
+        return self.clock.time()
+
+
+
+    @staticmethod
+    def header_time(headerInfo,stamp_field='cycleStamp'):
+        """
+        The time-stamp (POSIX) of a subscription update from its header: stamp_field ('cycleStamp' or 'acqStamp'), or the other
+        one if it is missing. None if the header has no time-stamp.
+        """
+
+        for key in (stamp_field,'acqStamp','cycleStamp'):
+
+            stamp=headerInfo.get(key)
+
+            if stamp is None:
+                continue
+
+            if isinstance(stamp,datetime.datetime):
+                return stamp.timestamp()
+
+            return float(stamp)
+
+        return None
+
+
+
+    def string_found(self,string1, string2):
+        
+       if re.search(r"\b" + re.escape(string1) + r"\b", string2):
+          return True
+       return False 
+
+
+    @ghost_span(fields=('description',))
+    def fec_call(self,func,*args,description='',deadline='policy',validate=None,breaker=True,**kwargs):
+        """
+        Method to execute a JAPC operation (e.g. self.japc.getParam) with the retry policy of the module (self.retry_policy).
+
+        Input:
+
+        func: The callable to be executed with the positional arguments *args and the keyword arguments **kwargs.
+
+        description: (string): Short description of the operation for the log messages.
+
+        deadline: (float): The total time (in seconds) given to the operation. By default the deadline of the retry policy is used.
+                           None means that the operation is retried until it succeeds.
+
+        validate: A callable which receives the result of func and returns False if the result is not acceptable (e.g. NaN values).
+                  Invalid results are retried with the same backoff, but they do not count for the circuit breaker.
+
+        breaker: (bool): False for the operations whose failures do not tell about the health of the FEC (e.g. the introspection
+                 GETs of the FESA schema): They neither count for the circuit breaker nor wait for it.
+
+        Output:
+
+        The result of func. FECTimeoutError is raised if the deadline is reached.
+
+        """
+
+        policy=self.retry_policy
+
+        if deadline=='policy':
+            deadline=policy.deadline
+
+        t_start=self.clock.monotonic()
+        attempt=0
+
+        while True:
+
+            if breaker and policy.is_open():
+                self.wait_for_FEC(t_start,deadline,description)
+
+            try:
+
+                result=func(*args,**kwargs)
+
+            except Exception as err:
+
+                if breaker:
+                    policy.record_failure()
+
+                reason='{}: {}'.format(type(err).__name__,err)
+                error=err
+
+            else:
+
+                if breaker:
+                    policy.record_success()
+
+                if validate is None or validate(result):
+                    return result
+
+                reason='Invalid value received ({}).'.format(result)
+                error=None
+
+            delay=policy.backoff(attempt)
+            attempt+=1
+
+            if deadline is not None and self.clock.monotonic()-t_start+delay>deadline:
+
+                msg='Giving up {0} after {1} attempts ({2}).'.format(description,attempt,reason)
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                raise FECTimeoutError(msg) from error
+
+            if not (breaker and policy.is_open()):
+
+                msg='Attempt {0} of {1} failed ({2}). Retrying in {3} seconds.'.format(attempt,description,reason,"%.1f"%delay)
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='retry',values={'Attempt':attempt,'Delay':delay})
+
+                self.sleep(delay)
+
+
+
+    def wait_for_FEC(self,t_start,deadline,description=''):
+        """
+        Method to wait, while the circuit breaker of the retry policy is open, until the FEC answers again.
+
+        The FEC is probed with a GET of the module kill flag, which is a single scalar, every probe_interval seconds.
+
+        Input:
+
+        t_start: (float): The monotonic time at which the operation started.
+
+        deadline: (float): The total time (in seconds) given to the operation (None for no deadline).
+
+        description: (string): Short description of the operation for the log messages.
+
+        """
+
+        policy=self.retry_policy
+
+        my_probe=self.FESA_GHOST_Device+'/'+self.FESA_GHOST_Property+'#'+self.mod_name+'_kill'
+
+        msg=('There seems to be a problem communicating with the FEC ({0} consecutive failures).' + 
+            ' Probing the FEC every {1} seconds before {2}.').format(policy.failures,policy.probe_interval,description)
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+        while True:
+
+            try:
+
+                self.japc.getParam(my_probe)
+
+            except Exception:
+
+                if deadline is not None and self.clock.monotonic()-t_start+policy.probe_interval>deadline:
+
+                    msg='Giving up {}: The FEC does not answer.'.format(description)
+                    self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                    raise FECTimeoutError(msg)
+
+                self.sleep(policy.probe_interval)
+
+            else:
+
+                policy.half_open()
+
+                msg='The FEC answers again. Resuming {}.'.format(description)
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+                return
+
+
+
+    @ghost_span()
+    def get_FESA_param(self,param_request):
+        
+        """
+        Method to get the values of the dedicated FESA parameters that control each module, via the GET method of pyjapc module.
+
+        Input:
+
+        param_request:(string): The parameter to be fetched from FESA. Only the description part of each parameter is accepted in this parameter. 
+
+                                Each FESA parameter is named with the naming rule $Module_name+'_'+$parameter.
+
+                                For example, the kill flag of HTadjust is HTadjust_kill. In order to fetch the value of this parameter, param_request should be
+
+                                'kill' 
+
+        The name is validated with the FESA schema registry (see initiate_schema()).
+
+        The GET is retried with the retry policy of the module until the FEC answers (no deadline).
+        
+        """
+        
+        
+
+        my_field=self.FESA_GHOST_Device+'/'+self.FESA_GHOST_Property
+        
+        my_inquiry=my_field+'#'+self.mod_name+'_'+param_request
+
+        if not self.schema.has_field(my_inquiry):
+
+            self.initiate_schema(refresh=True) # The cached schema may be older than the FESA class.
+        
+        assert self.schema.has_field(my_inquiry),'Wrong name of FESA parameter: {}'.format(param_request)
+
+        return self.fec_call(self.japc.getParam,my_inquiry,description='GET '+my_inquiry,deadline=None)
+
+
+
+    def FESA_param_limits(self,param_request):
+        """
+        The FESA limits (low, high) of a parameter of the module (None where not defined).
+        """
+
+        my_field=self.FESA_GHOST_Device+'/'+self.FESA_GHOST_Property
+
+        try:
+            fld=self.schema.field(my_field,self.mod_name+'_'+param_request)
+        except KeyError:
+            return None,None
+
+        return fld.low,fld.high
+
+
+
+
+    @ghost_phase('measure')
+    def get_my_JAPC_parameter(self,device,field,parameter,my_selector=None,no_shots=10,subscribe_=1,basic_per=1.2,verbose=True,
+                              not_before=None,settle_time=0.0,settle_shots=0,settle_tol=0.05,stamp_field='cycleStamp'):
+        """
+        Method to get the values of any FESA parameter via the GET method of pyjapc module.
+
+        The inputs are:{
+
+        device: The device name in FESA
+
+        field:  The field name in FESA
+
+        parameter: The parameter name in FESA
+
+        my_selector: The PLS selector (Set None for non-ppm parameters)
+
+        no_shots: The number of shots that the variable is measured.
+
+        subscribe_: Logical flag for subscription (True) or not (False) to a parameter via PyJAPC
+
+        basic_per: In case of subscribe_=False for a parameter, manual measurement is enabled, which is periodical with period basic_per.
+
+        verbose: Flag to ctivate some additional information, while measuring a parameter.
+
+        not_before: Time (POSIX or datetime, e.g. last_set_time) before which the shots are not valid. With subscribe_, the updates
+        whose header time-stamp (stamp_field, 'cycleStamp' or 'acqStamp') is earlier than not_before+settle_time are discarded.
+        The first update is accepted if it is recent enough. None: Only the first update is discarded.
+
+        settle_time: Settling time in seconds after not_before.
+
+        settle_shots: Settle detector: The shots are counted only from the first settle_shots consecutive valid shots with a 
+        relative spread (max-min)/|mean| below settle_tol. 0 for no settle detector.
+
+        settle_tol: The relative spread of the settle detector.
+
+        stamp_field: The time-stamp of the header which is compared with not_before.
+
+        }
+
+        The outputs are:{
+
+        A dictionary with the keys 'Values'-> the vector of the measurements of length no_shots,
+        'Mean'-> The average value of the 'Values' vector, 'Sigma'->The standard deviation of the 'Values' vector.
+
+        }
+
+        Normally the pyjapc module GET function is called to interact with 
+        the parameter device/field#parameter (based on the JAPC rules)
+
+        """
+        
+        my_constructor=device+'/'+field+'#'+parameter
+        
+        global ind_
+        
+        
+        if subscribe_:
+        
+            param=[]
+            ind_=1
+
+            valid_after=None
+            if not_before is not None:
+                valid_after=(not_before.timestamp() if isinstance(not_before,datetime.datetime) else not_before)+settle_time
+
+            settling=[] # Window of the settle detector
+            settle_state=[bool(settle_shots)] # True while the signal is settling
+            discarded=[0]
+
+            def accept_value(parameterName,newValue):
+
+                global ind_
+
+                param.append(newValue)
+                msg="({0}) Measured value for {1} is: {2}".format(ind_,parameterName, "%.3f"%newValue)
+                if verbose:
+                    self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                ind_+=1
+            
+            def newValueCallback(parameterName, newValue, headerInfo):
+
+                """
+                Call-back function to subscribe to the parameter parameterName. 
+                The output is the newValue value of the parameter. This function
+                is called through pyjapc for the number of shots that the user
+                has defined (no_shots)
+
+                """
+                
+                
+                global ind_
+
+                if valid_after is None:
+                    valid=not headerInfo['isFirstUpdate']
+                else:
+                    stamp=self.header_time(headerInfo,stamp_field)
+                    valid=(not headerInfo['isFirstUpdate']) if stamp is None else stamp>=valid_after
+
+                if not valid:
+                    discarded[0]+=1
+                    return
+
+                if settle_state[0]:
+
+                    settling.append(newValue)
+
+                    if len(settling)>settle_shots:
+                        settling.pop(0)
+                        discarded[0]+=1
+
+                    window=np.asarray(settling,dtype=float)
+
+                    if len(window)<settle_shots or not np.ptp(window)<=settle_tol*abs(np.mean(window)):
+                        return
+
+                    # Settled: The shots of the window are the first valid shots.
+                    for value in window:
+                        accept_value(parameterName,value)
+
+                    settling[:]=[]
+                    settle_state[0]=False
+
+                    return
+
+                accept_value(parameterName,newValue)
+
+            self.japc.setSelector(my_selector)
+            msg=my_constructor+' measurement: Assigning selector-> '+str(my_selector)+'.'
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+            self.fec_call(self.japc.subscribeParam,my_constructor,newValueCallback,getHeader=True,
+                description='subscription to '+my_constructor)
+            self.fec_call(self.japc.startSubscriptions,parameterName=my_constructor,description='subscription to '+my_constructor)
+
+            while ind_<=no_shots:
+
+                self.japc_idle()
+
+            # Only this subscription: The long-lived subscriptions (see start_buffered_subscription()) keep running.
+            self.japc.stopSubscriptions(parameterName=my_constructor)
+            self.japc.clearSubscriptions(parameterName=my_constructor)
+
+            if discarded[0] and valid_after is not None:
+                msg='{0} updates of {1} discarded (before the SET or settling).'.format(discarded[0],my_constructor)
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='shots_discarded',
+                    values={'Discarded':discarded[0]})
+
+            param=param[:no_shots]
+
+
+            
+        else:
+            
+            param=[]
+            ind_=1
+            # msg="Manual JAPC Measurement Mode: Waiting for "+str(basic_per)+" seconds for each measurement."
+            # cmn.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',print_me=False)
+            
+            self.japc.setSelector(my_selector)
+            msg=my_constructor+' measurement: Assigning selector-> '+str(my_selector)+'.'
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            
+            for k in range(no_shots):
+                newValue=self.fec_call(self.japc.getParam,my_constructor,description='GET '+my_constructor)
+                param.append(newValue)
+                msg="({0}) Measured value for {1} is: {2}".format(ind_,my_constructor, "%.3f"%newValue)
+                if verbose:
+                    self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+                self.sleep(basic_per)
+                ind_+=1
+        
+        
+        return {'Values':param,'Mean':np.mean(param),'Sigma':np.std(param)}
+
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    @ghost_phase('subscribe')
+    def start_buffered_subscription(self,device,field,parameter,my_selector=None,size=1024,convert=None):
+        """
+        Method to start a long-lived subscription to device/field#parameter, which feeds a ring buffer (ShotBuffer) until
+        stop_buffered_subscription(). A measurement is then take_shots(), without the set-up of a subscription and without
+        the loss of its first update.
+
+        Input:
+
+        device, field, parameter: The FESA parameter.
+
+        my_selector: The PLS selector of the subscription.
+
+        size: The number of updates kept in the ring buffer.
+
+        convert: Function applied to each update before it is buffered (e.g. the code of an enum value). None: no conversion.
+
+        Output:
+
+        The constructor device/field#parameter, which identifies the subscription. A running subscription is reused.
+
+        """
+
+        my_constructor=device+'/'+field+'#'+parameter
+
+        if my_constructor in self.shot_buffers:
+            return my_constructor
+
+        buffer_=ShotBuffer(size)
+
+        def bufferCallback(parameterName,newValue,headerInfo):
+
+            value=newValue if convert is None else convert(newValue)
+
+            buffer_.append(value,self.header_time(headerInfo),headerInfo.get('isFirstUpdate',False))
+
+        msg=my_constructor+' long-lived subscription: Assigning selector-> '+str(my_selector)+'.'
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+        self.fec_call(self.japc.subscribeParam,my_constructor,bufferCallback,getHeader=True,timingSelector=my_selector,
+            description='subscription to '+my_constructor)
+        self.fec_call(self.japc.startSubscriptions,parameterName=my_constructor,description='subscription to '+my_constructor)
+
+        self.shot_buffers[my_constructor]=buffer_
+
+        return my_constructor
+
+
+
+    @ghost_span()
+    def stop_buffered_subscription(self,my_constructor=None):
+        """
+        Method to stop a long-lived subscription (all of them if my_constructor is None). Stopped subscriptions are ignored.
+        """
+
+        names=list(self.shot_buffers) if my_constructor is None else [my_constructor]
+
+        for name in names:
+
+            if self.shot_buffers.pop(name,None) is None:
+                continue
+
+            self.japc.stopSubscriptions(parameterName=name)
+            self.japc.clearSubscriptions(parameterName=name)
+
+            msg=name+' long-lived subscription stopped.'
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+
+
+    @staticmethod
+    def settled_index(values,settle_shots,settle_tol):
+        """
+        The index of the first window of settle_shots consecutive values with a relative spread (max-min)/|mean| below 
+        settle_tol (None if the values did not settle yet).
+        """
+
+        values=np.asarray(values,dtype=float)
+
+        if len(values)<settle_shots:
+            return None
+
+        windows=np.lib.stride_tricks.sliding_window_view(values,settle_shots)
+
+        settled=np.flatnonzero(np.ptp(windows,axis=1)<=settle_tol*np.abs(np.mean(windows,axis=1)))
+
+        return int(settled[0]) if settled.size else None
+
+
+
+    @ghost_phase('measure')
+    def take_shots(self,my_constructor,no_shots=10,not_before=None,settle_time=0.0,settle_shots=0,settle_tol=0.05,verbose=True,
+                   after=None):
+        """
+        Method to measure no_shots updates of a long-lived subscription (see start_buffered_subscription()).
+
+        Without not_before, the next no_shots updates after the call are measured. With not_before (e.g. last_set_time), the
+        updates already in the buffer whose time-stamp is later than not_before+settle_time are used first, so that the shots
+        which arrived since a SET are not lost. The settle detector (settle_shots, settle_tol) is the same as for
+        get_my_JAPC_parameter().
+
+        after (e.g. the 'Last' of the previous measurement) is the sequence number of the last update already measured: only the
+        later updates are used, so that two consecutive measurements (e.g. two rounds after the same SET) never share a shot.
+
+        Output:
+
+        A dictionary with the keys 'Values', 'Mean' and 'Sigma', as for get_my_JAPC_parameter(), 'Stamps' (the time-stamps of
+        the measured updates) and 'Last' (the sequence number of the last measured update).
+
+        """
+
+        buffer_=self.shot_buffers[my_constructor]
+
+        valid_after=None
+        if not_before is not None:
+            valid_after=(not_before.timestamp() if isinstance(not_before,datetime.datetime) else not_before)+settle_time
+
+        if after is not None:
+            start=after+1
+        else:
+            start=buffer_.count if valid_after is None else 0
+
+        while True:
+
+            values,stamps,first,base=buffer_.since(start)
+
+            if valid_after is None:
+                valid=~first
+            else:
+                valid=np.where(np.isnan(stamps),~first,stamps>=valid_after)
+
+            taken=np.flatnonzero(valid) # Positions of the valid updates
+
+            if settle_shots:
+
+                ind=self.settled_index(values[taken],settle_shots,settle_tol)
+
+                taken=taken[ind:] if ind is not None else taken[:0]
+
+            if len(taken)>=no_shots:
+                break
+
+            self.japc_idle()
+
+        taken=taken[:no_shots]
+
+        param=values[taken].tolist()
+
+        discarded=int(taken[-1])+1-no_shots if no_shots else 0 # Updates before and between the measured ones
+
+        if verbose and discarded and valid_after is not None:
+            msg='{0} updates of {1} discarded (before the SET or settling).'.format(discarded,my_constructor)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='shots_discarded',
+                values={'Discarded':discarded})
+
+        if verbose:
+
+            for ind,value in enumerate(param):
+
+                msg="({0}) Measured value for {1} is: {2}".format(ind+1,my_constructor,"%.3f"%value)
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+        last=base+int(taken[-1]) if no_shots else (after if after is not None else base-1)
+
+        return {'Values':param,'Mean':np.mean(param),'Sigma':np.std(param),'Stamps':stamps[taken].tolist(),'Last':last}
+
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def shot_statistics(self,values,estimator='mean',reject_cut=3.5,max_reject=0.2):
+        """
+        Method to compute the statistics of a series of shots (e.g. the 'Values' of get_my_JAPC_parameter()), optionally with a
+        robust estimator which rejects the outlier shots (missed pulses, glitches).
+
+        The outliers are the non-finite shots and the shots further than reject_cut robust standard deviations (1.4826*MAD)
+        from the median of the series.
+
+        Input:
+
+        values: (list or array): The measured values of the shots.
+
+        estimator: (string): 'mean' (mean and standard deviation of all the shots), 'median' (median and 1.4826*MAD of the
+        accepted shots) or 'trimmed' (mean and standard deviation of the accepted shots).
+
+        reject_cut: (float): The rejection threshold in robust standard deviations.
+
+        max_reject: (float): The maximum fraction of rejected shots. A series with more outliers is not a glitch but unstable
+        conditions: its 'Sigma' is set to inf.
+
+        Output:
+
+        A dictionary with the keys 'Values', 'Mean', 'Sigma', 'Rejected' (number of rejected shots) and 'Accepted' (boolean mask
+        of the accepted shots).
+
+        """
+
+        values=np.asarray(values,dtype=float)
+
+        if estimator=='mean':
+
+            return {'Values':values,'Mean':np.mean(values),'Sigma':np.std(values),'Rejected':0,
+                    'Accepted':np.ones(values.shape,dtype=bool)}
+
+        if estimator not in ('median','trimmed'):
+            raise ValueError('Unknown estimator {} (mean, median or trimmed).'.format(estimator))
+
+        finite=np.isfinite(values)
+
+        if not finite.any():
+
+            return {'Values':values,'Mean':np.nan,'Sigma':np.inf,'Rejected':values.size,'Accepted':finite}
+
+        median=np.median(values[finite])
+        scale=1.4826*np.median(np.abs(values[finite]-median))
+
+        # With a zero MAD (e.g. a constant signal with one glitch) only the shots equal to the median are accepted.
+        with np.errstate(invalid='ignore'):
+            accepted=finite&(np.abs(values-median)<=reject_cut*scale)
+
+        kept=values[accepted]
+
+        if estimator=='median':
+            mean,sigma=np.median(kept),1.4826*np.median(np.abs(kept-np.median(kept)))
+        else:
+            mean,sigma=np.mean(kept),np.std(kept)
+
+        rejected=int(values.size-accepted.sum())
+
+        if rejected>max_reject*values.size:
+            sigma=np.inf
+
+        return {'Values':values,'Mean':mean,'Sigma':sigma,'Rejected':rejected,'Accepted':accepted}
+
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    def pool_shot_statistics(self,rounds,ref_shots):
+        """
+        Method to pool several rounds of shot statistics (see shot_statistics()) with inverse-variance weighting.
+
+        The rounds are weighted with accepted_shots/Sigma**2. The pooled 'Sigma' is the standard error of the pooled mean scaled
+        to ref_shots shots, i.e. the standard deviation which a single round of ref_shots shots with the same precision would have.
+        Thus it can be compared with the stability criterion of a single round, which it reproduces for one round of ref_shots shots.
+
+        Input:
+
+        rounds: (list): The dictionaries of shot_statistics() of the rounds.
+
+        ref_shots: (int): The number of shots of the reference round of the stability criterion.
+
+        Output:
+
+        A dictionary with the keys 'Values', 'Mean', 'Sigma', 'Rejected' and 'Rounds' (number of pooled rounds).
+
+        """
+
+        means=np.array([np.mean(item['Mean']) for item in rounds],dtype=float)
+        sigmas=np.array([np.mean(item['Sigma']) for item in rounds],dtype=float)
+        shots=np.array([np.sum(item.get('Accepted',np.ones(np.size(item['Values']),dtype=bool))) for item in rounds],dtype=float)
+
+        values=np.concatenate([np.asarray(item['Values'],dtype=float) for item in rounds])
+        rejected=int(sum(item.get('Rejected',0) for item in rounds))
+
+        usable=np.isfinite(means)&np.isfinite(sigmas)&(shots>0)
+
+        if not usable.any():
+
+            return {'Values':values,'Mean':np.nan,'Sigma':np.inf,'Rejected':rejected,'Rounds':len(rounds)}
+
+        # A round without spread would get an infinite weight.
+        floor=(1e-9*np.max(np.abs(means[usable])))**2+np.finfo(float).tiny
+
+        weights=np.where(usable,shots/np.maximum(sigmas**2,floor),0.0)
+
+        mean=np.sum(weights*np.where(usable,means,0.0))/np.sum(weights)
+        sigma=np.sqrt(ref_shots/np.sum(weights))
+
+        return {'Values':values,'Mean':mean,'Sigma':sigma,'Rejected':rejected,'Rounds':len(rounds)}
+
+
+
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* # 
+    
+
+    @ghost_span()
+    def get_property_template(self,device,field,my_selector,refresh=False):
+        """
+        Method to get the cached template of the FESA property device/field for the SET operations.
+
+        The template is the dictionary of the property, as returned from the GET method of pyjapc, without the '_min' and '_max' keys.
+        It is fetched from the FEC only when it is not cached, when it is older than template_max_age seconds or when refresh is True.
+
+        Input:
+
+        device: The device name in FESA
+
+        field:  The field name in FESA
+
+        my_selector: The PLS selector (Set None for non-ppm parameters)
+
+        refresh: (boolean): Flag to force a GET of the property.
+
+        Output:
+
+        The template dictionary and a flag which is True if the template was fetched from the FEC.
+
+        """
+
+        my_constructor=device+'/'+field
+
+        key=(my_constructor,my_selector)
+
+        cached=self.property_templates.get(key)
+
+        if (not refresh) and (cached is not None) and (self.clock.monotonic()-cached['Time']<=self.template_max_age):
+
+            return cached['Values'],False
+
+        self.japc.setSelector(my_selector)
+        dic_FESA=self.fec_call(self.japc.getParam,my_constructor,description='GET '+my_constructor)
+
+        template={key_:item for key_,item in dic_FESA.items() if not (('_min' in key_ ) or ('_max' in key_))}
+
+        self.property_templates[key]={'Time':self.clock.monotonic(),'Values':template}
+
+        return template,True
+
+
+
+    @ghost_phase('set')
+    def set_my_JAPC_parameters(self,device,field,values,my_selector,lim_l,lim_r,verify_tol=None):
+        
+        """
+        Method to set several fields of one FESA property with a single SET of the pyjapc module.
+        
+        The inputs are:
+        
+        {
+        
+        device: The device name in FESA
+        
+        field:  The field name in FESA
+        
+        values: Dictionary with the parameter names in FESA as keys and the new values to be set as items.
+        
+        lim_l, lim_r: The lower and upper limits of the values to be set. Either a single value for all the parameters or a dictionary
+        with the same keys as values. If any of the values is outside its range, the SET action is aborted and all the parameters
+        retain their initial values.
+
+        my_selector: The PLS selector (Set None for non-ppm parameters)
+        
+        }
+
+        The property is written on top of its cached template (see get_property_template()). If a parameter is missing from the template
+        or the SET with the cached template fails, the template is refreshed and the SET is repeated.
+
+        Note that fields of the property which are changed by another client are overwritten with their cached value, 
+        unless the template is older than template_max_age seconds. The template is always read from the FEC for the first
+        SET of the property in an iteration (see begin_iteration()) and for a roll-back, so that the values before the
+        iteration in the SET journal are the true ones.
+
+        Each SET is recorded in the SET journal (see journal_SET()). If verify_tol (or the object parameter verify_tol) is not None,
+        the values are read back and confirmed within this tolerance (see verify_SET()).
+
+        Output:
+
+        True if the SET was performed, False if it was aborted because of the limits. ValueError is raised if the SET fails.
+        
+        """
+                
+        my_constructor=device+'/'+field
+
+        names=list(values.keys())
+
+        my_values=np.array([float(values[name]) for name in names])
+
+        if isinstance(lim_l,dict):
+            lim_l=[lim_l[name] for name in names]
+        if isinstance(lim_r,dict):
+            lim_r=[lim_r[name] for name in names]
+
+        low=np.broadcast_to(np.asarray(lim_l,dtype=float),my_values.shape)
+        high=np.broadcast_to(np.asarray(lim_r,dtype=float),my_values.shape)
+
+        outside=~((my_values>=low) & (my_values<=high))
+
+        if outside.any():
+
+            for ind in np.flatnonzero(outside):
+
+                msg=('Given value to SET is outside safe operating range (Limit->' +
+                    '[{0},{1}]. Aborting SET operation for {2}.').format(low[ind],high[ind],my_constructor+'#'+names[ind])
+                
+                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            
+            return False
+
+        key=(my_constructor,my_selector)
+
+        refresh=self.rolling_back or (self.iteration_open and key not in self.iteration_templates)
+
+        template,fresh=self.get_property_template(device,field,my_selector,refresh=refresh)
+
+        if self.iteration_open:
+            self.iteration_templates.add(key)
+
+        if not set(names).issubset(template) and not fresh:
+            template,fresh=self.get_property_template(device,field,my_selector,refresh=True)
+
+        my_str=', '.join(my_constructor+'#'+name for name in names)
+
+        if not set(names).issubset(template):
+
+            msg='Unable to set {}: Unknown parameter for the FESA property.'.format(my_str)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+            raise ValueError(msg)
+
+        dic_FESA=dict(template)
+        dic_FESA.update(zip(names,my_values.tolist()))
+
+        try:
+
+            self.japc.setSelector(my_selector)
+
+            if fresh:
+
+                self.fec_call(self.japc.setParam,my_constructor,dic_FESA,description='SET '+my_constructor)
+
+            else:
+
+                try:
+
+                    self.japc.setParam(my_constructor,dic_FESA)
+
+                except Exception:
+
+                    # The cached template does not match the property anymore: Refresh it and repeat.
+
+                    template,fresh=self.get_property_template(device,field,my_selector,refresh=True)
+                    dic_FESA=dict(template)
+                    dic_FESA.update(zip(names,my_values.tolist()))
+
+                    self.japc.setSelector(my_selector)
+                    self.fec_call(self.japc.setParam,my_constructor,dic_FESA,description='SET '+my_constructor)
+
+        except Exception:
+
+            msg='Unable to set {0} to value(s) {1}.'.format(my_str,my_values.tolist())
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            
+            raise ValueError(msg)
+
+        self.last_set_time=self.japc_time() # Acquisitions which have to follow the SET (see get_my_JAPC_parameter())
+
+        previous=[template.get(name) for name in names]
+        template_before=dict(zip(names,previous))
+
+        template.update(zip(names,my_values.tolist()))
+
+        for name,val in zip(names,my_values.tolist()):
+
+            msg='Setting '+my_constructor+'#'+name+' parameter to value '+str(val)+'.'
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='SET '+my_constructor+'#'+name,
+                values={'Previous':template_before.get(name),'New':val})
+
+        entries=[self.journal_SET(device,field,name,my_selector,prev,val) 
+                 for name,prev,val in zip(names,previous,my_values.tolist())]
+
+        if verify_tol is None:
+            verify_tol=self.verify_tol
+
+        if (verify_tol is not None) and (not self.simulate_SET):
+            self.verify_SET(device,field,my_selector,entries,verify_tol)
+        
+        return True
+
+
+
+    @ghost_span(fields=('parameter',))
+    def set_my_JAPC_parameter(self,device,field,parameter,my_selector,val_to_set,lim_l,lim_r):
+        
+        """
+        Method to set the values of any FESA parameter via the SET method of pyjapc module.
+        
+        The inputs are:
+        
+        {
+        
+        device: The device name in FESA
+        
+        field:  The field name in FESA
+        
+        parameter: The parameter name in FESA
+        
+        val_to_set: The new value to be set for the parameter device/field#parameter.
+        
+        lim_l, lim_r: The lower and upper limits of the value to be set. If the val_to_set value is outside this range, the SET action
+        is aborted and the parameter retains its initial value.
+
+        my_selector: The PLS selector (Set None for non-ppm parameters)
+        
+        }
+        
+        
+        Normally the PyJAPC module SET function is called to interact with 
+        the parameter device/field#parameter. (the name construction follows the JAPC rules)
+
+        This is the single-field version of set_my_JAPC_parameters().
+        
+        """
+
+        return self.set_my_JAPC_parameters(device=device,field=field,values={parameter:val_to_set},
+            my_selector=my_selector,lim_l=lim_l,lim_r=lim_r)
+            
+
+# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
+
+
+    @ghost_span()
+    def write_journal(self,record):
+        """
+        Method to append a record (dictionary) to the SET journal file of the module (one JSON record per line).
+
+        The journal file is dir_logging+mod_name+'_SET_journal.jsonl' and it is written only if the object parameter journal_me is True.
+
+        """
+
+        if not self.journal_me:
+            return
+
+        with open(self.journal_file,'a') as journal_file:
+
+            journal_file.write(json.dumps(record,default=str)+'\n')
+
+
+
+    def rotate_journal(self):
+        """
+        Method to rotate the SET journal file when it is larger than journal_max_size bytes: It is renamed to
+        journal_file+'.1' (replacing the previous one) and a new file is started. Called by begin_iteration(), when the
+        records of the previous iterations are not needed anymore for the recovery (see recover_journal()).
+
+        """
+
+        if not self.journal_me:
+            return
+
+        try:
+
+            if os.path.getsize(self.journal_file)>self.journal_max_size:
+                os.replace(self.journal_file,self.journal_file+'.1')
+
+        except OSError:
+
+            pass # No journal yet.
+
+
+
+    def journal_tail(self,block=65536):
+        """
+        Method to read the records of the SET journal file from the last 'begin' record (all the records if there is none).
+        The file is read backwards by blocks of block bytes, so that only the tail is read.
+
+        """
+
+        with open(self.journal_file,'rb') as journal_file:
+
+            journal_file.seek(0,os.SEEK_END)
+
+            position=journal_file.tell()
+            data=b''
+
+            while True:
+
+                size=min(block,position)
+                position-=size
+
+                journal_file.seek(position)
+                data=journal_file.read(size)+data
+
+                lines=data.split(b'\n')
+
+                if position>0:
+                    lines=lines[1:] # The first line may be incomplete.
+
+                if position==0 or any(b'"Event": "begin"' in line for line in lines):
+                    break
+
+        records=[json.loads(line) for line in lines if line.strip()]
+
+        begins=[ind for ind,record in enumerate(records) if record.get('Event')=='begin']
+
+        return records[begins[-1]:] if begins else records
+
+
+
+    def journal_SET(self,device,field,parameter,my_selector,previous,new):
+        """
+        Method to record a SET operation in the in-memory (set_journal) and the on-disk SET journal.
+
+        Input:
+
+        device, field, parameter: The FESA device, field and parameter name of the SET.
+
+        my_selector: The PLS selector of the SET.
+
+        previous: The value of the parameter before the SET.
+
+        new: The value which was set.
+
+        Output:
+
+        The journal entry (dictionary).
+
+        """
+
+        entry={'Event':'SET','Timestamp':self.clock.now().isoformat(),'Module':self.mod_name,
+               'Iteration':self.iteration,'Device':device,'Field':field,'Parameter':parameter,
+               'Selector':my_selector,'Previous':previous,'New':new,'Rollback':self.rolling_back,'Verified':None}
+
+        self.set_journal.append(entry)
+
+        self.write_journal(entry)
+
+        if self.status is not None:
+            self.status.setpoint(device+'/'+field+'#'+parameter,new,previous)
+
+        return entry
+
+
+
+    @ghost_span()
+    def verify_SET(self,device,field,my_selector,entries,verify_tol):
+        """
+        Method to read back the property device/field and confirm the values of the journal entries within the tolerance verify_tol.
+
+        The 'Verified' key of each journal entry is updated. ValueError is raised if any of the values is not confirmed.
+
+        """
+
+        my_constructor=device+'/'+field
+
+        self.japc.setSelector(my_selector)
+        dic_FESA=self.fec_call(self.japc.getParam,my_constructor,description='readback of '+my_constructor)
+
+        readback=np.array([float(dic_FESA[entry['Parameter']]) for entry in entries])
+        expected=np.array([entry['New'] for entry in entries])
+
+        confirmed=np.abs(readback-expected)<=verify_tol
+
+        for entry,ok in zip(entries,confirmed.tolist()):
+
+            entry['Verified']=ok
+
+            self.write_journal({'Event':'verify','Timestamp':self.clock.now().isoformat(),
+                                'Iteration':self.iteration,'Parameter':my_constructor+'#'+entry['Parameter'],'Verified':ok})
+
+        if not confirmed.all():
+
+            msg=('SET of {0} not confirmed by the readback (read {1}, expected {2}, tolerance {3}).').format(
+                my_constructor,readback.tolist(),expected.tolist(),verify_tol)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+            raise ValueError(msg)
 
-        
-        self.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
 
-     
-       
-    def string_found(self,string1, string2):
-        
-       if re.search(r"\b" + re.escape(string1) + r"\b", string2):
-          return True
-       return False 
 
+    @ghost_span()
+    def recover_journal(self,max_age=600.0):
+        """
+        Method to roll back the unfinished iteration of a previous run of the module (e.g. after a restart by the watchdog),
+        from the SET journal on disk: The parameters of its SET operations are restored to their values before the iteration.
+        The numbering of the iterations continues from the journal. An iteration whose last record is older than max_age 
+        seconds is not rolled back (the operators may have changed the parameters since). Only the tail of the journal file
+        from the last 'begin' record is read (see journal_tail()).
 
-    def get_FESA_param(self,param_request):
-        
+        Output: The number of parameters which were restored.
         """
-        Method to get the values of the dedicated FESA parameters that control each module, via the GET method of pyjapc module.
 
-        Input:
+        if not self.journal_me:
+            return 0
 
-        param_request:(string): The parameter to be fetched from FESA. Only the description part of each parameter is accepted in this parameter. 
+        try:
 
-                                Each FESA parameter is named with the naming rule $Module_name+'_'+$parameter.
+            records=self.journal_tail()
 
-                                For example, the kill flag of HTadjust is HTadjust_kill. In order to fetch the value of this parameter, param_request should be
+        except (OSError,ValueError):
 
-                                'kill' 
-        
-        """
-        
-        
+            return 0
 
-        my_field=self.FESA_GHOST_Device+'/'+self.FESA_GHOST_Property
-        
-        my_list=self.japc.getParamInfo(my_field)
-        
-        my_inquiry=my_field+'#'+self.mod_name+'_'+param_request
-        
-        assert self.string_found(my_inquiry,my_list),'Wrong name of FESA parameter: {}'.format(param_request)
-        
-        my_param=[]
+        begins=[ind for ind,record in enumerate(records) if record.get('Event')=='begin']
 
-        while len(my_param)==0:
-            
+        if not begins:
+            return 0
 
-            try:
+        last=records[begins[-1]]
 
-                my_param=[self.japc.getParam(my_inquiry)]
+        self.iteration=max(self.iteration,last.get('Iteration',0))
 
-                
+        unfinished=records[begins[-1]+1:]
 
-            except:
+        if any(record.get('Event') in ('commit','rollback') for record in unfinished):
+            return 0
 
-                msg=("There seems to be a problem communicating with the FEC." + 
-                    " No GET action is possible. Rechecking in 5 minutes.").format(self.mod_name)
-                
-                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                
-                sleep(5*60)
+        age=(self.clock.now()-datetime.datetime.fromisoformat((unfinished or [last])[-1]['Timestamp'])).total_seconds()
 
-                
+        if age>max_age:
+
+            msg='Unfinished iteration {0} of the previous run is {1} seconds old. No recovery.'.format(self.iteration,int(age))
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
+            return 0
 
-        return my_param[0]
+        # Reconstruct the iteration in memory and roll it back.
+        self.set_journal=[record for record in unfinished if record.get('Event')=='SET']
+        self.iteration_start=0
+        self.iteration_open=True
 
+        msg='Recovering the unfinished iteration {0} of the previous run of {1} module ({2} SET operations).'.format(
+            self.iteration,self.mod_name,len(self.set_journal))
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='recovery',
+            values={'Iteration':self.iteration,'SETs':len(self.set_journal)})
 
+        return self.rollback_iteration(reason='Recovery after a restart of the module.')
 
 
 
-    def get_my_JAPC_parameter(self,device,field,parameter,my_selector=None,no_shots=10,subscribe_=1,basic_per=1.2,verbose=True):
+    def begin_iteration(self):
         """
-        Method to get the values of any FESA parameter via the GET method of pyjapc module.
+        Method to open a new iteration of the module. All the SET operations until commit_iteration() can be undone with rollback_iteration().
 
-        The inputs are:{
+        The journal of the previous iterations is dropped from memory and the journal file is rotated if it is too large (see
+        rotate_journal()).
 
-        device: The device name in FESA
+        """
 
-        field:  The field name in FESA
+        if self.limiter is not None:
+            self.report_limiter()
 
-        parameter: The parameter name in FESA
+        self.iteration+=1
+        self.iteration_open=True
 
-        my_selector: The PLS selector (Set None for non-ppm parameters)
+        # The SET operations of the previous iterations cannot be rolled back anymore.
+        self.set_journal=[]
+        self.iteration_start=0
+        self.iteration_templates=set()
 
-        no_shots: The number of shots that the variable is measured.
+        self.rotate_journal()
 
-        subscribe_: Logical flag for subscription (True) or not (False) to a parameter via PyJAPC
+        if self.tracer is not None:
 
-        basic_per: In case of subscribe_=False for a parameter, manual measurement is enabled, which is periodical with period basic_per.
+            # One span per iteration, from its start to the start of the next one.
+            self.tracer.end_until('iteration')
+            self.tracer.iteration(self.iteration)
+            self.tracer.begin('iteration','iteration',{'Iteration':self.iteration})
 
-        verbose: Flag to ctivate some additional information, while measuring a parameter.
+        self.write_journal({'Event':'begin','Timestamp':self.clock.now().isoformat(),
+                            'Module':self.mod_name,'Iteration':self.iteration})
 
-        }
 
-        The outputs are:{
 
-        A dictionary with the keys 'Values'-> the vector of the measurements of length no_shots,
-        'Mean'-> The average value of the 'Values' vector, 'Sigma'->The standard deviation of the 'Values' vector.
+    def commit_iteration(self):
+        """
+        Method to close the current iteration of the module. Its SET operations are kept and they are not rolled back anymore.
 
-        }
+        """
 
-        Normally the pyjapc module GET function is called to interact with 
-        the parameter device/field#parameter (based on the JAPC rules)
+        self.iteration_open=False
+        self.iteration_start=len(self.set_journal)
 
+        self.write_journal({'Event':'commit','Timestamp':self.clock.now().isoformat(),
+                            'Module':self.mod_name,'Iteration':self.iteration})
+
+
+
+    @ghost_phase('rollback')
+    def rollback_iteration(self,reason=''):
         """
-        
-        my_constructor=device+'/'+field+'#'+parameter
-        
-        global ind_
-        
-        
-        if subscribe_:
-        
-            param=[]
-            ind_=1
-            
-            def newValueCallback(parameterName, newValue, headerInfo):
+        Method to restore all the parameters changed in the current iteration to their values before the iteration.
 
-                """
-                Call-back function to subscribe to the parameter parameterName. 
-                The output is the newValue value of the parameter. This function
-                is called through pyjapc for the number of shots that the user
-                has defined (no_shots)
+        The SET operations of the journal since begin_iteration() are grouped per FESA property and selector, and each property is
+        restored with a single batched SET (see set_my_JAPC_parameters()).
 
-                """
-                
-                
-                global ind_
+        Input:
 
-            #     param.append(newValue)
-                if not headerInfo['isFirstUpdate']:
-                    param.append(newValue)
-                    msg="({0}) Measured value for {1} is: {2}".format(ind_,parameterName, "%.3f"%newValue)
-                    if verbose:
-                        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                    ind_+=1
+        reason: (string): The reason of the roll-back, for the log messages.
 
-            self.japc.setSelector(my_selector)
-            msg=my_constructor+' measurement: Assigning selector-> '+str(my_selector)+'.'
-            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+        Output:
 
-            self.japc.subscribeParam(my_constructor, newValueCallback, getHeader=True)
-            self.japc.startSubscriptions()
+        The number of parameters which were restored.
 
-            while True:
+        """
 
-                if ind_<=no_shots:
-                    continue
-                else:
-                    self.japc.stopSubscriptions()
-                    self.japc.clearSubscriptions()
-                    break
-            param=param[:no_shots]
+        if not self.iteration_open:
+            return 0
 
+        restore={}
 
-            
-        else:
-            
-            param=[]
-            ind_=1
-            # msg="Manual JAPC Measurement Mode: Waiting for "+str(basic_per)+" seconds for each measurement."
-            # cmn.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',print_me=False)
-            
-            self.japc.setSelector(my_selector)
-            msg=my_constructor+' measurement: Assigning selector-> '+str(my_selector)+'.'
-            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-            
-            for k in range(no_shots):
-                newValue=self.japc.getParam(my_constructor)
-                param.append(newValue)
-                msg="({0}) Measured value for {1} is: {2}".format(ind_,my_constructor, "%.3f"%newValue)
-                if verbose:
-                    self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                sleep(basic_per)
-                ind_+=1
-                self.japc.stopSubscriptions()
-                self.japc.clearSubscriptions()
-        
-        
-        return {'Values':param,'Mean':np.mean(param),'Sigma':np.std(param)}
+        for entry in self.set_journal[self.iteration_start:]:
 
+            if entry['Event']!='SET' or entry['Rollback']:
+                continue
 
+            values=restore.setdefault((entry['Device'],entry['Field'],entry['Selector']),{})
 
+            if entry['Parameter'] not in values: # Keep the value before the first SET of the iteration.
+                values[entry['Parameter']]=entry['Previous']
 
+        msg='Rolling back iteration {0} of {1} module ({2} parameters). {3}'.format(self.iteration,self.mod_name,
+            sum(len(values) for values in restore.values()),reason)
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='rollback',
+            values={'Parameters':sum(len(values) for values in restore.values())})
 
+        self.rolling_back=True
 
-# *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* # 
-    
+        try:
 
-    def set_my_JAPC_parameter(self,device,field,parameter,my_selector,val_to_set,lim_l,lim_r):
-        
-        """
-        Method to set the values of any FESA parameter via the SET method of pyjapc module.
-        
-        The inputs are:
-        
-        {
-        
-        device: The device name in FESA
-        
-        field:  The field name in FESA
-        
-        parameter: The parameter name in FESA
-        
-        val_to_set: The new value to be set for the parameter device/field#parameter.
-        
-        lim_l, lim_r: The lower and upper limits of the value to be set. If the val_to_set value is outside this range, the SET action
-        is aborted and the parameter retains its initial value.
+            for (device,field,my_selector),values in restore.items():
 
-        my_selector: The PLS selector (Set None for non-ppm parameters)
-        
-        }
-        
-        
-        Normally the PyJAPC module SET function is called to interact with 
-        the parameter device/field#parameter. (the name construction follows the JAPC rules)
-        
-        """
-                
-        my_constructor=device+'/'+field
-        self.japc.setSelector(my_selector)
-        dic_FESA=self.japc.getParam(my_constructor)
-        temp={}
+                self.set_my_JAPC_parameters(device=device,field=field,values=values,my_selector=my_selector,
+                    lim_l=-np.inf,lim_r=np.inf)
 
-        for key,item in dic_FESA.items():
+        finally:
 
-            if not (('_min' in key ) or ('_max' in key)):
-                temp[key]=item
-        
-        dic_FESA=temp
-        
-        if float(val_to_set)>=float(lim_l) and float(val_to_set)<=float(lim_r):
-              
-            dic_FESA[parameter]=float(val_to_set)
-            
-            try:
-            
-                self.japc.setParam(my_constructor,dic_FESA)
-                msg='Setting '+my_constructor+'#'+parameter+' parameter to value '+str(val_to_set)+'.'
-                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                
-                return True
+            self.rolling_back=False
 
-            except:
+        self.write_journal({'Event':'rollback','Timestamp':self.clock.now().isoformat(),
+                            'Module':self.mod_name,'Iteration':self.iteration,'Reason':reason})
+
+        self.iteration_open=False
+        self.iteration_start=len(self.set_journal)
+
+        return sum(len(values) for values in restore.values())
 
-                msg='Unable to set '+my_constructor+'#'+parameter+' parameter to value '+str(val_to_set)+'.'
-                self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-                
-                raise ValueError(msg)
-        
-        else:
 
-            msg=('Given value to SET is outside safe operating range (Limit->' +
-                '[{0},{1}]. Aborting SET operation for {2}.').format(lim_l,lim_r,my_constructor+'#'+parameter)
-            
-            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
-            
-            return False
-            
 
 # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
 
         
+    @ghost_phase('wait')
     def wait_time_interval(self,FESA_time,set_init,device='',field='',parameter='',
-    val_to_set=0,lim_l=-1,lim_r=1,user_time=0):#time_interval in minutes!
+    val_to_set=0,lim_l=-1,lim_r=1,user_time=0,wake_on=None):#time_interval in minutes!
         """
         Method to freeze the execution of the a module for a user defined time interval. 
 
@@ -590,6 +2708,9 @@ class GHOST():
 
         user_time: (float) : If other than zero, the FESA_time is overriden and the module freezes for a time interval of user_time seconds.
 
+        wake_on: (callable) : Called every second of the wait (after the kill flag). If it returns a reason (string), the wait is
+        cut short (e.g. a drop of the beam current, see the CusumDetector class).
+
 
         
         """
@@ -600,7 +2721,7 @@ class GHOST():
 
             msg='End of current iteration. Waiting for '+str(FESA_time)+' minutes.'
             
-            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='wait',values={'Seconds':FESA_time*60})
 
              
             m=1
@@ -609,14 +2730,18 @@ class GHOST():
                 
                 self.my_stopper(flag='',set_init=set_init,
                     device=device,field=field,parameter=parameter,val_to_set=val_to_set,lim_l=lim_l,lim_r=lim_r)
-                sleep(1)# Input in seconds
+
+                if self.wake_up(wake_on):
+                    break
+
+                self.sleep(1)# Input in seconds
                 m+=1
             
         else:
             
             msg='End of current iteration. User defined sleep time. Waiting for {} seconds.'\
                                                                                 .format(user_time)
-            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='wait',values={'Seconds':user_time})
             
          
             
@@ -625,12 +2750,36 @@ class GHOST():
                 
                 self.my_stopper(flag='',set_init=set_init,
                     device=device,field=field,parameter=parameter,val_to_set=val_to_set,lim_l=lim_l,lim_r=lim_r)
-                sleep(1)# Input in seconds
+
+                if self.wake_up(wake_on):
+                    break
+
+                self.sleep(1)# Input in seconds
                 m+=1
 
         msg='Proceeding with next iteration of the module.'
 
-        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='wait_end')
+
+
+
+    def wake_up(self,wake_on):
+        """
+        Check the wake-up condition of wait_time_interval(). True (and a log entry) if the wait is cut short.
+        """
+
+        if wake_on is None:
+            return False
+
+        reason=wake_on()
+
+        if not reason:
+            return False
+
+        msg='Wait interrupted: {}.'.format(reason)
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='wake')
+
+        return True
 
 
 
@@ -639,6 +2788,7 @@ class GHOST():
 # *--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--*--* #
 
 
+    @ghost_span()
     def my_stopper(self,flag,set_init,device='',field='',parameter='',val_to_set=0,lim_l=-1,lim_r=1):
         """ Function to terminate the  module by checking the kill flag.
 
@@ -659,6 +2809,8 @@ class GHOST():
             lim_l, lim_r: (float): The lower and upper limits of the value to be set. If the val_to_set value is outside this range, the SET action
             is aborted and the parameter retains its initial value.
 
+            If an iteration is open (see begin_iteration()), all its SET operations are rolled back with rollback_iteration() instead.
+
 
 
         """
@@ -677,17 +2829,30 @@ class GHOST():
             self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
 
         
-        signum=self.get_FESA_param('kill')
+        self.kill_check=True # Priority request of the JAPC rate limiter
+
+        try:
+            signum=self.get_FESA_param('kill')
+        finally:
+            self.kill_check=False
 
         if signum:
             
             msg="""Terminating {} module: Kill flag raised by the user.""".format(mod_name)
-            self.write_L3_log(msg=msg,where='both logs',logfile_lvl='info')
+            self.write_L3_log(msg=msg,where='both logs',logfile_lvl='info',event='kill')
 
-            if set_init:
+            if self.iteration_open:
 
-                self.set_my_JAPC_parameter(device=device,field=field,parameter=parameter,
+                self.rollback_iteration(reason='Kill flag raised by the user.')
+
+            elif set_init:
+
+                self.set_my_JAPC_parameter(device=device,field=field,parameter=parameter,my_selector=self.japc_selector,
                 val_to_set=val_to_set,lim_l=lim_l,lim_r=lim_r)
+
+            self.stop_buffered_subscription()
+
+            self.enter_phase('exit') # The watchdog does not restart a killed module.
             
             exit(msg)# Exit from the module
         
@@ -701,7 +2866,19 @@ class GHOST():
 
             return
         
-    def read_timber(self,scale,offset,observable=['IP.NSRCGEN:SOURCEHTAQNI'],plot_me=True,pickle_me=False,ax_obj=None):
+    @ghost_span()
+    def read_timber(self,scale,offset,observable=['IP.NSRCGEN:SOURCEHTAQNI'],plot_me=True,pickle_me=False,ax_obj=None,
+                    plot_file=None,plot_formats=('png',)):
+         """
+         Method to read the Timber series of the observables over the last offset days, hours or minutes (scale).
+
+         Output: The DataFrame of the series (index: the time stamps of the first observable).
+
+         With plot_me, the series are drawn on the axes ax_obj if given (the figure of the caller). Otherwise the plot is rendered
+         without display by a worker process (see ghost_plot.TimberPlotter) to the files plot_file.png and/or plot_file.svg
+         (default: dir_logging+mod_name+'_timber'), with a rolling window of offset: The method only queues the new samples and
+         never waits on the rendering. Each further call updates the same figure.
+         """
                 
          if scale=='hours':
                 delta=datetime.timedelta(hours=offset)
@@ -716,9 +2893,9 @@ class GHOST():
             
          assert offset>=0,"Please provide a finite positive offset."
         
-         t1 = datetime.datetime.now() - delta
+         t1 = self.clock.now() - delta
         
-         t2 = datetime.datetime.now()
+         t2 = self.clock.now()
         
          
          
@@ -731,11 +2908,14 @@ class GHOST():
          
          df=pd.DataFrame(index=calendar,columns=observable)
          
+         series={}
+
          for obs in observable:
              
              data=db.get(obs,t1,t2)[obs]
              numeric=data[1]
              df[obs]=numeric
+             series[obs]=data
              
         
          
@@ -743,46 +2923,106 @@ class GHOST():
          if pickle_me:
              df.to_pickle(calendar[-1]+'.pickle')
              
-         if plot_me:
+         if plot_me and ax_obj is not None:
              
              df.plot(ax=ax_obj, marker='')
-             plt.show()
+
+         elif plot_me:
+
+             plot_file=plot_file if plot_file is not None else self.dir_logging+self.mod_name+'_timber'
+
+             if plot_file not in self.plotters:
+
+                 self.plotters[plot_file]=TimberPlotter(plot_file,plot_formats,window=delta.total_seconds(),
+                     title='[GHOST:{}] Timber'.format(self.mod_name))
+
+                 atexit.register(self.plotters[plot_file].close)
+
+             self.plotters[plot_file].update(series)
              
          return df
 
 
-    def send_email(self,sender='gts.ghost@cern.ch',recipient='+41754114204@mail2sms.cern.ch',password='LiliKesi5'):
-        
-        # create message object instance
-        msg = MIMEMultipart()
-         
-         
-        message = "Hello Detlef,\n\nThe module has finished with success :-).\n\nBest regards,\n\nGHOST"
-         
-        # setup the parameters of the message
-        
-        msg['From'] = sender
-        msg['To'] = recipient
-        msg['Subject'] = "[GHOST:{}]".format(self.mod_name)
-         
-        # add in the message body
-        msg.attach(MIMEText(message, 'plain'))
-         
-        #create server
-        server = smtplib.SMTP('smtp.cern.ch: 587')
-         
-        server.starttls()
-         
-        # Login Credentials for sending the mail
-        server.login(msg['From'], password)
-         
-         
-        # send the message via the server.
-        server.sendmail(msg['From'], msg['To'], msg.as_string())
-         
-        server.quit()
-         
-        print("Successfully sent email to {}".format(msg['To']))
+    @ghost_phase('timber')
+    def get_timber_series(self,observable,t_start,t_end=None):
+        """
+        Read the raw Timber history of one variable between the POSIX times t_start and t_end (default: now).
+
+        Output: The arrays of the time-stamps (POSIX time) and of the values.
+        """
+
+        t_end=self.clock.time() if t_end is None else t_end
+
+        db=pytimber.LoggingDB()
+
+        times,values=db.get(observable,t_start,t_end)[observable]
+
+        return np.asarray(times,dtype=float),np.asarray(values,dtype=float)
+
+
+    @ghost_span()
+    def send_email(self,message=None,subject=None,recipient=None):
+        """
+        Method to send an e-mail notification, without blocking the module: The e-mail is queued and sent in the background by
+        a ghost_notify.NotificationDispatcher (persistent SMTP connection, retries, deduplication and rate limit). The queued
+        e-mails are still sent at the exit of the module.
+
+        The SMTP server, the sender, the default recipients and the credentials come from the configuration file notify_config
+        (or the environment, see ghost_notify.load_notify_config()). No e-mail is sent in replay mode.
+
+        Input:
+
+        message: (string): The body of the e-mail (default: the success message of the module).
+
+        subject: (string): The subject of the e-mail (default: '[GHOST:<mod_name>]').
+
+        recipient: (string): The recipient (default: the recipients of the configuration).
+
+        Output: True if the e-mail is queued.
+
+        """
+
+        if message is None:
+            message="Hello Detlef,\n\nThe module has finished with success :-).\n\nBest regards,\n\nGHOST"
+
+        subject=subject if subject is not None else "[GHOST:{}]".format(self.mod_name)
+
+        if self.japc_replay is not None:
+
+            msg='Replay mode: E-mail "{}" not sent.'.format(subject)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info')
+
+            return False
+
+        if self.notifier is None:
+
+            self.notifier=NotificationDispatcher(load_notify_config(self.notify_config),log=self.notify_log)
+
+            atexit.register(self.notifier.close) # The queued e-mails are sent before the exit.
+
+        if not (recipient or self.notifier.config['Recipients']):
+
+            msg=('No recipient for the e-mail "{}": Set the recipients in the configuration file or in the environment variable'
+                 ' GHOST_NOTIFY_RECIPIENTS.').format(subject)
+            self.write_L3_log(msg=msg,where='logfile',logfile_lvl='warning',event='notify_dropped')
+
+            return False
+
+        queued=self.notifier.notify(subject,message,[recipient] if recipient else None)
+
+        msg='E-mail "{0}" {1}.'.format(subject,'queued' if queued else 'not queued (duplicate or full queue)')
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event='notify',values={'Queued':int(queued)})
+
+        return queued
+
+
+
+    def notify_log(self,msg,event):
+        """
+        Method for the messages of the notification dispatcher (from its thread) in the local log.
+        """
+
+        self.write_L3_log(msg=msg,where='logfile',logfile_lvl='info',event=event)
 
         
         
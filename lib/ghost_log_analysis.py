@@ -0,0 +1,394 @@
+# Analysis of the local logs of the GHOST modules (HTadjust, OvenRestart).
+
+# Usage: python ghost_log_analysis.py /user/ln3op/GHOST/HTadjust/log/ --report all
+
+#Parsing of the log messages
+import re
+
+#Structured logs
+import json
+import gzip
+
+#Log files and cache
+import os
+import glob
+import pickle
+import hashlib
+
+#Parallel parsing of the files
+from concurrent.futures import ProcessPoolExecutor
+
+#Event tables
+import numpy as np
+import pandas as pd
+
+#Command line
+import argparse
+
+
+
+# Format of the local log: '%(asctime)s:%(levelname)s:%(message)s'
+LINE_FORMAT=re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}):([A-Z]+):(.*)$')
+
+NUM=r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf)'
+
+# (event type, message pattern, names of the numeric groups). The first matching pattern defines the event of a message.
+MESSAGE_PATTERNS=[
+    ('start',re.compile(r'\*+Initiating (\w+) module'),[]),
+    ('iteration_start',re.compile(r'HTadjust_interval is '+NUM+' minutes'),['Interval']),
+    ('HT_start',re.compile(r'The source HT voltage is '+NUM+' V\.'),['HT']),
+    ('BCT15_initial',re.compile(r'Initial ion beam current measurement is '+NUM),['Current']),
+    ('BCT15',re.compile(r'Result of BCT15 measurements for adjustment DV = '+NUM+' V: Mean-> '+NUM+', Sigma-> '+NUM+
+        ', Rejected-> (\d+)'),['DV','Mean','Sigma','Rejected']),
+    ('BCT15',re.compile(r'Result of BCT15 measurements for adjustment DV = '+NUM+' V: Mean-> '+NUM+', Sigma-> '+NUM),
+        ['DV','Mean','Sigma']),
+    ('BCT15_pooled',re.compile(r'Pooled BCT15 measurements of (\d+) rounds: Mean-> '+NUM+', Sigma-> '+NUM),
+        ['Rounds','Mean','Sigma']),
+    ('shots_discarded',re.compile(r'(\d+) updates of .* discarded \(before the SET or settling\)'),['Discarded']),
+    ('BCT15_rejected',re.compile(r'(\d+) of (\d+) BCT15 shots rejected as outliers'),['Rejected','Shots']),
+    ('BCT15_shared',re.compile(r'round of BCT15 measurements shares (\d+) cycles with the previous round'),['Shared']),
+    ('surrogate_warm_start',re.compile(r'Warm start from the surrogate model: HT voltage '+NUM+'-->'+NUM+' V, step '+NUM+' V'),
+        ['HT_start','HT_candidate','Step']),
+    ('momentum_reuse',re.compile(r'Reusing the BCT15 measurement of the previous iteration at '+NUM+' V: Mean-> '+NUM),
+        ['HT','Mean']),
+    ('momentum_skip',re.compile(r'Skipping the probe at DV = '+NUM+' V'),['DV']),
+    ('HT_change',re.compile(r'HT extracting voltage \[V\]: '+NUM+'-->'+NUM+', BCT15 I \[mA\]: '+NUM+'-->'+NUM),
+        ['HT_start','HT_new','BCT15_start','BCT15_new']),
+    ('tracking_start',re.compile(r'Starting the HT tracking around '+NUM+' V: Dither \+/- '+NUM+' V'),['HT','Amplitude']),
+    ('tracking',re.compile(r'HT tracking: Center '+NUM+' V, BCT15 I\+ '+NUM+' mA, I- '+NUM+' mA, demodulated '+NUM+
+        ', filtered '+NUM+', step '+NUM+' V'),['HT','I_plus','I_minus','Demodulated','Filtered','Step']),
+    ('tracking_stop',re.compile(r'HT tracking stopped: '),[]),
+    ('schedule',re.compile(r'Adaptive schedule: next iteration in '+NUM+' seconds \(cruise interval '+NUM+' seconds\)'),
+        ['Wait','Cruise']),
+    ('wait',re.compile(r'End of current iteration\. Waiting for '+NUM+' minutes\.'),['Minutes']),
+    ('wait',re.compile(r'User defined sleep time\. Waiting for '+NUM+' seconds\.'),['Seconds']),
+    ('wake',re.compile(r'Wait interrupted: '),[]),
+    ('wait_end',re.compile(r'Proceeding with next iteration of the module\.'),[]),
+    ('abort_source_status',re.compile(r'The status of the source is .*\. Waiting'),[]),
+    ('abort_low_current',re.compile(r'BCT15 current is below threshold'),[]),
+    ('abort_unstable',re.compile(r'Adjustments of the HT source are not possible due to unstable conditions'),[]),
+    ('recovery',re.compile(r'Recovering the unfinished iteration (\d+) of the previous run of .* module \((\d+) SET'),
+        ['Iteration','SETs']),
+    ('rollback',re.compile(r'Rolling back iteration'),[]),
+    ('notify',re.compile(r'E-mail ".*" queued\.'),[]),
+    ('notify_sent',re.compile(r'Successfully sent e-mail '),[]),
+    ('notify_retry',re.compile(r'Attempt (\d+) of e-mail ".*" failed .* Retrying in '+NUM+' seconds'),['Attempt','Delay']),
+    ('notify_failed',re.compile(r'E-mail ".*" not sent after (\d+) attempts'),['Attempts']),
+    ('notify_delayed',re.compile(r'Notification rate limit reached\. E-mail ".*" delayed by (\d+) seconds'),['Delay']),
+    ('notify_dropped',re.compile(r'Notification queue full\.|No recipient for the e-mail '),[]),
+    ('retry',re.compile(r'Attempt (\d+) of .* failed .* Retrying in '+NUM+' seconds'),['Attempt','Delay']),
+    ('rate_limit',re.compile(r'JAPC rate limiter: (\d+) of (\d+) requests delayed by '+NUM+' seconds'),
+        ['Delayed','Requests','Wait']),
+    ('kill',re.compile(r'Kill flag raised by the user'),[]),
+    ('inhibit',re.compile(r'Inhibition of module'),[]),
+    ('pressure',re.compile(r'The pressure is '+NUM+' mbar\.'),['Pressure']),
+    ('pressure_high',re.compile(r'Pressure is larger than '+NUM+' mbar\. Waiting'),['Limit']),
+    ('oven_power',re.compile(r'The power of oven (\d) is measured to be '+NUM+' W\.'),['Oven','Power']),
+    ('oven_power_set',re.compile(r'Power of oven (\d) is set to '+NUM+' W\.'),['Oven','Power']),
+    ('oven_resistance',re.compile(r'The resistance of oven (\d) is measured to be '+NUM+' Ohm\.'),['Oven','Resistance']),
+    ('finish',re.compile(r'OvenRestart module finished with success'),[]),
+    ('abort_resistance',re.compile(r'Resistance value outside operation range'),[]),
+    ('abort_powered_on',re.compile(r'appears to be already powered on'),[]),
+    ('abort_oven_status',re.compile(r'The status of the oven .* Aborting'),[]),
+    ]
+
+# Events which define the state of the module during the following wait.
+WAIT_STATES={'HT_change':'after HT change','BCT15':'no HT change','abort_source_status':'source status',
+             'abort_low_current':'low current','abort_unstable':'unstable BCT15','inhibit':'inhibit',
+             'pressure_high':'pressure','oven_power_set':'oven power step','tracking_stop':'tracking stopped'}
+
+
+
+def parse_message(message):
+    """
+    The event type and the numeric values (dictionary) of a log message. (None, {}) for messages without event.
+    """
+
+    for event,pattern,names in MESSAGE_PATTERNS:
+
+        found=pattern.search(message)
+
+        if found:
+
+            values=dict(zip(names,(float(group) for group in found.groups()[-len(names):]))) if names else {}
+
+            if 'Minutes' in values:
+                values={'Seconds':values['Minutes']*60}
+
+            return event,values
+
+    return None,{}
+
+
+
+def module_of(file_name):
+    """
+    The module name of a log file (e.g. HTadjust_2019-01-01_10_00_00.log -> HTadjust).
+    """
+
+    return re.split(r'[_.]',os.path.basename(file_name))[0]
+
+
+
+def parse_log_file(file_name):
+    """
+    Parse a local log file (text log of GHOST.initiate_logger() or structured JSON lines log, plain or gzip) into a list of
+    event records (tuples: time, module, level, event, values, message).
+    """
+
+    records=[]
+
+    module=module_of(file_name)
+
+    opener=gzip.open if file_name.endswith('.gz') else open
+
+    with opener(file_name,'rt',errors='replace') as log_file:
+
+        if '.jsonl' in file_name:
+
+            for line in log_file:
+
+                try:
+                    item=json.loads(line)
+                except ValueError:
+                    continue
+
+                if 'Message' not in item:
+                    continue
+
+                event,values=(item['Event'],item['Values']) if item['Event'] else parse_message(item['Message'])
+
+                records.append((pd.Timestamp.fromtimestamp(item['Time']),item['Module'],
+                                item['Level'],event,values,item['Message']))
+
+            return records
+
+        for line in log_file:
+
+            found=LINE_FORMAT.match(line.rstrip('\n'))
+
+            if not found:
+                continue
+
+            stamp,level,message=found.groups()
+
+            event,values=parse_message(message)
+
+            records.append((pd.Timestamp(stamp.replace(',','.')),module,level,event,values,message))
+
+    return records
+
+
+
+class LogAnalysis():
+    """
+    Parser and analysis of the local logs of the GHOST modules.
+
+    The log files are parsed in parallel into a table of events (see events). The parsed result of each file is cached in
+    cache_dir, with a key built from the path, the size and the modification time of the file, so that repeated queries
+    only parse new or changed files.
+
+    Input:
+
+    log_dir: (string): The directory of the log files.
+
+    structured: (boolean): Parse the structured logs (*.jsonl, *.jsonl.gz) instead of the text logs (*.log*).
+
+    module: (string): Analyse only the logs of this module (None for all).
+
+    cache_dir: (string): Directory of the cache (default: log_dir/.ghost_analysis_cache).
+
+    jobs: (int): Number of parallel parsing processes (None: number of CPUs).
+
+    """
+
+    def __init__(self,log_dir,structured=False,module=None,cache_dir=None,jobs=None):
+
+        self.log_dir=log_dir
+        self.structured=structured
+        self.module=module
+        self.cache_dir=cache_dir if cache_dir is not None else os.path.join(log_dir,'.ghost_analysis_cache')
+        self.jobs=jobs
+
+        self._events=None
+
+    def log_files(self):
+
+        patterns=['*.jsonl','*.jsonl.gz'] if self.structured else ['*.log','*.log.*']
+
+        files=sorted({name for pattern in patterns for name in glob.glob(os.path.join(self.log_dir,pattern))
+                      if not name.endswith('_SET_journal.jsonl')})
+
+        if self.module is not None:
+            files=[name for name in files if module_of(name)==self.module]
+
+        return files
+
+    def cache_name(self,file_name):
+
+        stat=os.stat(file_name)
+
+        key='{0}|{1}|{2}'.format(os.path.abspath(file_name),stat.st_size,stat.st_mtime_ns)
+
+        return os.path.join(self.cache_dir,hashlib.sha1(key.encode()).hexdigest()+'.pickle')
+
+    def parse(self):
+        """
+        Parse the log files (cached files are read from the cache) and return the list of event records.
+        """
+
+        os.makedirs(self.cache_dir,exist_ok=True)
+
+        records={}
+        missing=[]
+
+        for file_name in self.log_files():
+
+            cache_name=self.cache_name(file_name)
+
+            try:
+
+                with open(cache_name,'rb') as cache_file:
+                    records[file_name]=pickle.load(cache_file)
+
+            except (OSError,pickle.UnpicklingError,EOFError):
+
+                missing.append(file_name)
+
+        if len(missing)>1 and self.jobs!=1:
+
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                parsed=list(pool.map(parse_log_file,missing))
+
+        else:
+
+            parsed=[parse_log_file(file_name) for file_name in missing]
+
+        for file_name,file_records in zip(missing,parsed):
+
+            records[file_name]=file_records
+
+            with open(self.cache_name(file_name),'wb') as cache_file:
+                pickle.dump(file_records,cache_file,protocol=pickle.HIGHEST_PROTOCOL)
+
+        return [record for file_name in sorted(records) for record in records[file_name]]
+
+    @property
+    def events(self):
+        """
+        Table (DataFrame) of all the parsed log messages with the columns Time, Module, Level, Event, Values and Message,
+        sorted in time.
+        """
+
+        if self._events is None:
+
+            self._events=pd.DataFrame(self.parse(),columns=['Time','Module','Level','Event','Values','Message'])
+            self._events=self._events.sort_values('Time',kind='stable').reset_index(drop=True)
+
+        return self._events
+
+    def table(self,event):
+        """
+        Typed table of one event type: The columns Time and Module and one float column for each numeric value of the event.
+        """
+
+        rows=self.events[self.events['Event']==event]
+
+        values=pd.DataFrame(list(rows['Values']),index=rows.index,dtype=float)
+
+        return pd.concat([rows[['Time','Module']],values],axis=1).reset_index(drop=True)
+
+    def ht_trajectory(self):
+        """
+        The HT voltage changes of HTadjust (Time, HT_start, HT_new, BCT15_start, BCT15_new).
+        """
+
+        return self.table('HT_change')
+
+    def iteration_durations(self):
+        """
+        The duration of each iteration of the modules (time between two successive iteration starts of the same run of the
+        module, in seconds).
+        """
+
+        events=self.events[self.events['Event'].isin(['start','iteration_start'])][['Time','Module','Event']]
+
+        # A run of the module starts with its initiation message.
+        events=events.assign(Run=(events['Event']=='start').groupby(events['Module']).cumsum())
+
+        starts=events[events['Event']=='iteration_start']
+
+        durations=starts.groupby(['Module','Run'])['Time'].diff().dt.total_seconds()
+
+        starts=starts[['Time','Module']]
+
+        return starts.assign(Duration=durations).dropna().reset_index(drop=True)
+
+    def abort_reasons(self):
+        """
+        The number of aborted iterations per module and reason.
+        """
+
+        aborts=self.events[self.events['Event'].fillna('').str.startswith('abort_')]
+
+        return aborts.groupby(['Module','Event']).size().rename('Count').reset_index()
+
+    def wait_states(self):
+        """
+        The time spent (in seconds) per wait state of the modules. The state of a wait is given by the last event before it
+        (see WAIT_STATES). The duration is measured up to the end of the wait, or taken from the nominal waiting time.
+        """
+
+        events=self.events[self.events['Event'].notna()]
+
+        rows=[]
+        state={}
+        open_wait={}
+
+        for stamp,module,event,values in zip(events['Time'],events['Module'],events['Event'],events['Values']):
+
+            if event in WAIT_STATES:
+
+                state[module]=WAIT_STATES[event]
+
+            elif event=='wait':
+
+                open_wait[module]=(stamp,values.get('Seconds',np.nan),state.get(module,'other'))
+
+            elif event=='wait_end' and module in open_wait:
+
+                start,nominal,wait_state=open_wait.pop(module)
+
+                rows.append((module,wait_state,(stamp-start).total_seconds(),nominal))
+
+        for module,(start,nominal,wait_state) in open_wait.items():
+            rows.append((module,wait_state,nominal,nominal))
+
+        waits=pd.DataFrame(rows,columns=['Module','State','Seconds','Nominal'])
+
+        return waits.groupby(['Module','State']).agg(Waits=('Seconds','size'),Seconds=('Seconds','sum')).reset_index()
+
+
+
+if __name__=='__main__':
+
+    parser=argparse.ArgumentParser(description='Analysis of the local logs of the GHOST modules.')
+    parser.add_argument('log_dir',help='Directory of the log files.')
+    parser.add_argument('--module',default=None,help='Analyse only this module (e.g. HTadjust).')
+    parser.add_argument('--structured',action='store_true',help='Use the structured (JSON lines) logs.')
+    parser.add_argument('--report',default='all',choices=['all','ht','iterations','aborts','waits'])
+    parser.add_argument('--jobs',type=int,default=None,help='Number of parallel parsing processes.')
+    args=parser.parse_args()
+
+    analysis=LogAnalysis(args.log_dir,structured=args.structured,module=args.module,jobs=args.jobs)
+
+    pd.set_option('display.width',200)
+
+    if args.report in ('all','ht'):
+        print('HT trajectory:\n{}\n'.format(analysis.ht_trajectory()))
+    if args.report in ('all','iterations'):
+        print('Iteration durations [s]:\n{}\n'.format(analysis.iteration_durations()['Duration'].describe()))
+    if args.report in ('all','aborts'):
+        print('Abort reasons:\n{}\n'.format(analysis.abort_reasons()))
+    if args.report in ('all','waits'):
+        print('Time per wait state:\n{}\n'.format(analysis.wait_states()))
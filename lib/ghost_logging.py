@@ -0,0 +1,302 @@
+# Structured (JSON lines), compressed and time-indexed logs of the GHOST modules.
+
+#Logging handler of the structured sink
+import logging
+
+#Records and time index
+import json
+
+#Compression of the rolled segments
+import gzip
+
+#Files of the segments
+import os
+
+#Search in the time index
+import bisect
+
+#Date of the segments
+import datetime
+
+
+
+# Logger of the failures of the structured sink itself (not the logger of the module, whose records it writes).
+logger=logging.getLogger('ghost_logging')
+
+
+
+class StructuredLogHandler(logging.Handler):
+    """
+    Logging handler which writes the records of a GHOST module as JSON lines, with the keys:
+
+    'Time' (POSIX time), 'Module', 'Iteration', 'Level', 'Event', 'Values' (dictionary of numeric values) and 'Message'.
+
+    The event type, the values and the iteration are passed with the extra argument of the logger
+    (keys 'ghost_event', 'ghost_values', 'ghost_iteration', see GHOST.write_L3_log()).
+
+    The active segment <mod_name>.jsonl keeps the same name across restarts. At midnight (or when it is larger than max_bytes)
+    it is rolled to a gzip segment <mod_name>.<date>.jsonl.gz, made of independent gzip members of block_records records each.
+    Only the newest retention rolled segments are kept.
+
+    The sidecar time index <mod_name>.index.json stores for each segment its time range and the time and file offset of each
+    block, so that query_structured_log() seeks straight to a time range.
+
+    Input:
+
+    directory: (string): The directory of the log files.
+
+    mod_name: (string): The name of the module.
+
+    retention: (int): The number of rolled segments to keep.
+
+    max_bytes: (int): The size of the active segment which forces a roll-over (None: only at midnight).
+
+    block_records: (int): The number of records per indexed block.
+
+    """
+
+    def __init__(self,directory,mod_name,retention=30,max_bytes=None,block_records=256):
+
+        logging.Handler.__init__(self)
+
+        self.directory=directory
+        self.mod_name=mod_name
+        self.retention=retention
+        self.max_bytes=max_bytes
+        self.block_records=block_records
+
+        self.active_name=os.path.join(directory,mod_name+'.jsonl')
+        self.index_name=os.path.join(directory,mod_name+'.index.json')
+
+        self.index=load_index(self.index_name)
+        self.segments=[seg for seg in self.index if seg['File']!=os.path.basename(self.active_name)]
+
+        self.active=self.scan_active()
+        self.stream=open(self.active_name,'a')
+
+        self.remove_failed=False # The first failed removal of an old segment is logged.
+
+    def scan_active(self):
+        """
+        Rebuild the index entry of the active segment from its content (e.g. after a restart of the module).
+        """
+
+        entry={'File':os.path.basename(self.active_name),'Start':None,'End':None,'Blocks':[],'Records':0}
+
+        if not os.path.exists(self.active_name):
+            return entry
+
+        with open(self.active_name,'rb') as active:
+
+            offset=0
+
+            for line in active:
+
+                try:
+                    stamp=json.loads(line)['Time']
+                except (ValueError,KeyError):
+                    offset+=len(line)
+                    continue
+
+                self.add_to_entry(entry,stamp,offset)
+
+                offset+=len(line)
+
+        return entry
+
+    def add_to_entry(self,entry,stamp,offset):
+
+        if entry['Records']%self.block_records==0:
+            entry['Blocks'].append([stamp,offset])
+
+        if entry['Start'] is None:
+            entry['Start']=stamp
+
+        entry['End']=stamp
+        entry['Records']+=1
+
+    def emit(self,record):
+
+        try:
+
+            item={'Time':record.created,'Module':self.mod_name,
+                  'Iteration':getattr(record,'ghost_iteration',None),'Level':record.levelname,
+                  'Event':getattr(record,'ghost_event',None),'Values':getattr(record,'ghost_values',None) or {},
+                  'Message':record.getMessage()}
+
+            line=json.dumps(item,default=float)+'\n'
+
+            if self.should_roll(record.created):
+                self.roll_over()
+
+            self.stream.seek(0,os.SEEK_END)
+            offset=self.stream.tell()
+
+            self.stream.write(line)
+            self.stream.flush()
+
+            new_block=self.active['Records']%self.block_records==0
+
+            self.add_to_entry(self.active,record.created,offset)
+
+            if new_block:
+                self.save_index()
+
+        except Exception:
+
+            self.handleError(record)
+
+    def should_roll(self,stamp):
+
+        if self.active['Start'] is None:
+            return False
+
+        if datetime.date.fromtimestamp(stamp)!=datetime.date.fromtimestamp(self.active['Start']):
+            return True
+
+        return self.max_bytes is not None and self.stream.tell()>=self.max_bytes
+
+    def roll_over(self):
+        """
+        Compress the active segment into a gzip segment of independent members (one per block) and start a new active segment.
+        """
+
+        self.stream.close()
+
+        day='{:%Y-%m-%d_%H%M%S}'.format(datetime.datetime.fromtimestamp(self.active['Start']))
+        gz_name=os.path.join(self.directory,'{0}.{1}.jsonl.gz'.format(self.mod_name,day))
+
+        entry={'File':os.path.basename(gz_name),'Start':self.active['Start'],'End':self.active['End'],
+               'Blocks':[],'Records':self.active['Records']}
+
+        offsets=[offset for stamp,offset in self.active['Blocks']]+[None]
+
+        with open(self.active_name,'rb') as active, open(gz_name,'wb') as segment:
+
+            for (stamp,offset),next_offset in zip(self.active['Blocks'],offsets[1:]):
+
+                active.seek(offset)
+                block=active.read() if next_offset is None else active.read(next_offset-offset)
+
+                entry['Blocks'].append([stamp,segment.tell()])
+                segment.write(gzip.compress(block))
+
+        self.segments.append(entry)
+
+        while len(self.segments)>self.retention:
+
+            old=self.segments.pop(0)
+
+            try:
+
+                os.remove(os.path.join(self.directory,old['File']))
+
+            except OSError as err:
+
+                if not self.remove_failed:
+                    logger.warning('Old log segment {0} not removed: {1}.'.format(old['File'],err))
+
+                self.remove_failed=True
+
+        self.stream=open(self.active_name,'w')
+        self.active={'File':os.path.basename(self.active_name),'Start':None,'End':None,'Blocks':[],'Records':0}
+
+        self.save_index()
+
+    def save_index(self):
+
+        temp_name=self.index_name+'.tmp'
+
+        with open(temp_name,'w') as index_file:
+            json.dump(self.segments+[self.active],index_file)
+
+        os.replace(temp_name,self.index_name)
+
+    def close(self):
+
+        try:
+
+            self.save_index()
+            self.stream.close()
+
+        finally:
+
+            logging.Handler.close(self)
+
+
+
+def load_index(index_name):
+    """
+    Load the time index of a structured log (empty list if it does not exist).
+    """
+
+    try:
+
+        with open(index_name) as index_file:
+            return json.load(index_file)
+
+    except (OSError,ValueError):
+
+        return []
+
+
+
+def query_structured_log(directory,mod_name,t_start=None,t_end=None,event=None):
+    """
+    Read the records of the structured log of a module within a time range, with the help of the time index.
+
+    Input:
+
+    directory: (string): The directory of the log files.
+
+    mod_name: (string): The name of the module.
+
+    t_start, t_end: (float or datetime): The time range (None for no limit).
+
+    event: (string): Return only the records of this event type (None for all).
+
+    Output:
+
+    Generator of the records (dictionaries) in time order.
+
+    """
+
+    if isinstance(t_start,datetime.datetime):
+        t_start=t_start.timestamp()
+    if isinstance(t_end,datetime.datetime):
+        t_end=t_end.timestamp()
+
+    t_start=float('-inf') if t_start is None else t_start
+    t_end=float('inf') if t_end is None else t_end
+
+    for segment in load_index(os.path.join(directory,mod_name+'.index.json')):
+
+        if segment['Start'] is None or segment['End']<t_start or segment['Start']>t_end:
+            continue
+
+        # Last block which starts before t_start.
+        ind=max(bisect.bisect_right([stamp for stamp,offset in segment['Blocks']],t_start)-1,0)
+        offset=segment['Blocks'][ind][1] if segment['Blocks'] else 0
+
+        file_name=os.path.join(directory,segment['File'])
+
+        with open(file_name,'rb') as raw:
+
+            raw.seek(offset)
+
+            lines=gzip.GzipFile(fileobj=raw) if file_name.endswith('.gz') else raw
+
+            for line in lines:
+
+                try:
+                    item=json.loads(line)
+                except ValueError:
+                    continue # Partially written last line
+
+                if item['Time']<t_start:
+                    continue
+                if item['Time']>t_end:
+                    break
+
+                if event is None or item['Event']==event:
+                    yield item
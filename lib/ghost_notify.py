@@ -0,0 +1,343 @@
+# Asynchronous e-mail notifications of the GHOST modules.
+
+#Configuration file of the SMTP server
+import json
+
+#Credentials in the environment
+import os
+
+#Real time of the retries and of the rate limit
+import time
+
+#Background dispatcher
+import threading
+import queue
+
+#E-mails
+import smtplib
+from email.mime.text import MIMEText
+
+#Jitter of the retry backoff
+import random
+
+
+
+# Default configuration of the SMTP server. The credentials and the recipients are never in the code: they come from the
+# configuration file (see load_notify_config()) or from the environment variables GHOST_SMTP_USER, GHOST_SMTP_PASSWORD and
+# GHOST_NOTIFY_RECIPIENTS.
+NOTIFY_DEFAULTS={'Host':'smtp.cern.ch','Port':587,'StartTLS':True,'User':None,'Password':None,'Sender':'gts.ghost@cern.ch',
+                 'Recipients':[]}
+
+
+
+def load_notify_config(file_name=None):
+    """
+    The configuration (dictionary with the keys of NOTIFY_DEFAULTS) of the SMTP server, from the JSON file file_name (default:
+    the environment variable GHOST_NOTIFY_CONFIG) on top of NOTIFY_DEFAULTS. The environment variables GHOST_SMTP_USER and
+    GHOST_SMTP_PASSWORD give the credentials missing from the file. The user is the sender if only a password is given. The
+    environment variable GHOST_NOTIFY_RECIPIENTS (comma-separated addresses) gives the recipients missing from the file.
+
+    The file should be readable only by the operator account (e.g. chmod 600).
+    """
+
+    config=dict(NOTIFY_DEFAULTS)
+
+    file_name=file_name if file_name is not None else os.environ.get('GHOST_NOTIFY_CONFIG')
+
+    if file_name:
+
+        with open(file_name) as config_file:
+            config.update(json.load(config_file))
+
+    if config['User'] is None:
+        config['User']=os.environ.get('GHOST_SMTP_USER')
+
+    if config['Password'] is None:
+        config['Password']=os.environ.get('GHOST_SMTP_PASSWORD')
+
+    if config['Password'] and not config['User']:
+        config['User']=config['Sender']
+
+    if not config['Recipients']:
+        config['Recipients']=os.environ.get('GHOST_NOTIFY_RECIPIENTS','')
+
+    if isinstance(config['Recipients'],str):
+        config['Recipients']=[address.strip() for address in config['Recipients'].split(',') if address.strip()]
+
+    return config
+
+
+
+class NotificationDispatcher():
+    """
+    Background dispatcher of the e-mails of a GHOST module: notify() only queues the message and returns at once, and a worker
+    thread sends it on a persistent SMTP connection (STARTTLS and login once, reused for the next messages and closed after
+    idle_timeout seconds without messages).
+
+    A failed send is retried with a jittered exponential backoff (the connection is opened again), up to max_attempts attempts.
+    A permanent refusal of the server (5xx reply, wrong credentials) is not retried.
+
+    The same message (or the same key) is sent at most once per dedup_window seconds, and at most rate_limit messages are sent
+    per rate_window seconds: the next messages wait in the queue. The queue holds at most max_queue messages.
+
+    Input:
+
+    config: (dictionary): The configuration of the SMTP server (see load_notify_config()).
+
+    max_attempts: (int): The maximum number of attempts of a message.
+
+    base_delay, max_delay: (float): The delay (in seconds) after the first failed attempt and the maximum delay.
+
+    dedup_window: (float): The deduplication window (in seconds).
+
+    rate_limit, rate_window: The rate limit (messages per rate_window seconds).
+
+    idle_timeout: (float): The idle time (in seconds) before the SMTP connection is closed.
+
+    max_queue: (int): The maximum number of queued messages.
+
+    timeout: (float): The timeout (in seconds) of the SMTP connection.
+
+    log: (function): log(msg,event) for the messages of the dispatcher (event 'notify_sent', 'notify_retry', 'notify_failed',
+    'notify_delayed' or 'notify_dropped').
+
+    smtp_class: The SMTP client class (e.g. a local stand-in for the tests).
+
+    """
+
+    def __init__(self,config=None,max_attempts=5,base_delay=5.0,max_delay=300.0,dedup_window=600.0,rate_limit=10,
+                 rate_window=3600.0,idle_timeout=60.0,max_queue=100,timeout=30.0,log=None,smtp_class=smtplib.SMTP):
+
+        self.config=config if config is not None else load_notify_config()
+        self.max_attempts=max_attempts
+        self.base_delay=base_delay
+        self.max_delay=max_delay
+        self.dedup_window=dedup_window
+        self.rate_limit=rate_limit
+        self.rate_window=rate_window
+        self.idle_timeout=idle_timeout
+        self.timeout=timeout
+        self.log=log if log is not None else (lambda msg,event: None)
+        self.smtp_class=smtp_class
+
+        self.queue=queue.Queue(max_queue)
+        self.server=None # The persistent SMTP connection
+        self.recent={} # Deduplication key -> time of the last queued message
+        self.sent_times=[] # Times of the messages sent in the rate window
+        self.stats={'Queued':0,'Sent':0,'Failed':0,'Deduplicated':0,'Dropped':0}
+        self.lock=threading.Lock()
+        self.closing=False
+
+        self.worker=threading.Thread(target=self.work,name='ghost_notify',daemon=True)
+        self.worker.start()
+
+    def notify(self,subject,body,recipients=None,key=None):
+        """
+        Queue the e-mail subject/body to recipients (default: the recipients of the configuration). key identifies the
+        duplicates (default: subject, body and recipients). Output: True if the message is queued.
+        """
+
+        recipients=list(recipients) if recipients is not None else list(self.config['Recipients'])
+
+        key=key if key is not None else (subject,body,tuple(recipients))
+
+        now=time.time()
+
+        with self.lock:
+
+            if self.closing:
+                return False
+
+            self.recent={k:stamp for k,stamp in self.recent.items() if now-stamp<self.dedup_window}
+
+            if key in self.recent:
+                self.stats['Deduplicated']+=1
+                return False
+
+            try:
+
+                self.queue.put_nowait({'Subject':subject,'Body':body,'Recipients':recipients,'Queued':now})
+
+            except queue.Full:
+
+                self.stats['Dropped']+=1
+                self.log('Notification queue full. E-mail "{}" dropped.'.format(subject),'notify_dropped')
+
+                return False
+
+            self.recent[key]=now
+            self.stats['Queued']+=1
+
+        return True
+
+    def connect(self):
+
+        if self.server is not None:
+            return self.server
+
+        server=self.smtp_class(self.config['Host'],self.config['Port'],timeout=self.timeout)
+
+        try:
+
+            if self.config['StartTLS']:
+                server.starttls()
+
+            if self.config['User'] and self.config['Password']:
+                server.login(self.config['User'],self.config['Password'])
+
+        except Exception:
+
+            self.disconnect(server)
+
+            raise
+
+        self.server=server
+
+        return server
+
+    def disconnect(self,server=None):
+
+        server=server if server is not None else self.server
+
+        self.server=None
+
+        if server is None:
+            return
+
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def permanent(error):
+        """
+        True if the error of the SMTP server is permanent (no retry).
+        """
+
+        if isinstance(error,smtplib.SMTPAuthenticationError):
+            return True
+
+        if isinstance(error,smtplib.SMTPRecipientsRefused):
+            return all(code>=500 for code,_ in error.recipients.values())
+
+        return isinstance(error,smtplib.SMTPResponseException) and error.smtp_code>=500
+
+    def rate_wait(self):
+        """
+        The time (in seconds) before the next message is allowed by the rate limit.
+        """
+
+        now=time.time()
+
+        self.sent_times=[stamp for stamp in self.sent_times if now-stamp<self.rate_window]
+
+        if len(self.sent_times)<self.rate_limit:
+            return 0.0
+
+        return self.sent_times[0]+self.rate_window-now
+
+    def deliver(self,item):
+        """
+        Send the message item with retries. Output: True if it is sent.
+        """
+
+        message=MIMEText(item['Body'],'plain')
+        message['From']=self.config['Sender']
+        message['To']=', '.join(item['Recipients'])
+        message['Subject']=item['Subject']
+
+        delay=self.base_delay
+
+        for attempt in range(1,self.max_attempts+1):
+
+            try:
+
+                self.connect().sendmail(self.config['Sender'],item['Recipients'],message.as_string())
+
+                self.sent_times.append(time.time())
+
+                return True
+
+            except (smtplib.SMTPException,OSError) as error:
+
+                self.disconnect() # The connection is opened again for the next attempt.
+
+                if self.permanent(error) or attempt==self.max_attempts:
+
+                    self.log('E-mail "{0}" not sent after {1} attempts: {2!r}'.format(item['Subject'],attempt,error),'notify_failed')
+
+                    return False
+
+                wait=delay*(1+random.uniform(-0.2,0.2))
+
+                self.log('Attempt {0} of e-mail "{1}" failed ({2!r}). Retrying in {3} seconds.'.format(attempt,
+                    item['Subject'],error,"%.1f"%wait),'notify_retry')
+
+                time.sleep(wait)
+
+                delay=min(delay*2,self.max_delay)
+
+        return False
+
+    def work(self):
+
+        while True:
+
+            try:
+
+                item=self.queue.get(timeout=self.idle_timeout)
+
+            except queue.Empty:
+
+                self.disconnect() # Idle: the connection is closed.
+
+                continue
+
+            if item is None:
+
+                self.disconnect()
+                self.queue.task_done()
+
+                return
+
+            wait=self.rate_wait()
+
+            if wait>0:
+
+                self.log('Notification rate limit reached. E-mail "{0}" delayed by {1} seconds.'.format(item['Subject'],
+                    int(wait)),'notify_delayed')
+
+                time.sleep(wait)
+
+            sent=self.deliver(item)
+
+            with self.lock:
+                self.stats['Sent' if sent else 'Failed']+=1
+
+            if sent:
+                self.log('Successfully sent e-mail "{0}" to {1}.'.format(item['Subject'],', '.join(item['Recipients'])),'notify_sent')
+
+            self.queue.task_done()
+
+    def close(self,timeout=60.0):
+        """
+        Send the queued messages (at most timeout seconds) and stop the worker.
+        """
+
+        with self.lock:
+
+            if self.closing:
+                return
+
+            self.closing=True
+
+        try:
+            self.queue.put(None,timeout=timeout)
+        except queue.Full:
+            return
+
+        self.worker.join(timeout)
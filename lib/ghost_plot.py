@@ -0,0 +1,185 @@
+# Headless rendering of the Timber plots of the GHOST modules in a worker process.
+
+#Worker process and its request queue
+import multiprocessing
+import queue
+
+#Atomic replacement of the figure files
+import os
+
+#Rolling window of the series
+import numpy as np
+
+#Failures of the rendering
+import logging
+
+
+
+logger=logging.getLogger('ghost_plot')
+
+
+
+def render_worker(requests,file_name,formats,window,title):
+    """
+    Main function of the rendering process (see TimberPlotter): The figure is drawn with the non-interactive backend Agg and
+    updated in place (one line per observable) for each batch of requests. The pending requests are merged before each
+    rendering, so that a slow rendering never builds a backlog.
+    """
+
+    import matplotlib
+
+    matplotlib.use('Agg') # No display: only files.
+
+    import matplotlib.pyplot as plt
+
+    fig,ax=plt.subplots(figsize=(10,5))
+    ax.set_title(title)
+    ax.set_xlabel('Time [h]')
+    ax.grid(True)
+
+    series={} # Observable -> (times, values)
+    lines={} # Observable -> Line2D
+
+    failed=False # The first failed rendering is logged.
+
+    running=True
+
+    while running:
+
+        batch=[requests.get()]
+
+        while True:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+
+        for item in batch:
+
+            if item is None:
+                running=False
+                continue
+
+            for obs,(times,values) in item.items():
+
+                old_times,old_values=series.get(obs,(np.array([]),np.array([])))
+
+                # Only the samples newer than the known ones (incremental updates).
+                new=times>old_times[-1] if len(old_times) else np.ones(len(times),dtype=bool)
+
+                series[obs]=(np.concatenate([old_times,times[new]]),np.concatenate([old_values,values[new]]))
+
+        if not any(len(times) for times,_ in series.values()):
+            continue
+
+        last=max(times[-1] for times,_ in series.values() if len(times))
+
+        for obs,(times,values) in list(series.items()):
+
+            if window is not None:
+
+                keep=times>=last-window
+                times,values=times[keep],values[keep]
+                series[obs]=(times,values)
+
+            x=(times-last)/3600.0
+
+            if obs in lines:
+                lines[obs].set_data(x,values)
+            else:
+                lines[obs],=ax.plot(x,values,label=obs)
+
+        ax.relim()
+        ax.autoscale_view()
+        ax.legend(loc='best')
+
+        for extension in formats:
+
+            temp_name='{0}.tmp.{1}'.format(file_name,extension)
+
+            try:
+
+                fig.savefig(temp_name,format=extension)
+                os.replace(temp_name,'{0}.{1}'.format(file_name,extension))
+
+            except (OSError,ValueError) as err:
+
+                if not failed:
+                    logger.warning('Figure {0}.{1} not rendered: {2}.'.format(file_name,extension,err))
+
+                failed=True
+
+    plt.close(fig)
+
+
+
+class TimberPlotter():
+    """
+    Headless plotter of the Timber series of a GHOST module (see GHOST.read_timber()).
+
+    update() only queues the new samples and returns at once: A worker process (spawned, without a display) renders a rolling
+    window figure to the files file_name.png and/or file_name.svg. When the worker is busy and the queue is full, the update is
+    dropped (the next one carries the newer samples), so that the data fetching and the module never wait on the rendering.
+
+    Input:
+
+    file_name: (string): The figure file, without extension.
+
+    formats: (tuple): The formats of the figure ('png', 'svg').
+
+    window: (float): The rolling window of the figure (in seconds, None: all the samples).
+
+    title: (string): The title of the figure.
+
+    max_pending: (int): The maximum number of queued updates.
+
+    """
+
+    def __init__(self,file_name,formats=('png',),window=None,title='',max_pending=10):
+
+        context=multiprocessing.get_context('spawn') # No fork of the JAPC threads.
+
+        self.file_name=file_name
+        self.requests=context.Queue(max_pending)
+        self.dropped=0
+
+        self.process=context.Process(target=render_worker,args=(self.requests,file_name,tuple(formats),window,title),
+                                     name='ghost_plot',daemon=True)
+        self.process.start()
+
+    def update(self,series):
+        """
+        Queue the samples of series (dictionary: observable -> (times, values), POSIX times). Output: False if dropped.
+        """
+
+        item={obs:(np.asarray(times,dtype=float),np.asarray(values,dtype=float)) for obs,(times,values) in series.items()}
+
+        try:
+
+            self.requests.put_nowait(item)
+
+        except queue.Full:
+
+            self.dropped+=1
+
+            return False
+
+        return True
+
+    def close(self,timeout=30.0):
+        """
+        Render the queued updates (at most timeout seconds) and stop the worker.
+        """
+
+        if not self.process.is_alive():
+            return
+
+        try:
+            self.requests.put(None,timeout=timeout)
+        except queue.Full:
+            pass
+
+        self.process.join(timeout)
+
+        if self.process.is_alive():
+            self.process.terminate()
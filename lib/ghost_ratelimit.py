@@ -0,0 +1,249 @@
+# Token-bucket rate limiter of the JAPC requests of the GHOST modules, to protect the FEC.
+
+#Rates of the devices in a JSON file and shared state of the host
+import json
+
+#Lock of the shared state of the host
+import fcntl
+
+#Time of the buckets
+import time
+
+#Buckets shared by the threads of the process
+import threading
+
+
+
+# Rate (requests per second) and burst (requests) of the JAPC GET and SET requests of each device. 'default' is used for the
+# devices which are not listed.
+DEFAULT_RATES={'default':(5.0,10.0)}
+
+
+
+def load_rates(rates=None):
+    """
+    The rates (dictionary: device -> (rate, burst)) from a dictionary or a JSON file name, on top of DEFAULT_RATES.
+    """
+
+    if isinstance(rates,str):
+
+        with open(rates) as rates_file:
+            rates=json.load(rates_file)
+
+    merged=dict(DEFAULT_RATES)
+    merged.update({device:tuple(value) for device,value in (rates or {}).items()})
+
+    return merged
+
+
+
+def refill(tokens,stamp,now,rate,burst):
+
+    return min(burst,tokens+max(now-stamp,0.0)*rate)
+
+
+
+class JAPCLimiter():
+    """
+    Token-bucket limiter of the JAPC requests, with one bucket per device.
+
+    Each request takes one token of the bucket of its device. A bucket refills at rate tokens per second, up to burst tokens.
+    The routine requests leave reserve (fraction of burst) tokens in the bucket for the priority requests (kill checks and
+    rollbacks, see RateLimitedJAPC), which therefore pass first when the budget of the device is used up.
+
+    With host_file, the buckets are shared by all the GHOST modules of the host: their state is kept in host_file, under an
+    exclusive file lock (the real time is then used for the buckets). Otherwise they are shared by the threads of the process
+    (see process_limiter()).
+
+    The statistics of each device are kept in self.device_stats (see stats()).
+
+    Input:
+
+    rates: (dictionary or string): The rate and burst of each device, or a JSON file of them (see load_rates()).
+
+    reserve: (float): The fraction of the burst kept for the priority requests.
+
+    host_file: (string): The state file of the buckets shared by the host (None: process-wide buckets).
+
+    clock: The clock of the buckets and of the waits (an object with time() and sleep(), default: the time module).
+
+    """
+
+    def __init__(self,rates=None,reserve=0.3,host_file=None,clock=None):
+
+        self.rates=load_rates(rates)
+        self.reserve=reserve
+        self.host_file=host_file
+        self.clock=clock if clock is not None else time
+        self.lock=threading.Lock()
+        self.buckets={} # Device -> [tokens, time] (process-wide buckets)
+        self.device_stats={}
+
+    def limits(self,device):
+
+        return self.rates.get(device,self.rates['default'])
+
+    def take_buckets(self,buckets,device,priority,now):
+        """
+        Take one token of the bucket of device in buckets. Output: 0 if taken, else the wait (in seconds) before the next try.
+        """
+
+        rate,burst=self.limits(device)
+
+        tokens,stamp=buckets.get(device,(burst,now))
+        tokens=refill(tokens,stamp,now,rate,burst)
+
+        need=1.0 if priority else 1.0+self.reserve*burst
+
+        if tokens>=need:
+            buckets[device]=[tokens-1.0,now]
+            return 0.0
+
+        buckets[device]=[tokens,now]
+
+        return (need-tokens)/rate
+
+    def take(self,device,priority):
+
+        if self.host_file is None:
+
+            with self.lock:
+                return self.take_buckets(self.buckets,device,priority,self.clock.time())
+
+        with open(self.host_file,'a+') as state_file:
+
+            fcntl.flock(state_file,fcntl.LOCK_EX)
+
+            try:
+
+                state_file.seek(0)
+
+                try:
+                    buckets=json.loads(state_file.read() or '{}')
+                except ValueError:
+                    buckets={} # A damaged state only resets the buckets.
+
+                wait=self.take_buckets(buckets,device,priority,time.time())
+
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(buckets))
+                state_file.flush() # Written before the lock is released.
+
+            finally:
+
+                fcntl.flock(state_file,fcntl.LOCK_UN)
+
+        return wait
+
+    def acquire(self,device,priority=False):
+        """
+        Wait for one token of the bucket of device. Output: The wait (in seconds).
+        """
+
+        waited=0.0
+
+        while True:
+
+            wait=self.take(device,priority)
+
+            if wait<=0:
+                break
+
+            wait=min(wait,1.0) # The other requests may have refilled the bucket.
+
+            self.clock.sleep(wait)
+
+            waited+=wait
+
+        with self.lock:
+
+            item=self.device_stats.setdefault(device,{'Requests':0,'Priority':0,'Delayed':0,'Wait_total':0.0,'Wait_max':0.0})
+
+            item['Requests']+=1
+            item['Priority']+=int(priority)
+
+            if waited>0:
+                item['Delayed']+=1
+                item['Wait_total']+=waited
+                item['Wait_max']=max(item['Wait_max'],waited)
+
+        return waited
+
+    def stats(self):
+        """
+        The statistics (dictionary: device -> 'Requests', 'Priority', 'Delayed', 'Wait_total', 'Wait_max' in seconds) of the
+        requests of this process.
+        """
+
+        with self.lock:
+            return {device:dict(item) for device,item in self.device_stats.items()}
+
+
+
+process_limiters={} # Host file (None: process-wide) -> JAPCLimiter
+
+
+
+def process_limiter(rates=None,reserve=0.3,host_file=None,clock=None):
+    """
+    The JAPCLimiter of the process (one per host_file): All the GHOST objects of a process share its buckets. The rates of
+    the first call are used.
+    """
+
+    if host_file not in process_limiters:
+        process_limiters[host_file]=JAPCLimiter(rates,reserve,host_file,clock)
+
+    return process_limiters[host_file]
+
+
+
+class RateLimitedJAPC():
+    """
+    Proxy of a pyjapc.PyJapc object which takes the tokens of a JAPCLimiter before each GET and SET (one token per parameter
+    of the request, of the device of the parameter). The subscriptions are not limited: their data is pushed by the FEC.
+
+    Input:
+
+    japc: The pyjapc.PyJapc object.
+
+    limiter: (JAPCLimiter): The limiter.
+
+    priority: A callable which returns True for the priority requests (e.g. GHOST.japc_priority()).
+
+    """
+
+    def __init__(self,japc,limiter,priority=None):
+
+        self.japc=japc
+        self.limiter=limiter
+        self.priority=priority if priority is not None else (lambda: False)
+
+    def limit(self,parameterName):
+
+        priority=self.priority()
+
+        for name in (parameterName if isinstance(parameterName,list) else [parameterName]):
+            self.limiter.acquire(name.split('/')[0],priority)
+
+    def getParam(self,parameterName,*args,**kwargs):
+
+        self.limit(parameterName)
+
+        return self.japc.getParam(parameterName,*args,**kwargs)
+
+    def getParamInfo(self,parameterName,*args,**kwargs):
+
+        self.limit(parameterName)
+
+        return self.japc.getParamInfo(parameterName,*args,**kwargs)
+
+    def setParam(self,parameterName,parameterValue,*args,**kwargs):
+
+        self.limit(parameterName)
+
+        return self.japc.setParam(parameterName,parameterValue,*args,**kwargs)
+
+    def __getattr__(self,name):
+
+        return getattr(self.japc,name)
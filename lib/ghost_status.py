@@ -0,0 +1,287 @@
+# Local HTTP status endpoint of the GHOST modules, with a stream of server-sent events (SSE).
+
+#State and events as JSON
+import json
+
+#HTTP server in a background thread
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#Queue of each viewer of the event stream
+import queue
+import collections
+
+#Process of the module
+import os
+
+
+
+class StatusBoard():
+    """
+    State of a GHOST module for the status endpoint, fed by the module itself (see GHOST.write_L3_log(), GHOST.enter_phase()
+    and GHOST.journal_SET()): The viewers never add a request to the FEC.
+
+    The state has the keys 'Module', 'PID', 'Time', 'Phase', 'Phase_since', 'Iteration', 'Iteration_start', 'Last_values'
+    (event type -> time, values and message of its last message), 'Setpoints' (parameter -> time and value of its last SET)
+    and 'Timings' (phase -> count, total and last duration in seconds). The providers (dictionary: key -> callable) add their
+    own keys to the state (e.g. the statistics of the JAPC rate limiter).
+
+    Each event (log message with an event type, phase change or SET) is numbered and sent to every viewer of the stream. The
+    newest history events are kept for the viewers which reconnect (Last-Event-ID). A viewer which does not keep up loses
+    events instead of slowing down the module.
+
+    Input:
+
+    mod_name: (string): The name of the module.
+
+    clock: The clock of the module (see cmn_methods.WallClock and VirtualClock).
+
+    history: (int): The number of events kept for the reconnections.
+
+    max_pending: (int): The maximum number of events queued for a viewer.
+
+    """
+
+    def __init__(self,mod_name,clock,history=200,max_pending=100):
+
+        self.clock=clock
+        self.max_pending=max_pending
+        self.lock=threading.Lock()
+        self.events=collections.deque(maxlen=history)
+        self.viewers=[]
+        self.count=0 # Number of the last event
+        self.providers={}
+
+        now=clock.time()
+
+        self.state={'Module':mod_name,'PID':os.getpid(),'Time':now,'Phase':'start','Phase_since':now,'Iteration':0,
+                    'Iteration_start':None,'Last_values':{},'Setpoints':{},'Timings':{}}
+
+    def snapshot(self):
+
+        with self.lock:
+
+            state=json.loads(json.dumps(self.state,default=str))
+
+        state['Time']=self.clock.time()
+
+        for key,provider in self.providers.items():
+            state[key]=provider()
+
+        return state
+
+    def publish(self,event,data):
+        """
+        Number the event (event type and data dictionary) and send it to the viewers.
+        """
+
+        self.count+=1
+
+        item=(self.count,event,json.dumps(dict(data,Time=self.clock.time()),default=str))
+
+        self.events.append(item)
+
+        for viewer in self.viewers:
+            try:
+                viewer.put_nowait(item)
+            except queue.Full:
+                pass # Slow viewer: the event is lost for it.
+
+    def message(self,msg,event,values,iteration):
+
+        if event is None:
+            return
+
+        now=self.clock.time()
+
+        with self.lock:
+
+            self.state['Last_values'][event]={'Time':now,'Values':values or {},'Message':msg}
+
+            self.publish(event,{'Iteration':iteration,'Values':values or {},'Message':msg})
+
+    def phase(self,phase,iteration):
+
+        now=self.clock.time()
+
+        with self.lock:
+
+            previous=self.state['Phase']
+            duration=now-self.state['Phase_since']
+
+            timing=self.state['Timings'].setdefault(previous,{'Count':0,'Total':0.0,'Last':0.0})
+            timing['Count']+=1
+            timing['Total']+=duration
+            timing['Last']=duration
+
+            if iteration!=self.state['Iteration']:
+                self.state['Iteration']=iteration
+                self.state['Iteration_start']=now
+
+            self.state['Phase']=phase
+            self.state['Phase_since']=now
+
+            self.publish('phase',{'Phase':phase,'Previous':previous,'Duration':duration,'Iteration':iteration})
+
+    def setpoint(self,parameter,value,previous):
+
+        now=self.clock.time()
+
+        with self.lock:
+
+            self.state['Setpoints'][parameter]={'Time':now,'Value':value,'Previous':previous}
+
+            self.publish('set',{'Parameter':parameter,'Value':value,'Previous':previous})
+
+    def subscribe(self,last_id=0):
+        """
+        A new viewer of the stream: its queue, with the kept events after last_id.
+        """
+
+        viewer=queue.Queue(self.max_pending)
+
+        with self.lock:
+
+            for item in self.events:
+                if item[0]>last_id:
+                    try:
+                        viewer.put_nowait(item)
+                    except queue.Full:
+                        break
+
+            self.viewers.append(viewer)
+
+        return viewer
+
+    def unsubscribe(self,viewer):
+
+        with self.lock:
+
+            if viewer in self.viewers:
+                self.viewers.remove(viewer)
+
+    def close(self):
+
+        with self.lock:
+
+            for viewer in self.viewers:
+                try:
+                    viewer.put_nowait(None)
+                except queue.Full:
+                    pass
+
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """
+    Requests of the status endpoint:
+
+    GET /status: The state of the module (JSON).
+
+    GET /events: The stream of the events (text/event-stream). The event type is the SSE event name and the data is JSON.
+    """
+
+    keepalive=15.0 # seconds between two comments of an idle stream
+
+    def do_GET(self):
+
+        url=urlparse(self.path)
+
+        if url.path in ('/','/status'):
+
+            body=json.dumps(self.server.board.snapshot(),indent=1).encode()
+
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.send_header('Cache-Control','no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+        elif url.path=='/events':
+
+            last_id=self.headers.get('Last-Event-ID') or parse_qs(url.query).get('since',['0'])[0]
+
+            self.stream(int(last_id) if last_id.isdigit() else 0)
+
+        else:
+
+            self.send_error(404)
+
+    def stream(self,last_id):
+
+        board=self.server.board
+
+        viewer=board.subscribe(last_id)
+
+        try:
+
+            self.send_response(200)
+            self.send_header('Content-Type','text/event-stream')
+            self.send_header('Cache-Control','no-cache')
+            self.end_headers()
+
+            while True:
+
+                try:
+                    item=viewer.get(timeout=self.keepalive)
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+
+                if item is None:
+                    return
+
+                number,event,data=item
+
+                self.wfile.write('id: {0}\nevent: {1}\ndata: {2}\n\n'.format(number,event,data).encode())
+                self.wfile.flush()
+
+        except (BrokenPipeError,ConnectionResetError):
+
+            pass # The viewer is gone.
+
+        finally:
+
+            board.unsubscribe(viewer)
+
+    def log_message(self,format,*args):
+
+        pass # No access log on the console of the module.
+
+
+
+class StatusServer():
+    """
+    Local HTTP server of the StatusBoard of a module, in a daemon thread (see StatusHandler for the requests).
+
+    Input:
+
+    board: (StatusBoard): The state of the module.
+
+    host: (string): The address of the server (default: local connections only).
+
+    port: (int): The port of the server (0: a free port, see self.port).
+
+    """
+
+    def __init__(self,board,host='127.0.0.1',port=0):
+
+        self.board=board
+
+        self.httpd=ThreadingHTTPServer((host,port),StatusHandler)
+        self.httpd.daemon_threads=True
+        self.httpd.board=board
+
+        self.port=self.httpd.server_address[1]
+
+        self.thread=threading.Thread(target=self.httpd.serve_forever,name='ghost_status',daemon=True)
+        self.thread.start()
+
+    def close(self):
+
+        self.board.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,256 @@
+# Surrogate model of the BCT15 current versus the HT voltage, for the warm start of the HTadjust module.
+
+#Recursive least squares
+import numpy as np
+
+#State of the model on disk
+import json
+
+#Atomic replacement of the state file
+import os
+
+
+
+class QuadraticSurrogate():
+    """
+    Quadratic model I(HT)=c0+c1*x+c2*x**2, with x=(HT-HT_ref)/scale, of the BCT15 current versus the HT voltage.
+
+    The model is fitted by recursive least squares with exponential forgetting in time: Each new sample (from the Timber
+    history or from the measurements of the module) updates the coefficients in O(1), and the weight of the older samples
+    halves every half_life seconds, so that the model follows the slow changes of the source without a refit from scratch.
+    The covariance is bounded (prior), so that a long period without HT changes does not blow up the next update.
+
+    The weighted mean and spread of the HT voltages of the samples are also kept: The model only proposes an optimum inside
+    the region covered by the data (no extrapolation).
+
+    Input:
+
+    HT_ref: (float): The reference HT voltage of the model (V).
+
+    scale: (float): The scale of the HT voltage of the model (V).
+
+    half_life: (float): The half-life of the weight of the samples (in seconds).
+
+    prior: (float): The initial (and maximum) variance of the coefficients.
+
+    """
+
+    version=1
+
+    def __init__(self,HT_ref=0.0,scale=10.0,half_life=12*3600.0,prior=1e3):
+
+        self.HT_ref=HT_ref
+        self.scale=scale
+        self.half_life=half_life
+        self.prior=prior
+
+        self.theta=np.zeros(3)
+        self.P=np.eye(3)*prior
+        self.samples=0
+        self.weight=0.0 # Decayed sum of the weights of the samples
+        self.x_sum=0.0 # Decayed weighted sums of x and x**2
+        self.x2_sum=0.0
+        self.last_time=None # Time of the newest sample
+        self.last_history=None # Time of the newest Timber sample used (incremental refit)
+
+    def features(self,HT):
+
+        x=(HT-self.HT_ref)/self.scale
+
+        return np.array([1.0,x,x*x])
+
+    def update(self,HT,current,stamp,weight=1.0):
+        """
+        Add the sample (HT, current) of the time stamp (POSIX time) to the model. The samples should come in time order; an
+        older sample is added without forgetting.
+        """
+
+        if not (np.isfinite(HT) and np.isfinite(current)):
+            return
+
+        lam=1.0
+
+        if self.last_time is not None and stamp>self.last_time:
+            lam=0.5**((stamp-self.last_time)/self.half_life)
+
+        if self.last_time is None or stamp>self.last_time:
+            self.last_time=stamp
+
+        phi=self.features(HT)
+
+        P_phi=self.P.dot(phi)
+        gain=P_phi/(lam/weight+phi.dot(P_phi))
+
+        self.theta=self.theta+gain*(current-phi.dot(self.theta))
+        self.P=(self.P-np.outer(gain,P_phi))/lam
+
+        # Bounded covariance (no wind-up without excitation).
+        trace=np.trace(self.P)
+        if trace>3*self.prior:
+            self.P*=3*self.prior/trace
+
+        self.weight=lam*self.weight+weight
+        self.x_sum=lam*self.x_sum+weight*phi[1]
+        self.x2_sum=lam*self.x2_sum+weight*phi[2]
+
+        self.samples+=1
+
+    def support(self):
+        """
+        The weighted mean and standard deviation (V) of the HT voltages of the samples.
+        """
+
+        if self.weight<=0:
+            return self.HT_ref,0.0
+
+        mean=self.x_sum/self.weight
+        spread=np.sqrt(max(self.x2_sum/self.weight-mean**2,0.0))
+
+        return self.HT_ref+mean*self.scale,spread*self.scale
+
+    def optimum(self):
+        """
+        The HT voltage of the maximum of the model and the predicted current there. None if the model has no maximum.
+        """
+
+        c0,c1,c2=self.theta
+
+        if not c2<0:
+            return None,None
+
+        x_opt=-c1/(2*c2)
+
+        return self.HT_ref+x_opt*self.scale,c0-c1**2/(4*c2)
+
+    def propose(self,HT_now,low,high,step,min_samples=20,drop=0.02,min_step=None,max_step=None):
+        """
+        Propose the first candidate HT voltage and the step of an iteration.
+
+        Input:
+
+        HT_now: The present HT voltage.
+
+        low, high: The safe limits of the HT voltage.
+
+        step: The default step (returned when the model is not trusted).
+
+        min_samples: The number of samples before the model is trusted.
+
+        drop: The step is the distance from the optimum where the model predicts a relative drop of the current of drop.
+
+        min_step, max_step: The limits of the proposed step (default: step/4 and step).
+
+        Output:
+
+        HT_candidate: The proposed HT voltage (None if the model is not trusted or has no maximum inside its data).
+
+        step: The proposed step.
+
+        """
+
+        min_step=step/4.0 if min_step is None else min_step
+        max_step=step if max_step is None else max_step
+
+        HT_opt,I_opt=self.optimum()
+
+        if self.samples<min_samples or HT_opt is None or not I_opt>0:
+            return None,step
+
+        mean,spread=self.support()
+
+        if abs(HT_opt-mean)>2*spread:
+            return None,step
+
+        curvature=-self.theta[2]/self.scale**2 # mA/V**2
+
+        new_step=float(np.clip(np.sqrt(drop*I_opt/curvature),min_step,max_step))
+
+        return float(np.clip(HT_opt,low,high)),new_step
+
+    def to_dict(self):
+
+        return {'Version':self.version,'HT_ref':self.HT_ref,'Scale':self.scale,'Half_life':self.half_life,'Prior':self.prior,
+                'Theta':self.theta.tolist(),'P':self.P.tolist(),'Samples':self.samples,'Weight':self.weight,
+                'X_sum':self.x_sum,'X2_sum':self.x2_sum,'Last_time':self.last_time,'Last_history':self.last_history}
+
+    @classmethod
+    def from_dict(cls,state):
+
+        model=cls(state['HT_ref'],state['Scale'],state['Half_life'],state['Prior'])
+
+        model.theta=np.array(state['Theta'])
+        model.P=np.array(state['P'])
+        model.samples=state['Samples']
+        model.weight=state['Weight']
+        model.x_sum=state['X_sum']
+        model.x2_sum=state['X2_sum']
+        model.last_time=state['Last_time']
+        model.last_history=state['Last_history']
+
+        return model
+
+    def save(self,file_name):
+
+        temp_name=file_name+'.tmp'
+
+        with open(temp_name,'w') as state_file:
+            json.dump(self.to_dict(),state_file,indent=1)
+
+        os.replace(temp_name,file_name)
+
+    @classmethod
+    def load(cls,file_name):
+        """
+        Load the model from file_name. None is returned if the file is missing or has a different version stamp.
+        """
+
+        try:
+
+            with open(file_name) as state_file:
+                state=json.load(state_file)
+
+        except (OSError,ValueError):
+
+            return None
+
+        if state.get('Version')!=cls.version:
+            return None
+
+        return cls.from_dict(state)
+
+
+
+def align_history(HT_times,HT_values,BCT15_times,BCT15_values,bin_size=60.0,threshold=0.01):
+    """
+    Align the Timber histories of the HT voltage and of the BCT15 current on time bins of bin_size seconds (median of each
+    bin), keeping only the bins with both signals and a BCT15 current above threshold (mA).
+
+    Output: The arrays of the bin times, HT voltages and BCT15 currents, in time order.
+    """
+
+    def binned(times,values):
+
+        times=np.asarray(times,dtype=float)
+        values=np.asarray(values,dtype=float)
+
+        keep=np.isfinite(times)&np.isfinite(values)
+        bins=np.floor(times[keep]/bin_size)
+
+        if not len(bins):
+            return {}
+
+        series=values[keep]
+        order=np.argsort(bins,kind='stable')
+        bins,series=bins[order],series[order]
+
+        edges=np.flatnonzero(np.diff(bins))+1
+
+        return {b[0]:np.median(v) for b,v in zip(np.split(bins,edges),np.split(series,edges))}
+
+    HT_bins=binned(HT_times,HT_values)
+    BCT15_bins=binned(BCT15_times,BCT15_values)
+
+    common=sorted(b for b in HT_bins if b in BCT15_bins and BCT15_bins[b]>=threshold)
+
+    return (np.array([(b+0.5)*bin_size for b in common]),np.array([HT_bins[b] for b in common]),
+            np.array([BCT15_bins[b] for b in common]))
@@ -0,0 +1,278 @@
+# Tracing spans of the GHOST modules, with Chrome trace and collapsed stack (flamegraph) outputs.
+
+#Chrome trace file
+import json
+
+#Atomic replacement of the trace file
+import os
+
+#Durations of the spans (wall clock)
+import time
+
+#Spans of the JAPC callback threads
+import threading
+
+#Bounded list of the Chrome events
+import collections
+
+#Optional profiling of an iteration window
+import cProfile
+
+#Failures of the trace file
+import logging
+
+
+
+logger=logging.getLogger('ghost_trace')
+
+
+
+class Tracer():
+    """
+    Tracer of the named spans of a GHOST module (see GHOST.span(), GHOST.trace_mark() and the decorators ghost_span and
+    ghost_phase of cmn_methods).
+
+    The spans nest per thread. Their duration is measured with the wall clock (time.perf_counter), also when the module runs
+    on a virtual clock. The trace is written to trace_file:
+
+    'chrome': Chrome trace JSON (complete events), for chrome://tracing or Perfetto. Only the newest max_events spans are kept.
+
+    'collapsed': Collapsed stacks 'outer;inner;name microseconds' of the self time of the spans, for flamegraph.pl or
+    speedscope. The stacks of a thread other than the main thread start with the name of the thread.
+
+    The trace is written every save_interval seconds (at the start of an iteration) and by close().
+
+    For the iterations first to last of profile_iterations, the module is also profiled with cProfile, and the statistics are
+    dumped to profile_file (see pstats). Iteration 0 is the start of the module, before its first iteration (e.g. (0, 0) for
+    the whole run of a single-passage module).
+
+    Input:
+
+    trace_file: (string): The trace file.
+
+    trace_format: (string): 'chrome' or 'collapsed' (None: 'chrome' if trace_file ends with '.json', else 'collapsed').
+
+    max_events: (int): The maximum number of spans of the Chrome trace.
+
+    save_interval: (float): The minimum time (in seconds) between two periodic writes of the trace.
+
+    profile_iterations: (tuple): The window (first, last) of the profiled iterations (None: no profiling).
+
+    profile_file: (string): The file of the profile statistics (default: trace_file+'.prof').
+
+    """
+
+    def __init__(self,trace_file,trace_format=None,max_events=200000,save_interval=60.0,profile_iterations=None,
+                 profile_file=None):
+
+        if trace_format is None:
+            trace_format='chrome' if trace_file.endswith('.json') else 'collapsed'
+
+        assert trace_format in ['chrome','collapsed'], 'Wrong trace format. Choose between "chrome" and "collapsed"'
+
+        self.trace_file=trace_file
+        self.trace_format=trace_format
+        self.save_interval=save_interval
+        self.profile_iterations=profile_iterations
+        self.profile_file=profile_file if profile_file is not None else trace_file+'.prof'
+
+        self.events=collections.deque(maxlen=max_events) # Chrome events
+        self.stacks={} # Collapsed stack -> self time (microseconds)
+        self.local=threading.local() # Open spans of each thread
+        self.lock=threading.Lock()
+        self.origin=time.perf_counter()
+        self.pid=os.getpid()
+        self.saved=self.origin # Time of the last write
+        self.save_failed=False # The first failed write is logged.
+        self.profiler=None
+
+        self.iteration(0)
+
+    def open_spans(self):
+
+        spans=getattr(self.local,'spans',None)
+
+        if spans is None:
+
+            spans=self.local.spans=[]
+
+            thread=threading.current_thread()
+
+            self.local.root=[] if thread is threading.main_thread() else [thread.name]
+
+        return spans
+
+    def begin(self,name,cat='',args=None,mark=False):
+        """
+        Open the span name (category cat) in the current thread. A mark span is closed by the next mark of the same thread.
+        """
+
+        # Name, category, arguments, start, time of the children, mark
+        self.open_spans().append([name,cat,args,time.perf_counter(),0.0,mark])
+
+    def end(self):
+        """
+        Close the innermost open span of the current thread.
+        """
+
+        spans=self.open_spans()
+
+        if not spans:
+            return
+
+        name,cat,args,start,children,mark=spans.pop()
+
+        duration=time.perf_counter()-start
+
+        if spans:
+            spans[-1][4]+=duration
+
+        with self.lock:
+
+            if self.trace_format=='chrome':
+
+                event={'name':name,'cat':cat,'ph':'X','ts':round((start-self.origin)*1e6,1),'dur':round(duration*1e6,1),
+                       'pid':self.pid,'tid':threading.get_ident()}
+
+                if args:
+                    event['args']=args
+
+                self.events.append(event)
+
+            else:
+
+                stack=';'.join(self.local.root+[span[0] for span in spans]+[name])
+
+                self.stacks[stack]=self.stacks.get(stack,0.0)+(duration-children)*1e6
+
+    def end_until(self,name):
+        """
+        Close the open spans of the current thread down to (and including) the outermost span name, if any.
+        """
+
+        spans=self.open_spans()
+
+        names=[span[0] for span in spans]
+
+        if name in names:
+            for _ in range(len(spans)-names.index(name)):
+                self.end()
+
+    def mark(self,name,cat='phase',args=None):
+        """
+        Close the open mark span of the current thread (with its children) and open the mark span name. The marks divide a
+        long method (e.g. the run() of a module) into sequential phases.
+        """
+
+        spans=self.open_spans()
+
+        marks=[index for index,span in enumerate(spans) if span[5]]
+
+        if marks:
+            for _ in range(len(spans)-marks[-1]):
+                self.end()
+
+        self.begin(name,cat,args,mark=True)
+
+    def span(self,name,cat='',args=None):
+
+        return Span(self,name,cat,args)
+
+    def iteration(self,number):
+        """
+        Start of the iteration number of the module: The profiler is started or stopped for the window of profile_iterations
+        and the trace is written if it is older than save_interval.
+        """
+
+        if self.profile_iterations is not None:
+
+            first,last=self.profile_iterations
+
+            if first<=number<=last and self.profiler is None:
+
+                self.profiler=cProfile.Profile()
+                self.profiler.enable()
+
+            elif number>last and self.profiler is not None:
+
+                self.stop_profile()
+
+        if time.perf_counter()-self.saved>=self.save_interval:
+            self.save()
+
+    def stop_profile(self):
+
+        if self.profiler is None:
+            return
+
+        self.profiler.disable()
+        self.profiler.dump_stats(self.profile_file)
+
+        self.profiler=None
+        self.profile_iterations=None # The window is profiled once.
+
+    def save(self):
+
+        self.saved=time.perf_counter()
+
+        temp_name=self.trace_file+'.tmp'
+
+        with self.lock:
+
+            if self.trace_format=='chrome':
+                content=json.dumps({'traceEvents':list(self.events),'displayTimeUnit':'ms'})
+            else:
+                content=''.join('{0} {1}\n'.format(stack,int(round(value))) for stack,value in sorted(self.stacks.items()))
+
+        try:
+
+            with open(temp_name,'w') as trace:
+                trace.write(content)
+
+            os.replace(temp_name,self.trace_file)
+
+        except OSError as err:
+
+            if not self.save_failed:
+                logger.warning('Trace file {0} not written: {1}.'.format(self.trace_file,err))
+
+            self.save_failed=True
+
+    def close(self):
+        """
+        Close the open spans of the current thread, stop the profiler and write the trace.
+        """
+
+        while self.open_spans():
+            self.end()
+
+        self.stop_profile()
+        self.save()
+
+
+
+class Span():
+    """
+    Context manager of a span of a Tracer.
+    """
+
+    __slots__=('tracer','name','cat','args')
+
+    def __init__(self,tracer,name,cat,args):
+
+        self.tracer=tracer
+        self.name=name
+        self.cat=cat
+        self.args=args
+
+    def __enter__(self):
+
+        self.tracer.begin(self.name,self.cat,self.args)
+
+        return self
+
+    def __exit__(self,*exc_info):
+
+        self.tracer.end()
+
+        return False
@@ -0,0 +1,319 @@
+# Heartbeat of the GHOST modules and watchdog which restarts a stalled module.
+
+#Heartbeat file
+import json
+
+#Files, signals and environment of the module process
+import os
+import signal
+
+#Real time of the heartbeat (independent of the clock of the module)
+import time
+
+#Process of the module
+import subprocess
+
+#Command line of the watchdog
+import argparse
+
+#Log of the watchdog
+import logging
+
+
+
+# Time budget (seconds) of each phase of a module, between two heartbeats. A waiting module beats every second. The
+# phase 'exit' is the last beat of a module terminated by its kill flag.
+PHASE_BUDGETS={'start':600.0,'run':120.0,'wait':30.0,'measure':300.0,'settle':60.0,'subscribe':120.0,'set':300.0,
+               'rollback':300.0,'logbook':120.0,'timber':600.0,'exit':60.0}
+
+
+
+class Heartbeat():
+    """
+    Heartbeat of a GHOST module, published to a local JSON file with the keys 'Module', 'PID', 'Phase', 'Budget' (seconds),
+    'Iteration' and 'Time' (POSIX time of the beat).
+
+    The file is rewritten (atomically) on each change of phase and by beat(), at most every interval seconds. The module is
+    stalled when no beat arrives within the budget of its phase (see Watchdog).
+
+    Input:
+
+    file_name: (string): The heartbeat file.
+
+    mod_name: (string): The name of the module.
+
+    budgets: (dictionary): The time budget of each phase (default: PHASE_BUDGETS). Unknown phases have the budget of 'run'.
+
+    interval: (float): The minimum time (in seconds) between two beats of the same phase.
+
+    """
+
+    def __init__(self,file_name,mod_name,budgets=None,interval=1.0):
+
+        self.file_name=file_name
+        self.mod_name=mod_name
+        self.budgets=dict(PHASE_BUDGETS,**(budgets or {}))
+        self.interval=interval
+        self.phase='start'
+        self.iteration=0
+        self.write_failed=False # The first failed write is logged.
+        self.written=0.0 # Time of the last beat
+
+    def enter(self,phase,iteration=0):
+
+        self.phase=phase
+        self.iteration=iteration
+
+        self.write()
+
+    def beat(self,iteration=0):
+
+        self.iteration=iteration
+
+        if time.time()-self.written>=self.interval:
+            self.write()
+
+    def write(self):
+
+        self.written=time.time()
+
+        item={'Module':self.mod_name,'PID':os.getpid(),'Phase':self.phase,
+              'Budget':self.budgets.get(self.phase,self.budgets['run']),'Iteration':self.iteration,'Time':self.written}
+
+        temp_name=self.file_name+'.tmp'
+
+        try:
+
+            with open(temp_name,'w') as beat_file:
+                json.dump(item,beat_file)
+
+            os.replace(temp_name,self.file_name)
+
+        except OSError as err:
+
+            if not self.write_failed:
+                logging.getLogger('ghost_watchdog').warning('Heartbeat file {0} not written: {1}.'.format(self.file_name,err))
+
+            self.write_failed=True
+
+
+
+def read_heartbeat(file_name):
+    """
+    The last heartbeat (dictionary) of the heartbeat file, None if it is missing or incomplete.
+    """
+
+    try:
+
+        with open(file_name) as beat_file:
+            return json.load(beat_file)
+
+    except (OSError,ValueError):
+
+        return None
+
+
+
+class Watchdog():
+    """
+    Watchdog of a GHOST module: The module is started as a child process with the environment variables GHOST_HEARTBEAT and
+    GHOST_STACK_DUMP (see GHOST), and its heartbeat file is polled.
+
+    When the last beat is older than the budget of its phase (plus grace), the stack of all the threads of the module is dumped
+    (SIGUSR1, see faulthandler) to the log of the watchdog, the module is terminated and restarted. A restarted module rolls
+    back the unfinished iteration of its SET journal (see GHOST.recover_journal()).
+
+    The module is also restarted when it exits with an error. A clean exit (code 0, or the kill flag: last beat in the phase
+    'exit') ends the watchdog. At most
+    max_restarts restarts are done within restart_window seconds.
+
+    Input:
+
+    command: (list): The command line of the module.
+
+    heartbeat_file: (string): The heartbeat file of the module.
+
+    stack_dump_file: (string): The file of the stack dumps (default: heartbeat_file+'.stack').
+
+    grace: (float): Extra time (in seconds) on top of the budget of the phase.
+
+    poll: (float): The polling period (in seconds) of the heartbeat.
+
+    max_restarts, restart_window: The restart limit.
+
+    logger: The logger of the watchdog.
+
+    """
+
+    def __init__(self,command,heartbeat_file,stack_dump_file=None,grace=5.0,poll=1.0,max_restarts=10,restart_window=3600.0,
+                 logger=None):
+
+        self.command=command
+        self.heartbeat_file=heartbeat_file
+        self.stack_dump_file=stack_dump_file if stack_dump_file is not None else heartbeat_file+'.stack'
+        self.grace=grace
+        self.poll=poll
+        self.max_restarts=max_restarts
+        self.restart_window=restart_window
+        self.logger=logger if logger is not None else logging.getLogger('ghost_watchdog')
+
+        self.restarts=[] # Times of the restarts
+        self.process=None
+        self.started=0.0 # Start time of the module process
+
+    def start(self):
+
+        env=dict(os.environ,GHOST_HEARTBEAT=self.heartbeat_file,GHOST_STACK_DUMP=self.stack_dump_file)
+
+        self.process=subprocess.Popen(self.command,env=env)
+        self.started=time.time()
+
+        self.logger.info('Module started (PID {0}): {1}'.format(self.process.pid,' '.join(self.command)))
+
+    def stalled(self,now):
+        """
+        The reason (string) if the module is stalled, otherwise None.
+        """
+
+        beat=read_heartbeat(self.heartbeat_file)
+
+        if beat is None or beat.get('PID')!=self.process.pid:
+
+            # No beat of this process yet: It is starting.
+            if now-self.started>PHASE_BUDGETS['start']+self.grace:
+                return 'No heartbeat {} seconds after the start'.format(int(now-self.started))
+
+            return None
+
+        age=now-beat['Time']
+
+        if age>beat['Budget']+self.grace:
+            return 'No heartbeat for {0} seconds in phase {1} (budget {2} seconds, iteration {3})'.format(
+                int(age),beat['Phase'],beat['Budget'],beat['Iteration'])
+
+        return None
+
+    def killed(self):
+        """
+        True if the last beat of the module process is in the phase 'exit' (kill flag).
+        """
+
+        beat=read_heartbeat(self.heartbeat_file)
+
+        return beat is not None and beat.get('PID')==self.process.pid and beat.get('Phase')=='exit'
+
+    def dump_stack(self):
+        """
+        Ask the module for the stack of all its threads (faulthandler on SIGUSR1) and copy it to the log of the watchdog.
+        """
+
+        try:
+            offset=os.path.getsize(self.stack_dump_file)
+        except OSError:
+            offset=0
+
+        try:
+            self.process.send_signal(signal.SIGUSR1)
+        except OSError:
+            return
+
+        time.sleep(1.0)
+
+        try:
+
+            with open(self.stack_dump_file) as dump_file:
+                dump_file.seek(offset)
+                self.logger.warning('Stack of the stalled module:\n'+dump_file.read())
+
+        except OSError:
+
+            self.logger.warning('No stack dump of the stalled module.')
+
+    def stop(self,timeout=10.0):
+
+        self.process.terminate()
+
+        try:
+
+            self.process.wait(timeout)
+
+        except subprocess.TimeoutExpired:
+
+            self.process.kill()
+            self.process.wait()
+
+    def monitor(self):
+        """
+        Poll the module until it exits or stalls. Output: The exit code of the module, or None if it was stopped as stalled.
+        """
+
+        while True:
+
+            time.sleep(self.poll)
+
+            code=self.process.poll()
+
+            if code is not None:
+                return code
+
+            reason=self.stalled(time.time())
+
+            if reason is not None:
+
+                self.logger.warning('Module stalled (PID {0}): {1}.'.format(self.process.pid,reason))
+
+                self.dump_stack()
+                self.stop()
+
+                return None
+
+    def run(self):
+
+        while True:
+
+            self.start()
+
+            code=self.monitor()
+
+            if code==0:
+                self.logger.info('Module exited normally. Watchdog stopped.')
+                return 0
+
+            if code is not None and self.killed():
+                self.logger.info('Module terminated by its kill flag. Watchdog stopped.')
+                return 0
+
+            if code is not None:
+                self.logger.warning('Module exited with code {}.'.format(code))
+
+            now=time.time()
+            self.restarts=[stamp for stamp in self.restarts if now-stamp<self.restart_window]+[now]
+
+            if len(self.restarts)>self.max_restarts:
+                self.logger.error('{0} restarts within {1} seconds. Watchdog stopped.'.format(len(self.restarts)-1,
+                    self.restart_window))
+                return 1
+
+            self.logger.info('Restarting the module.')
+
+
+
+if __name__ == "__main__":
+
+    parser=argparse.ArgumentParser(description='Run a GHOST module under the watchdog.')
+    parser.add_argument('--heartbeat',required=True,help='The heartbeat file of the module.')
+    parser.add_argument('--stack-dump',default=None,help='The file of the stack dumps (default: heartbeat file + .stack).')
+    parser.add_argument('--log',default=None,help='The log file of the watchdog (default: standard error).')
+    parser.add_argument('--grace',type=float,default=5.0,help='Extra time (seconds) on top of the phase budgets.')
+    parser.add_argument('--max-restarts',type=int,default=10,help='Maximum number of restarts per hour.')
+    parser.add_argument('command',nargs=argparse.REMAINDER,help='The command of the module (after --).')
+
+    args=parser.parse_args()
+
+    command=args.command[1:] if args.command[:1]==['--'] else args.command
+
+    logging.basicConfig(filename=args.log,level=logging.INFO,format='%(asctime)s:%(levelname)s:%(message)s')
+
+    watchdog=Watchdog(command,args.heartbeat,args.stack_dump,grace=args.grace,max_restarts=args.max_restarts)
+
+    raise SystemExit(watchdog.run())
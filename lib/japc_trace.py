@@ -0,0 +1,465 @@
+# Record and replay of the JAPC sessions of the GHOST modules.
+
+# Compact binary trace: Pickled records in a gzip stream
+import pickle
+import gzip
+
+# Time-stamps of the records
+import time
+
+# Callbacks of the subscriptions arrive from the JAPC threads
+import threading
+
+# Close the trace at the exit of the module
+import atexit
+
+# For the comparison of the SET values
+import numpy as np
+
+# For loading the module classes from the command line
+import os
+import sys
+import importlib
+
+
+
+class TraceExhausted(BaseException):
+    """
+    Raised by JAPCReplayer when the module asks for data which is not in the trace anymore.
+
+    It derives from BaseException so that the retry layer of GHOST (GHOST.fec_call()) and the exception handling of the
+    modules do not catch it: it ends the replay of the module.
+    """
+
+
+
+class JAPCRecorder():
+    """
+    Proxy of a pyjapc.PyJapc object which records every GET, SET and subscription callback to a trace file.
+
+    Each record is the tuple (kind, name, value, time) where kind is one of 'GET', 'INFO', 'SET', 'ERROR', 'SELECTOR',
+    'SUBSCRIBE', 'START', 'STOP', 'CLEAR', 'CALLBACK' or 'SCHEMA'. The records are pickled into a gzip stream.
+
+    Input:
+
+    japc: The pyjapc.PyJapc object.
+
+    file_name: (string): The trace file.
+
+    clock: The clock of the time-stamps of the records (an object with a time() method, default: the time module). A module
+    simulated on a virtual clock records the simulated time.
+
+    """
+
+    def __init__(self,japc,file_name,clock=None):
+
+        self.japc=japc
+        self.file_name=file_name
+        self.clock=clock if clock is not None else time
+        self.trace=gzip.open(file_name,'wb')
+        self.lock=threading.Lock()
+        self.records=0
+
+        atexit.register(self.close)
+
+    def record(self,kind,name,value=None):
+
+        with self.lock:
+
+            pickle.dump((kind,name,value,self.clock.time()),self.trace,protocol=pickle.HIGHEST_PROTOCOL)
+            self.records+=1
+
+            # Keep the trace readable if the module is killed.
+            if kind in ('SET','ERROR') or self.records%100==0:
+                self.trace.flush()
+
+    @staticmethod
+    def key(name):
+
+        return tuple(name) if isinstance(name,list) else name
+
+    def getParam(self,parameterName,*args,**kwargs):
+
+        try:
+
+            value=self.japc.getParam(parameterName,*args,**kwargs)
+
+        except Exception as err:
+
+            self.record('ERROR',('GET',self.key(parameterName)),repr(err))
+            raise
+
+        self.record('GET',self.key(parameterName),value)
+
+        return value
+
+    def getParamInfo(self,parameterName,*args,**kwargs):
+
+        try:
+
+            value=self.japc.getParamInfo(parameterName,*args,**kwargs)
+
+        except Exception as err:
+
+            self.record('ERROR',('INFO',self.key(parameterName)),repr(err))
+            raise
+
+        self.record('INFO',self.key(parameterName),value)
+
+        return value
+
+    def setParam(self,parameterName,parameterValue,*args,**kwargs):
+
+        try:
+
+            self.japc.setParam(parameterName,parameterValue,*args,**kwargs)
+
+        except Exception as err:
+
+            self.record('ERROR',('SET',self.key(parameterName)),repr(err))
+            raise
+
+        self.record('SET',self.key(parameterName),parameterValue)
+
+    def setSelector(self,timingSelector,*args,**kwargs):
+
+        self.record('SELECTOR',None,timingSelector)
+
+        return self.japc.setSelector(timingSelector,*args,**kwargs)
+
+    def subscribeParam(self,parameterName,onValueReceived=None,*args,**kwargs):
+
+        def recorded_callback(*cb_args):
+
+            self.record('CALLBACK',self.key(cb_args[0]),cb_args[1:])
+
+            return onValueReceived(*cb_args)
+
+        self.record('SUBSCRIBE',self.key(parameterName),kwargs.get('getHeader',False))
+
+        return self.japc.subscribeParam(parameterName,recorded_callback,*args,**kwargs)
+
+    def startSubscriptions(self,*args,**kwargs):
+
+        self.record('START',kwargs.get('parameterName',args[0] if args else None))
+
+        return self.japc.startSubscriptions(*args,**kwargs)
+
+    def stopSubscriptions(self,*args,**kwargs):
+
+        self.record('STOP',kwargs.get('parameterName',args[0] if args else None))
+
+        return self.japc.stopSubscriptions(*args,**kwargs)
+
+    def clearSubscriptions(self,*args,**kwargs):
+
+        self.record('CLEAR',kwargs.get('parameterName',args[0] if args else None))
+
+        return self.japc.clearSubscriptions(*args,**kwargs)
+
+    def record_schema(self,cache):
+        """
+        Store the FESA schema registry of the module (see FESASchema) in the trace, so that the replay does not depend on the cache file.
+        """
+
+        self.record('SCHEMA',None,cache)
+
+    def close(self):
+
+        with self.lock:
+            self.trace.close()
+
+    def __getattr__(self,name):
+
+        return getattr(self.japc,name)
+
+
+
+def read_trace(file_name):
+    """
+    Read all the records of a trace file. A trace which was cut (e.g. killed module) is read up to its last complete record.
+    """
+
+    records=[]
+
+    with gzip.open(file_name,'rb') as trace:
+
+        while True:
+
+            try:
+
+                records.append(pickle.load(trace))
+
+            except (EOFError,pickle.UnpicklingError,OSError):
+
+                break
+
+    return records
+
+
+
+class JAPCReplayer():
+    """
+    Replay backend with the interface of pyjapc.PyJapc, which feeds a trace recorded with JAPCRecorder back to a module.
+
+    The GET/INFO/SET operations of the module are matched in order against the trace. Every mismatch of the operation, of the
+    parameter name or of a SET value is reported as a divergence (see report()). Subscription callbacks are delivered from the
+    trace when the module waits for them (see pump()), so the replay runs as fast as the CPU allows.
+
+    Input:
+
+    trace: (string or list): The trace file or the list of its records.
+
+    tolerance: (float): The relative tolerance for the comparison of the SET values.
+
+    """
+
+    def __init__(self,trace,tolerance=1e-9):
+
+        self.records=read_trace(trace) if isinstance(trace,str) else list(trace)
+        self.tolerance=tolerance
+        self.cursor=0
+        self.selector=None
+        self.subscriptions={} # name -> [callback, getHeader, started]
+        self.divergences=[]
+        self.time=self.records[0][3] if self.records else time.time() # Recording time of the last replayed record
+
+        schemas=[record[2] for record in self.records if record[0]=='SCHEMA']
+        self.schema=schemas[0] if schemas else None
+
+    def now(self):
+        """
+        The recording time of the current position in the trace.
+        """
+
+        if self.cursor<len(self.records):
+            return self.records[self.cursor][3]
+
+        return self.records[-1][3] if self.records else time.time()
+
+    def divergence(self,what,expected,got):
+
+        self.divergences.append({'Record':self.cursor,'Time':self.now(),'What':what,'Expected':expected,'Got':got})
+
+    def same(self,expected,got):
+
+        if isinstance(expected,dict) and isinstance(got,dict):
+
+            return expected.keys()==got.keys() and all(self.same(expected[key],got[key]) for key in expected)
+
+        try:
+
+            return bool(np.allclose(np.asarray(expected,dtype=float),np.asarray(got,dtype=float),rtol=self.tolerance,atol=0))
+
+        except (TypeError,ValueError):
+
+            return expected==got
+
+    def next_record(self,kinds,name):
+        """
+        Advance the trace to the next record of the operation (kinds, name). The callbacks in between are delivered to the active
+        subscriptions, as they arrived during the recording, and the SCHEMA and SELECTOR records are skipped. A mismatch with the
+        next operation of the trace is reported as a divergence.
+        """
+
+        skip=('CALLBACK','SCHEMA','SELECTOR')
+
+        while self.cursor<len(self.records) and self.records[self.cursor][0] in skip:
+            self.deliver(self.records[self.cursor])
+            self.cursor+=1
+
+        index=self.cursor
+
+        if index>=len(self.records):
+            raise TraceExhausted('End of the JAPC trace at {} {}.'.format('/'.join(kinds),name))
+
+        kind,rec_name,value,stamp=self.records[index]
+
+        if not (kind in kinds and rec_name==name) and not (kind=='ERROR' and rec_name==(kinds[0],name)):
+
+            self.divergence('operation',(kind,rec_name),(kinds[0],name))
+
+            # Resynchronise on the next record of the same operation.
+            while index<len(self.records):
+
+                kind,rec_name,value,stamp=self.records[index]
+
+                if (kind in kinds and rec_name==name) or (kind=='ERROR' and rec_name==(kinds[0],name)):
+                    break
+
+                index+=1
+
+            else:
+
+                raise TraceExhausted('Operation {} {} not found in the rest of the JAPC trace.'.format('/'.join(kinds),name))
+
+        self.cursor=index+1
+        self.time=stamp
+
+        if kind=='ERROR':
+            raise RuntimeError('Replayed JAPC error: {}'.format(value))
+
+        return value
+
+    def getParam(self,parameterName,*args,**kwargs):
+
+        return self.next_record(('GET',),JAPCRecorder.key(parameterName))
+
+    def getParamInfo(self,parameterName,*args,**kwargs):
+
+        return self.next_record(('INFO',),JAPCRecorder.key(parameterName))
+
+    def setParam(self,parameterName,parameterValue,*args,**kwargs):
+
+        recorded=self.next_record(('SET',),JAPCRecorder.key(parameterName))
+
+        if not self.same(recorded,parameterValue):
+            self.divergence('SET value',recorded,parameterValue)
+
+    def setSelector(self,timingSelector,*args,**kwargs):
+
+        self.selector=timingSelector
+
+    def subscribeParam(self,parameterName,onValueReceived=None,*args,**kwargs):
+
+        self.next_record(('SUBSCRIBE',),JAPCRecorder.key(parameterName))
+
+        self.subscriptions[JAPCRecorder.key(parameterName)]=[onValueReceived,kwargs.get('getHeader',False),False]
+
+    def startSubscriptions(self,parameterName=None,*args,**kwargs):
+
+        self.next_record(('START',),parameterName)
+
+        for name,subscription in self.subscriptions.items():
+            if parameterName is None or name==parameterName:
+                subscription[2]=True
+
+    def stopSubscriptions(self,parameterName=None,*args,**kwargs):
+
+        self.next_record(('STOP',),parameterName)
+
+        for name,subscription in self.subscriptions.items():
+            if parameterName is None or name==parameterName:
+                subscription[2]=False
+
+    def clearSubscriptions(self,parameterName=None,*args,**kwargs):
+
+        self.next_record(('CLEAR',),parameterName)
+
+        for name in list(self.subscriptions):
+            if parameterName is None or name==parameterName:
+                del self.subscriptions[name]
+
+    def deliver(self,record):
+        """
+        Deliver a CALLBACK record to its subscription, if it is active. True is returned if the callback was called.
+        """
+
+        kind,name,value,stamp=record
+
+        if kind!='CALLBACK':
+            return False
+
+        subscription=self.subscriptions.get(name)
+
+        if subscription is None or not subscription[2]:
+            return False # Late update of a subscription which is already stopped.
+
+        subscription[0](name,*value)
+
+        return True
+
+    def pump(self):
+        """
+        Deliver the next subscription callback of the trace. It is called by GHOST while the module waits for subscription data.
+
+        TraceExhausted is raised if the next operation of the trace is not a callback of an active subscription.
+        """
+
+        while self.cursor<len(self.records):
+
+            kind,name,value,stamp=self.records[self.cursor]
+
+            if kind=='SCHEMA' or kind=='SELECTOR':
+                self.cursor+=1
+                continue
+
+            if kind!='CALLBACK':
+                break
+
+            self.cursor+=1
+            self.time=stamp
+
+            if self.deliver((kind,name,value,stamp)):
+                return True
+
+        raise TraceExhausted('The module waits for subscription data which is not in the JAPC trace.')
+
+    def report(self):
+        """
+        Summary (string) of the replay and of its divergences.
+        """
+
+        lines=['Replayed {0} of {1} records, {2} divergences.'.format(self.cursor,len(self.records),len(self.divergences))]
+
+        for item in self.divergences:
+
+            lines.append('[{0}] {1}: expected {2}, got {3}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(item['Time'])),item['What'],item['Expected'],item['Got']))
+
+        return '\n'.join(lines)
+
+
+
+def replay_module(module_class,trace,**module_kwargs):
+    """
+    Replay a JAPC trace through the run() method of a GHOST module (e.g. HTadjust or OvenRestart).
+
+    Input:
+
+    module_class: The class of the module.
+
+    trace: (string): The trace file, recorded with the japc_record option of the module.
+
+    module_kwargs: Keyword arguments for the initialisation of the module (e.g. dir_logging).
+
+    Output:
+
+    The JAPCReplayer object, with the list of divergences and the report() method.
+
+    """
+
+    replayer=JAPCReplayer(trace)
+
+    module_kwargs.setdefault('no_elog_write',True)
+
+    module=module_class(japc_replay=replayer,**module_kwargs)
+
+    try:
+
+        module.run()
+
+    except (TraceExhausted,SystemExit):
+
+        pass
+
+    return replayer
+
+
+
+if __name__=='__main__':
+
+    # python japc_trace.py HTadjust /path/to/HTadjust_trace.gz [log directory]
+
+    mod_name=sys.argv[1]
+    my_trace=sys.argv[2]
+    my_log_dir=sys.argv[3] if len(sys.argv)>3 else ''
+
+    my_lib=os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(os.path.dirname(my_lib),mod_name))
+
+    my_module=importlib.import_module(mod_name)
+
+    my_replayer=replay_module(getattr(my_module,mod_name),my_trace,dir_logging=my_log_dir,log_level='INFO')
+
+    print(my_replayer.report())